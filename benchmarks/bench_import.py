@@ -0,0 +1,50 @@
+## Import time of the package and of its submodules, each in a fresh interpreter (as in a worker process of a pool),
+## and the modules that each import pulls in.
+## Run with: python benchmarks/bench_import.py
+
+import subprocess
+import sys
+import numpy as np
+
+
+STATEMENTS = [
+    'import numpy',
+    'import sl2pm',
+    'import sl2pm.models',
+    'import sl2pm.pmt',
+    'import sl2pm.bistable_bias',
+    'import sl2pm.track_qd',
+    'import sl2pm.track_rbc',
+    'import sl2pm.track_vessel',
+    'from sl2pm import *',
+    'import sl2pm.__main__',
+]
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start, len(sys.modules), int('mpmath' in sys.modules), int('scipy.optimize' in sys.modules))
+"""
+
+
+def import_time(statement, repeat=5):
+    """
+    Median time (s) of 'statement' in a fresh interpreter, the number of modules loaded, and whether mpmath and scipy.optimize were loaded.
+    """
+    runs = [subprocess.run([sys.executable, '-c', PROBE.format(statement=statement)], capture_output=True, text=True, check=True).stdout.split()
+            for _ in range(repeat)]
+    
+    return np.median([float(run[0]) for run in runs]), int(runs[0][1]), runs[0][2] == '1', runs[0][3] == '1'
+
+
+if __name__ == '__main__':
+    print(f"{'statement':<30}{'time, ms':>10}{'modules':>9}{'mpmath':>8}{'scipy.optimize':>16}")
+    for statement in STATEMENTS:
+        time, n_modules, mpmath, optimize = import_time(statement)
+        print(f"{statement:<30}{1e3*time:>10.0f}{n_modules:>9}{str(mpmath):>8}{str(optimize):>16}")
+    
+    command = [sys.executable, '-m', 'sl2pm', '--version']
+    time = np.median([float(subprocess.run([sys.executable, '-c', f"import subprocess, time; t = time.perf_counter(); subprocess.run({command!r}, capture_output=True); print(time.perf_counter() - t)"], 
+                                           capture_output=True, text=True).stdout) for _ in range(5)])
+    print(f"{'sl2pm --version (process)':<30}{1e3*time:>10.0f}")
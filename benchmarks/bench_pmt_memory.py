@@ -0,0 +1,57 @@
+## Peak memory (RSS) and time of the likelihood of a 256x256 image, pmt.nll_q_grad(...) with s_max=1000 and delta_s=1,
+## evaluated densely (as before the evaluation in chunks) and in chunks with different memory budgets.
+## Each case runs in a fresh process, so that the peak RSS of one case does not hide the others.
+## Run with: python benchmarks/bench_pmt_memory.py
+
+import resource
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sl2pm import pmt
+from sl2pm.models import gaussian
+
+
+ALPHA, SIGMA, MU = 0.45, 6.0, 0.0
+SHAPE, S_MAX, DELTA_S = (256, 256), 1000, 1
+
+
+def nll_q_grad_dense(s, e, a, mu, sigma, delta_s=1, s_max=1024):
+    """
+    Dense evaluation of pmt.nll_q_grad(...), with (s_max/delta_s, pixels) arrays for all pixels at once.
+    """
+    dummy_s = np.arange(0, s_max, delta_s)[:, np.newaxis]
+    ds = s - mu
+    table = pmt.f_table(float(a), delta_s, s_max)
+    kernel = gaussian(ds - dummy_s, sigma)
+    
+    q0 = np.exp(-e)*gaussian(ds, sigma) + np.trapz(kernel*table(e), x=dummy_s[:, 0], axis=0)
+    q1 = np.trapz(kernel*table(e, shift=1), x=dummy_s[:, 0], axis=0)
+    
+    return np.sum(-np.log(q0)), -(q1 - q0)/q0
+
+
+def run(max_bytes, n_evals=3):
+    """
+    Peak RSS (MB) and time per evaluation (s) in this process.
+    """
+    rng = np.random.default_rng(0)
+    e = rng.uniform(0.5, 20, SHAPE).ravel()
+    s = pmt.pmt_output(rng.poisson(e), ALPHA) + rng.normal(0, SIGMA, e.shape)
+    
+    start = time.perf_counter()
+    for _ in range(n_evals):
+        if max_bytes == 'dense':
+            nll_q_grad_dense(s, e, ALPHA, MU, SIGMA, delta_s=DELTA_S, s_max=S_MAX)
+        else:
+            pmt.nll_q_grad(s, e, ALPHA, MU, SIGMA, delta_s=DELTA_S, s_max=S_MAX, max_bytes=max_bytes)
+    
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, (time.perf_counter() - start)/n_evals
+
+
+if __name__ == '__main__':
+    print(f"{'budget':<10}{'peak RSS, MB':>14}{'time, s':>10}")
+    for max_bytes in ['dense', 2**34, 256*2**20, pmt.MEMORY_BUDGET, 16*2**20, 4*2**20]:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            rss, dt = pool.submit(run, max_bytes).result()
+        label = max_bytes if max_bytes == 'dense' else f"{max_bytes/2**20:.0f} MB"
+        print(f"{label:<10}{rss:>14.0f}{dt:>10.2f}")
@@ -0,0 +1,40 @@
+## Accuracy vs. speed of the quadrature rules for the integrals in the models of line-profiles of blood vessels.
+## Errors are relative to a reference computed with many nodes; 'trapz, 256' was the default of the models up to release 1.0.1,
+## Gauss-Legendre with 64 (phi) and 128 (r) nodes is the default now (models.RULE, N_PHI, N_R).
+## Run with: python benchmarks/bench_quadrature.py
+
+import timeit
+import numpy as np
+from sl2pm import models
+
+
+x = np.linspace(-10, 10, 81)
+
+INTEGRALS = [
+    ('f_wall', models.f_wall, (x, 1.2, 0.8, 5.0, 0.3), 'n_phi', 'gauss-legendre'),
+    ('F_lumen', models.F_lumen, (x, 1.2, 0.8, 4.0), 'n_r', 'tanh-sinh'),
+    ('F_gcx', models.F_gcx, (x, 1.2, 0.8, 4.0, 5.0, 0.5), 'n_phi', 'gauss-legendre'),
+]
+
+
+def benchmark(rules=('trapz', 'gauss-legendre', 'tanh-sinh'), nodes=(16, 32, 64, 128, 256), n_ref=2048, repeat=20):
+    """
+    Relative error and time per call of each integral for each quadrature rule and number of nodes.
+    """
+    results = []
+    for name, func, args, n_key, ref_rule in INTEGRALS:
+        ref = func(*args, **{n_key: n_ref, 'rule': ref_rule})
+        for rule in rules:
+            for n in nodes:
+                kwargs = {n_key: n, 'rule': rule}
+                error = np.max(np.abs(func(*args, **kwargs) - ref))/np.max(np.abs(ref))
+                time = min(timeit.repeat(lambda: func(*args, **kwargs), number=1, repeat=repeat))
+                results.append((name, rule, n, error, time))
+
+    return results
+
+
+if __name__ == '__main__':
+    print(f"{'integral':<10}{'rule':<16}{'nodes':>6}{'rel. error':>12}{'time, us':>10}")
+    for name, rule, n, error, time in benchmark():
+        print(f"{name:<10}{rule:<16}{n:>6}{error:>12.1e}{1e6*time:>10.0f}")
@@ -0,0 +1,223 @@
+## Benchmark suite of the hot paths of tracking: time and peak memory of each case on synthetic data of several sizes,
+## checked against regression thresholds (benchmarks/thresholds.json) and, optionally, against the report of a previous run.
+## Run with: python benchmarks/suite.py [-o report.json] [--baseline old_report.json] [--quick]
+## Exits with status 1 if any case exceeds its threshold (or is slower than the baseline by more than --tolerance).
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+from functools import partial
+import numpy as np
+import scipy
+import sl2pm
+from sl2pm import bistable_bias, models, pmt, track_qd, track_rbc, track_vessel
+
+
+ALPHA, SIGMA = 0.452, 6.0
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thresholds.json')
+
+
+def pmt_noise(rng, e, n_aver=1):
+    """
+    PMT output for expected photon counts 'e', averaged over 'n_aver' samples (Gaussian approximation of its distribution).
+    """
+    return pmt.pmt_output(e, ALPHA) + rng.normal(size=np.shape(e))*np.sqrt(pmt.pmt_output_var(e, ALPHA, SIGMA)/n_aver)
+
+
+def pmt_counts(rng, e):
+    """
+    PMT output for expected photon counts 'e', sampled from the Poisson-Gamma model of the PMT plus Gaussian noise.
+    """
+    n = rng.poisson(e)
+    return rng.gamma(np.maximum(3*n, 1e-12), 1/ALPHA)*(n > 0) + rng.normal(0, SIGMA, n.shape)
+
+
+###----------------------------------------------###
+### Cases: setup(size, rng) -> function to time  ###
+
+def setup_f(size, rng):
+    s = np.linspace(1, 300, size)
+    return lambda: [pmt.f(s_k, 5.0, ALPHA) for s_k in s]
+
+
+def setup_q(size, rng):
+    e = rng.uniform(0.5, 20, size)
+    s = pmt_counts(rng, e)
+    return lambda: pmt.q(s, e, ALPHA, 0, SIGMA, delta_s=5, s_max=800)
+
+
+def setup_qd(size, rng):
+    X, Y = track_qd.xy_grid((size, size))
+    image = pmt_counts(rng, models.qd_blurred(X, Y, 0.5, 150, 0.5*size + 0.3, 0.5*size - 0.2, 1.5, 1.2, 0.3))
+    p0 = [0.6, 140, 0.5*size, 0.5*size, 1.4, 1.4, 0.0]
+    return lambda: track_qd.mle_fit(image, ALPHA, SIGMA, 0, p0=p0, minimize_options=dict(gtol=1e-3))
+
+
+def setup_rbc(size, rng):
+    x = np.arange(size)
+    linescan = pmt_counts(rng, models.rbc(x, 2, 14, 2.0, 0.5*size + 0.4))
+    p0 = [2.5, 13, 1.5, 0.5*size]
+    return lambda: track_rbc.mle_fit(linescan, ALPHA, SIGMA, 0, p0=p0, delta_s=4, s_max=700, minimize_options=dict(gtol=1e-3))
+
+
+VESSEL_PARAMS = {
+    'L_plasma_no_glx': (models.L_plasma_no_glx, [0.3, 1.2, 2.0, 4.0, 10.0, 1.0]),
+    'L_wall': (models.L_wall, [0.3, 1.2, 2.0, 4.0, 0.7, 10.0, 3.0, 1.0]),
+    'L_wall_plasma': (models.L_wall_plasma, [0.3, 1.2, 2.0, 4.0, 4.6, 0.8, 0.7, 10.0, 12.0, 3.0, 1.0, 1.5]),
+}
+
+
+def setup_vessel(name, size, rng, n_aver=10):
+    func, p_true = VESSEL_PARAMS[name]
+    x = np.linspace(-8, 8, size)
+    y = pmt_noise(rng, func(x, *p_true), n_aver)
+    p0 = np.multiply(p_true, 1.05)
+    return lambda: track_vessel.mle(x, y, func, p0, n_aver, ALPHA, SIGMA, minimize_options=dict(gtol=1e-3))
+
+
+MULTI_PARAMS = {
+    'L_multi': (models.L_multi, [1.2, 2.0, 0.6, 0.8, 3.0, 1.0, 1.5], [10.0, 12.0, 4.6, 0.3, 0.7]),
+    'L_multi_wall': (models.L_multi_wall, [1.2, 2.0, 3.0, 1.0], [10.0, 4.6, 0.3, 0.7]),
+    'L_multi_plasma': (models.L_multi_plasma, [1.2, 2.0, 1.0], [10.0, 4.6, 0.3]),
+}
+
+
+def setup_multi(name, size, rng, n_aver=10):
+    func, shared, scan = MULTI_PARAMS[name]
+    x = np.linspace(-8, 8, 41)
+    scans = np.array(scan)[:, np.newaxis] + rng.normal(0, 0.05, (len(scan), size))
+    p_true = np.concatenate([shared, scans.ravel()])
+    y = pmt_noise(rng, func(x, *p_true), n_aver)
+    return lambda: track_vessel.mle_multi(x, y, func, 1.02*p_true, n_aver, ALPHA, SIGMA, minimize_options=dict(gtol=1e-3))
+
+
+def setup_bb_double(size, rng):
+    t = np.linspace(0, 0.1, size)
+    p = [0.00072, 0.00052, 1.1e-4, 2.6e-5, 4.6, 14.6, 0.0021, 0.0004, 8e-5, 3e-5, 2.0, 6.0, 176.6]
+    return lambda: bistable_bias.bb_double(t, *p, dt=0.00331)
+
+
+# name: (setup, sizes, label of the size)
+CASES = {
+    'pmt.f': (setup_f, [10, 100, 1000], 'values of s'),
+    'pmt.q': (setup_q, [100, 1000, 10000], 'pixels'),
+    'track_qd.mle_fit': (setup_qd, [8, 16, 32], 'image side, pixels'),
+    'track_rbc.mle_fit': (setup_rbc, [64, 128, 256], 'pixels'),
+    **{f'track_vessel.mle[{name}]': (partial(setup_vessel, name), [41, 81, 161], 'pixels') for name in VESSEL_PARAMS},
+    **{f'track_vessel.mle_multi[{name}]': (partial(setup_multi, name), [4, 16, 64], 'line-profiles') for name in MULTI_PARAMS},
+    'bistable_bias.bb_double': (setup_bb_double, [1000, 100000, 1000000], 'samples'),
+}
+
+
+###----------------------------------------------###
+### Measurements and report                       ###
+
+def measure(func, repeat=5):
+    """
+    Minimal and median times (s) of calls of 'func' after a warm-up call, and the peak of memory allocated during a call (MB).
+    """
+    func()
+    times = timeit.repeat(func, number=1, repeat=repeat)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return dict(time_min=min(times), time_median=float(np.median(times)), peak_mb=peak/2**20)
+
+
+def environment():
+    """
+    Versions and machine the benchmarks ran on.
+    """
+    return dict(sl2pm=getattr(sl2pm, '__version__', None), python=platform.python_version(), numpy=np.__version__, scipy=scipy.__version__,
+                machine=platform.machine(), processor=platform.processor(), system=platform.system(), cpus=os.cpu_count())
+
+
+def run(names=None, quick=False, repeat=5, seed=0):
+    """
+    Measurements of the cases in 'names' (all by default), for the smallest size only if 'quick'.
+    """
+    results = []
+    for name, (setup, sizes, unit) in CASES.items():
+        if names and not any(pattern in name for pattern in names):
+            continue
+        for size in sizes[:1] if quick else sizes:
+            func = setup(size, np.random.default_rng(seed))
+            with np.errstate(all='ignore'):
+                results.append(dict(case=name, size=size, unit=unit, repeat=repeat, **measure(func, repeat=repeat)))
+            print(f"{name:<42}{size:>9}{1e3*results[-1]['time_median']:>12.2f}{results[-1]['peak_mb']:>10.1f}", flush=True)
+
+    return results
+
+
+def check(results, thresholds, baseline=None, tolerance=1.25):
+    """
+    Mark the results exceeding their thresholds ('time' in s, 'peak_mb' in MB, keyed by '<case>/<size>'),
+    or slower (minimal time) than in the 'baseline' results by more than 'tolerance'. Returns the number of regressions.
+    """
+    baseline = {(r['case'], r['size']): r for r in baseline or []}
+    n_regressions = 0
+    for r in results:
+        limits = thresholds.get(f"{r['case']}/{r['size']}", {})
+        r['regressions'] = [f"{key} > {limit}" for key, measured, limit in [('time', r['time_median'], limits.get('time')),
+                                                                              ('peak_mb', r['peak_mb'], limits.get('peak_mb'))]
+                            if limit is not None and measured > limit]
+
+        previous = baseline.get((r['case'], r['size']))
+        if previous is not None:
+            r['speedup'] = previous['time_min']/r['time_min']
+            if r['speedup'] < 1/tolerance:
+                r['regressions'].append(f"time > {tolerance}*baseline")
+
+        n_regressions += bool(r['regressions'])
+
+    return n_regressions
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot paths of sl2pm.")
+    parser.add_argument("-o", "--output", help="write the report to this JSON file")
+    parser.add_argument("-k", "--cases", nargs="+", help="run only the cases whose names contain one of these strings")
+    parser.add_argument("--quick", action="store_true", help="run only the smallest size of each case")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per case")
+    parser.add_argument("--thresholds", default=THRESHOLDS, help="JSON file of regression thresholds")
+    parser.add_argument("--baseline", help="report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed slowdown relative to the baseline")
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+
+    print(f"{'case':<42}{'size':>9}{'time, ms':>12}{'peak, MB':>10}")
+    results = run(args.cases, quick=args.quick, repeat=args.repeat)
+
+    thresholds = {}
+    if args.thresholds and os.path.exists(args.thresholds):
+        with open(args.thresholds) as file:
+            thresholds = json.load(file)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+    n_regressions = check(results, thresholds, baseline, args.tolerance)
+
+    for r in results:
+        if r['regressions']:
+            print(f"REGRESSION {r['case']}/{r['size']}: {', '.join(r['regressions'])}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(dict(environment=environment(), results=results, regressions=n_regressions), file, indent=2)
+
+    return 1 if n_regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+## Validation of the float32 precision mode (config.set_dtype): fits of synthetic kymograms of vessels and images of QDs
+## in float32 and float64, with the largest differences of the fitted positions and radii in units of their error bars,
+## and the times of the fits.
+## Run with: python benchmarks/validate_precision.py [--tolerance 0.1] [--n 64]
+## Exits with status 1 if any difference exceeds the tolerance.
+
+import argparse
+import sys
+import time
+import numpy as np
+from sl2pm import models, simulate, track_qd, track_vessel
+from sl2pm.pmt import Calibration
+
+
+CALIBRATION = Calibration(0.452, 6.0, 0)
+
+# model: (true parameters, fixed parameters, initial guesses of the tracked parameters, tracked parameters checked)
+VESSELS = {
+    'L_plasma_no_glx': (models.L_plasma_no_glx, dict(xc=30.0, s_xy=1.5, l=4.0, R_lum=12.0, I=10.0, b=1.0), ['s_xy', 'l'], ['xc', 'R_lum']),
+    'L_wall': (models.L_wall, dict(xc=30.0, s_xy=1.5, l=4.0, R_wall=12.0, a1=0.7, I=10.0, b_plasma=3.0, b_tissue=1.0), ['s_xy', 'l', 'a1'], ['xc', 'R_wall']),
+}
+
+
+def fit_vessels(name, n, rng, dtype):
+    func, params, fixed, checked = VESSELS[name]
+    x = np.arange(60.0)
+    radius = [name for name in checked if name.startswith('R_')][0]
+    truth = {**params, radius: params[radius] + 0.5*np.sin(np.arange(n)/10)}
+    kymogram = simulate.vessel_kymogram(x, func, truth, 10, CALIBRATION, rng=rng)
+    p0 = {name: 1.05*val for name, val in params.items() if name not in fixed}
+
+    return track_vessel.track_kymogram(kymogram, func, {name: params[name] for name in fixed}, p0, 10, CALIBRATION.alpha, CALIBRATION.sigma,
+                                       x=x, workers=1, minimize_options=dict(gtol=1e-3), dtype=dtype), checked
+
+
+def fit_qds(n, rng, dtype):
+    frames, truth = simulate.qd_frames(7 + 0.02*np.arange(n), 7 - 0.01*np.arange(n), (14, 14), CALIBRATION, rng=rng)
+
+    return track_qd.track_stack(frames, CALIBRATION, workers=1, minimize_options=dict(gtol=1e-3), dtype=dtype), ['xo', 'yo']
+
+
+CASES = {
+    **{f'track_vessel.track_kymogram[{name}]': (lambda n, rng, dtype, name=name: fit_vessels(name, n, rng, dtype)) for name in VESSELS},
+    'track_qd.track_stack': fit_qds,
+}
+
+
+def validate(n=64, seed=0):
+    """
+    For each case, the largest difference between the float32 and float64 fits of each checked parameter, in units of its median error bar,
+    and the times (s) of the fits.
+    """
+    results = []
+    for case, fit in CASES.items():
+        fits, times = {}, {}
+        for dtype in [np.float64, np.float32]:
+            start = time.perf_counter()
+            fits[dtype], checked = fit(n, np.random.default_rng(seed), dtype)
+            times[dtype] = time.perf_counter() - start
+
+        reference, fits32 = fits[np.float64], fits[np.float32]
+        for name in checked:
+            results.append(dict(case=case, param=name,
+                                max_diff=float(np.max(np.abs(fits32[name] - reference[name]))/np.median(reference[name + '_err'])),
+                                time64=times[np.float64], time32=times[np.float32],
+                                success64=int(reference['success'].sum()), success32=int(fits32['success'].sum()), n=n))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Differences between the float32 and float64 fits of sl2pm.")
+    parser.add_argument("--n", type=int, default=64, help="line-profiles (frames) per case")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed difference, in error bars")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = validate(args.n, args.seed)
+    print(f"{'case':<44}{'param':>8}{'max diff, err':>15}{'float64, s':>12}{'float32, s':>12}{'converged 64/32':>17}")
+    for r in results:
+        print(f"{r['case']:<44}{r['param']:>8}{r['max_diff']:>15.2e}{r['time64']:>12.2f}{r['time32']:>12.2f}{r['success64']:>9}/{r['success32']}")
+
+    failed = [r for r in results if not r['max_diff'] <= args.tolerance]
+    for r in failed:
+        print(f"FAILED {r['case']} {r['param']}: {r['max_diff']:.3g} > {args.tolerance} error bars")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
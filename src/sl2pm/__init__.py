@@ -1,25 +1,46 @@
 # The __init__.py file is loaded when the package is loaded.
 # It is used to indicate that the directory in which it resides is a Python package
 
+import importlib
 
-__version__ = (0, 0, 1)
 
-from . import bistable_bias
-from . import misc
-from . import models
-from . import pmt
-from . import track_qd
-from . import track_rbc
-from . import track_vessel
+__version__ = (0, 0, 1)
 
 # The __all__ variable is a list of variables which are imported
 # when a user does "from example import *"
 __all__ = [
     "bistable_bias", 
+    "cache", 
+    "config", 
+    "emulator", 
+    "fisher", 
+    "kernels", 
     "misc", 
     "models", 
     "pmt", 
+    "preprocess", 
+    "profiling", 
+    "quadrature", 
+    "simulate", 
+    "store", 
     "track_qd", 
     "track_rbc", 
     "track_vessel", 
 ]
+
+
+def __getattr__(name):
+    """
+    Import the submodules on first access (PEP 562), so that importing the package, or one of its submodules 
+    (e.g. in the worker processes of a pool), does not import the others and their dependencies (scipy, mpmath).
+    """
+    if name in __all__:
+        module = importlib.import_module(f".{name}", __name__)
+        globals()[name] = module
+        return module
+    
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
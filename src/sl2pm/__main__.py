@@ -1,14 +1,219 @@
 import os
 import sys
+import json
 import argparse
+import numpy as np
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import sl2pm
 
 
 parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parentdir)
 
+COMMAND_CALIBRATE_PMT = "calibrate-pmt"
+COMMAND_CALIBRATE_PSF = "calibrate-psf"
+COMMAND_TRACK_QD = "track-qd"
+COMMAND_TRACK_RBC = "track-rbc"
+COMMAND_TRACK_VESSEL = "track-vessel"
 
-def main():
+# Models of line-profiles of blood vessels (in sl2pm.models) and their OLS fits for the initial guesses (in sl2pm.track_vessel)
+VESSEL_MODELS = {
+    "plasma": ("L_plasma_no_glx", "ols_plasma"),
+    "wall": ("L_wall", "ols_wall"),
+    "wall-plasma": ("L_wall_plasma", "ols_wall_plasma"),
+}
+
+# Parameters of the vessel models fitted for every line-profile by default; the rest are fixed to the PSF calibration
+VESSEL_TRACKED_PARAMS = ["xc", "R_lum", "R_wall"]
+
+
+def vessel_model(name):
+    """
+    Model of line-profiles of blood vessels and its OLS fit, by name in VESSEL_MODELS.
+    The tracking modules are imported here, on first use, so that e.g. 'sl2pm --version' starts fast.
+    """
+    func, ols = VESSEL_MODELS[name]
+    
+    return getattr(sl2pm.models, func), getattr(sl2pm.track_vessel, ols)
+
+
+###----------------------------------------------###
+### Input/output                                  ###
+
+def load(path):
+    """
+    Load a .npy file memory-mapped, so that large acquisitions are read from disk as they are processed.
+    """
+    return np.load(path, mmap_mode="r")
+
+
+class StackedKymograms:
+    """
+    Kymograms [time, x] of the same shape (e.g. memory-mapped wall and plasma kymograms) stacked into [time, 2, x] lazily:
+    rows are read from the kymograms only when indexed, so that they are streamed block by block.
+    """
+    def __init__(self, kymograms):
+        if len({np.shape(kymogram) for kymogram in kymograms}) > 1:
+            raise ValueError(f"The kymograms have different shapes: {[np.shape(kymogram) for kymogram in kymograms]}")
+        
+        self.kymograms = kymograms
+        self.shape = (len(kymograms[0]), len(kymograms)) + np.shape(kymograms[0])[1:]
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        rows = [kymogram[rows] for kymogram in self.kymograms]
+        return np.stack(rows, axis=np.ndim(rows[0]) - self.ndim + 2)
+
+
+def load_kymogram(paths):
+    """
+    Load a kymogram [time, x], or two (wall and plasma) kymograms stacked into [time, 2, x], memory-mapped.
+    """
+    if len(paths) == 1:
+        return load(paths[0])
+
+    return StackedKymograms([load(path) for path in paths])
+
+
+def load_calibration(path):
+    """
+    Load a calibration file (JSON): PMT parameters 'alpha', 'sigma', 'mu' and, optionally, the PSF calibration 'psf'.
+    """
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_calibration(path, calibration):
+    """
+    Save a calibration to a JSON file, keeping the entries of an existing file that are not in 'calibration'.
+    """
+    if os.path.exists(path):
+        calibration = {**load_calibration(path), **calibration}
+
+    with open(path, "w") as file:
+        json.dump(calibration, file, indent=4)
+
+
+def result_store(args, dtype):
+    """
+    The result store (sl2pm.store.ResultStore) of the output given with -o: with --resume, its committed records are kept
+    and the tracking resumes after them, otherwise it is rewritten.
+    """
+    if not args.resume and os.path.exists(args.output + ".index.json"):
+        os.remove(args.output + ".index.json")
+
+    return sl2pm.store.ResultStore(args.output, dtype)
+
+
+def parallel_map(func, items, workers, chunksize=16):
+    """
+    Map 'func' over 'items' in a pool of 'workers' processes (all CPUs by default, no pool if workers=1),
+    yielding the results in order as they are ready.
+    """
+    if workers == 1:
+        yield from map(func, items)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            yield from pool.map(func, items, chunksize=chunksize)
+
+
+###----------------------------------------------###
+### Subcommands                                   ###
+
+def calibrate_psf(kymogram, model, alpha, sigma, minimize_options=None, block_size=1024):
+    """
+    PSF calibration from the time-averaged line-profile of a vessel (or the wall and plasma line-profiles),
+    fitted with MLE from the OLS initial guess. The kymogram is averaged over blocks of 'block_size' rows read one at a time.
+    """
+    func, ols = vessel_model(model)
+    n_aver = len(kymogram)
+    y = sum(np.sum(kymogram[i: i + block_size], axis=0, dtype=float) for i in range(0, n_aver, block_size))/n_aver
+    gain = 3/alpha
+
+    p0 = ols(*y/gain) if y.ndim == 2 else ols(y/gain)
+    x = np.arange(y.shape[-1])
+    res = sl2pm.track_vessel.mle(x, y, func, p0, n_aver, alpha, sigma, minimize_options=minimize_options)
+    params = sl2pm.misc.fitted_params(res, sl2pm.track_vessel.model_params(func))
+
+    return dict(model=model,
+                n_aver=n_aver,
+                params={name: val for name, (val, err) in params.items()},
+                errors={name: err for name, (val, err) in params.items()})
+
+
+def _fit_rbc(linescan, calibration, plasma_before_rbc, minimize_options):
+    return sl2pm.misc.fit_record(sl2pm.track_rbc.mle_fit(np.asarray(linescan, dtype=float), *calibration,
+                                             plasma_before_rbc=plasma_before_rbc, minimize_options=minimize_options))
+
+
+def track_qd_blocks(images, calibration, block_size=1024, workers=None, minimize_options=None, cache=None):
+    """
+    Track a QD through a stack of images in blocks of 'block_size' frames with sl2pm.track_qd.track_stack(...);
+    yields the fitting results for each frame.
+    """
+    for i in range(0, len(images), block_size):
+        block = np.asarray(images[i: i + block_size], dtype=float)
+        fits = sl2pm.profiling.run(sl2pm.profiling.enabled(), sl2pm.track_qd.track_stack, block, calibration, 
+                                   chunk_size=max(1, len(block)//(workers or os.cpu_count())), workers=workers, minimize_options=minimize_options, cache=cache)
+        yield from sl2pm.profiling.collect(fits, start=i)
+
+
+def track_vessel_blocks(kymogram, psf, alpha, sigma, n_aver=1, tracked=None, block_size=1024, workers=None, minimize_options=None, cache=None, 
+                        start=0, last=None):
+    """
+    Track a vessel through a kymogram, from its row 'start', in blocks of 'block_size' line-profiles, averaged over 'n_aver' consecutive rows,
+    with the parameters not in 'tracked' fixed to the PSF calibration; yields the fitting results for each line-profile.
+    Each block starts from the last fit of the previous one; the first, from 'last' (the fit before 'start', e.g. of a resumed run) if given.
+    """
+    func = vessel_model(psf["model"])[0]
+    tracked = VESSEL_TRACKED_PARAMS if tracked is None else tracked
+    fixed = {name: val for name, val in psf["params"].items() if name not in tracked}
+    p0 = {name: val for name, val in psf["params"].items() if name in tracked}
+    p0 = p0 if last is None else {name: last[name] for name in p0}
+
+    n_rows = start + (len(kymogram) - start)//n_aver*n_aver
+    for i in range(start, n_rows, block_size*n_aver):
+        block = np.asarray(kymogram[i: min(i + block_size*n_aver, n_rows)], dtype=float)
+        block = block.reshape((-1, n_aver) + block.shape[1:]).mean(axis=1)
+        fits = sl2pm.profiling.run(sl2pm.profiling.enabled(), sl2pm.track_vessel.track_kymogram, block, func, fixed, p0, n_aver, alpha, sigma,
+                                   chunk_size=max(1, len(block)//(workers or os.cpu_count())),
+                                   workers=workers, minimize_options=minimize_options, cache=cache)
+        fits = sl2pm.profiling.collect(fits, start=(i - start)//n_aver)
+        yield from fits
+        p0 = {name: fits[name][-1] for name in fits.dtype.names if name in p0} if len(fits) else p0
+
+
+def result_cache(args):
+    """
+    The cache of fitting results in the directory given with --cache, if any.
+    """
+    return sl2pm.cache.ResultCache(args.cache, max_bytes=int(args.cache_size*2**20)) if args.cache else None
+
+
+@contextmanager
+def profiled(args):
+    """
+    Profile the fits within the block if --profile is given: writes the profile (.json) and prints its summary.
+    """
+    if not getattr(args, "profile", None):
+        yield
+        return
+
+    with sl2pm.profiling.profile() as profile:
+        yield
+    profile.save(args.profile)
+    print(profile.table())
+
+
+###----------------------------------------------###
+### Command line interface                        ###
+
+def make_parser():
     doc = f"""
     Version: {'.'.join([str(i) for i in sl2pm.__version__])}
 
@@ -26,9 +231,94 @@ def main():
         action="version",
         version=f'SL2PM {".".join(map(str, sl2pm.__version__))}',
     )
-    args = parser.parse_args()
 
-    # if args.subcommand == COMMAND_CENTRIFUGE:
-    #     df_result = centrifuge_data(args.input)
-    # else:
-    #     assert False
+    subparsers = parser.add_subparsers(dest="subcommand", metavar="subcommand")
+
+    pmt_parser = subparsers.add_parser(COMMAND_CALIBRATE_PMT, help="calibrate the PMT (alpha, sigma, mu) from images of a uniform slide, the first one with the laser off")
+    pmt_parser.add_argument("images", nargs="+", help="images (.npy), [image, y, x], or one image stack (.npy) per laser intensity, [frame, y, x]")
+    pmt_parser.add_argument("--dark", type=int, default=0, help="index of the image (stack) recorded with the laser off (default: %(default)s)")
+    pmt_parser.add_argument("--per-pixel", action="store_true", help="fit the variance vs mean of every pixel over the frames of each stack (non-uniform fluorescence)")
+    pmt_parser.add_argument("--refine", action="store_true", help="refine the calibration by MLE on the full distribution of PMT output")
+    pmt_parser.add_argument("-c", "--calibration", required=True, help="calibration file (.json) to write")
+
+    psf_parser = subparsers.add_parser(COMMAND_CALIBRATE_PSF, help="calibrate the PSF from the time-averaged line-profile of a vessel")
+    psf_parser.add_argument("kymograms", nargs="+", help="kymogram (.npy), [time, x], or the wall and the plasma kymograms for '--model wall-plasma'")
+    psf_parser.add_argument("-c", "--calibration", required=True, help="calibration file (.json) with the PMT calibration, updated with the PSF calibration")
+    psf_parser.add_argument("--model", choices=list(VESSEL_MODELS), default="plasma", help="model of line-profiles (default: %(default)s)")
+    psf_parser.add_argument("--block-size", type=int, default=1024, help="rows of the kymograms read at a time (default: %(default)s)")
+
+    for command, inputs, description in [(COMMAND_TRACK_QD, "images", "track QDs on images, [image, y, x]"),
+                                  (COMMAND_TRACK_RBC, "linescans", "track RBCs on line-scans, [line-scan, x]"),
+                                  (COMMAND_TRACK_VESSEL, "kymograms", "track a vessel's center and radius through kymograms, [time, x]")]:
+        track_parser = subparsers.add_parser(command, help=description)
+        track_parser.add_argument(inputs, nargs="+" if command == COMMAND_TRACK_VESSEL else None, help=f"{inputs} (.npy)")
+        track_parser.add_argument("-c", "--calibration", required=True, help="calibration file (.json)")
+        track_parser.add_argument("-o", "--output", required=True, help="output (.npy) with the fitted parameters, their error bars, and convergence flags, written in chunks as they are fitted")
+        track_parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: all CPUs)")
+        track_parser.add_argument("--gtol", type=float, default=1e-3, help="gradient tolerance of the MLE fits (default: %(default)s)")
+        track_parser.add_argument("--resume", action="store_true", help="keep the results in the output of an interrupted run and track the rest")
+        track_parser.add_argument("--profile", default=None, help="file (.json) to write the times of the stages of the fits and the evaluations and iterations of every fit to")
+
+        if command == COMMAND_TRACK_RBC:
+            track_parser.add_argument("--rbc-before-plasma", action="store_true", help="RBCs enter the line-scans before plasma")
+        if command == COMMAND_TRACK_VESSEL:
+            track_parser.add_argument("--n-aver", type=int, default=1, help="number of consecutive rows averaged per line-profile (default: %(default)s)")
+            track_parser.add_argument("--tracked", nargs="+", default=None, help=f"parameters fitted for every line-profile (default: {' '.join(VESSEL_TRACKED_PARAMS)})")
+        if command in [COMMAND_TRACK_QD, COMMAND_TRACK_VESSEL]:
+            track_parser.add_argument("--block-size", type=int, default=1024, help="frames (line-profiles) fitted and written per block (default: %(default)s)")
+            track_parser.add_argument("--cache", default=None, help="directory of cached fitting results, reused when re-running on the same data and options")
+            track_parser.add_argument("--cache-size", type=float, default=1024, help="maximal size of the cache, MB (default: %(default)s)")
+
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+
+    if args.subcommand == COMMAND_CALIBRATE_PMT:
+        stacks = [load(path) for path in args.images] if len(args.images) > 1 else load(args.images[0])
+        sl2pm.pmt.calibrate(stacks, dark=args.dark, per_pixel=args.per_pixel, refine=args.refine).save(args.calibration)
+
+    elif args.subcommand == COMMAND_CALIBRATE_PSF:
+        calib = sl2pm.pmt.Calibration.load(args.calibration)
+        psf = calibrate_psf(load_kymogram(args.kymograms), args.model, calib.alpha, calib.sigma, minimize_options=dict(gtol=1e-3), 
+                            block_size=args.block_size)
+        save_calibration(args.calibration, dict(psf=psf))
+
+    elif args.subcommand == COMMAND_TRACK_QD:
+        calib = sl2pm.pmt.Calibration.load(args.calibration)
+        images = load(args.images)
+        store = result_store(args, sl2pm.misc.fit_dtype(sl2pm.track_vessel.model_params(sl2pm.models.qd_blurred)[1:]))
+        fits = track_qd_blocks(images[len(store):], calib, block_size=args.block_size, workers=args.workers, minimize_options=dict(gtol=args.gtol),
+                               cache=result_cache(args))
+        with profiled(args):
+            store.extend(fits)
+
+    elif args.subcommand == COMMAND_TRACK_RBC:
+        calib = sl2pm.pmt.Calibration.load(args.calibration)
+        linescans = load(args.linescans)
+        store = result_store(args, sl2pm.misc.fit_dtype(sl2pm.track_vessel.model_params(sl2pm.models.rbc)))
+        fit = partial(_fit_rbc, calibration=calib, plasma_before_rbc=not args.rbc_before_plasma, minimize_options=dict(gtol=args.gtol))
+        with profiled(args):
+            fits = parallel_map(partial(sl2pm.profiling.run, sl2pm.profiling.enabled(), fit), linescans[len(store):], args.workers)
+            store.extend(sl2pm.profiling.collect(output, start=i) for i, output in enumerate(fits, start=len(store)))
+
+    elif args.subcommand == COMMAND_TRACK_VESSEL:
+        calib = sl2pm.pmt.Calibration.load(args.calibration)
+        kymogram = load_kymogram(args.kymograms)
+        psf = load_calibration(args.calibration)["psf"]
+        tracked = [name for name in psf["params"] if name in (VESSEL_TRACKED_PARAMS if args.tracked is None else args.tracked)]
+        store = result_store(args, sl2pm.misc.fit_dtype(tracked))
+        fits = track_vessel_blocks(kymogram, psf, calib.alpha, calib.sigma, n_aver=args.n_aver, tracked=tracked, block_size=args.block_size, 
+                                   workers=args.workers, minimize_options=dict(gtol=args.gtol), cache=result_cache(args), start=len(store)*args.n_aver, 
+                                   last=store.read()[-1] if len(store) else None)
+        with profiled(args):
+            store.extend(fits)
+
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
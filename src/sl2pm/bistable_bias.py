@@ -1,4 +1,6 @@
+import inspect
 import numpy as np
+from . import config
 
 
 def step(t, tau1, tau2, dI1, dI2):
@@ -15,13 +17,25 @@ def step_diff(t, w, tau1, tau2, dI1, dI2):
     return step(t, tau1, tau2, dI1, dI2) - step(t-w, tau1, tau2, dI1, dI2)
 
 
+def _tails(phase, w, tau, dI, dt):
+    """
+    One exponential component of step_diff_periodic(...) at 'phase' = (t - t0) mod dt: the current step,
+    plus the tails of all the previous steps summed as a geometric series.
+    """
+    current = np.where(phase < w, dI*(1 - np.exp(-phase/tau)), dI*(np.exp(-np.maximum(phase - w, 0)/tau) - np.exp(-phase/tau)))
+    previous = dI*(np.exp(-(phase - w + dt)/tau) - np.exp(-(phase + dt)/tau))/-np.expm1(-dt/tau)
+    
+    return current + previous
+
+
 def step_diff_periodic(t, t0, w, tau1, tau2, dI1, dI2, dt):
     """
     Part of the expression for bb_single and bb_double, describing a single bistable bias step repeated periodically.
+    Evaluated in closed form, O(len(t)), for a step shorter than the period (w < dt) that has been repeating long before t[0].
     """
-    step_start = np.arange(t0 - 3*dt, t[-1] + 4*dt, dt)
+    phase = np.mod(t - t0, dt)
 
-    return step_diff(t[np.newaxis, :] - step_start[:, np.newaxis], w, tau1, tau2, dI1, dI2).sum(axis=0)
+    return _tails(phase, w, tau1, dI1, dt) + _tails(phase, w, tau2, dI2, dt)
 
 
 def bb_single(t, t0, w, tau1, tau2, dI1, dI2, I0, dt):
@@ -35,4 +49,103 @@ def bb_double(t, t01, w1, tau11, tau21, dI11, dI21, t02, w2, tau12, tau22, dI12,
     """
     Model of bistable bias with two steps.
     """
-    return I0 - step_diff_periodic(t, t01, w1, tau11, tau21, dI11, dI21, dt) - step_diff_periodic(t, t02, w2, tau12, tau22, dI12, dI22, dt)
\ No newline at end of file
+    return I0 - step_diff_periodic(t, t01, w1, tau11, tau21, dI11, dI21, dt) - step_diff_periodic(t, t02, w2, tau12, tau22, dI12, dI22, dt)
+
+
+def model_params(model):
+    """
+    Names of the fitted parameters of a bistable bias model (all arguments but 't' and 'dt').
+    """
+    return [name for name in inspect.signature(model).parameters if name not in ('t', 'dt')]
+
+
+def _jac(model, t, p, dt):
+    """
+    Forward-difference Jacobians of 'model' for a batch of parameters 'p' [trace, parameter], [trace, t, parameter].
+    """
+    f0 = model(t, *p.T[..., np.newaxis], dt=dt)
+    h = np.sqrt(np.finfo(float).eps)*np.maximum(np.abs(p), 1e-8)
+    jac = np.empty(f0.shape + (p.shape[1],))
+    for k in range(p.shape[1]):
+        p_k = p.copy()
+        p_k[:, k] += h[:, k]
+        jac[..., k] = (model(t, *p_k.T[..., np.newaxis], dt=dt) - f0)/h[:, k, np.newaxis]
+    
+    return f0, jac
+
+
+def fit_batch(t, traces, p0, dt, model=bb_single, max_iter=200, ftol=1e-10):
+    """
+    Least-squares fit of a bistable bias 'model' (bb_single or bb_double) to many traces [trace, t] at once 
+    (e.g. averaged periods of the PMT output of several channels), with a Levenberg-Marquardt iteration vectorized over the traces.
+    'p0' is the initial guess, a dict or a sequence for all traces, or an array [trace, parameter]; 'dt' is the period.
+    Returns a structured array with the fitted parameters, their error bars ('<name>_err', as from curve_fit), 
+    the residual sum of squares ('rss'), convergence flags ('success'), and numbers of iterations ('nit') for each trace.
+    """
+    names = model_params(model)
+    traces = np.atleast_2d(traces)
+    n, n_t, k = len(traces), traces.shape[-1], len(names)
+    p = np.array([p0[name] for name in names] if isinstance(p0, dict) else p0, dtype=float)
+    p = np.broadcast_to(p, (n, k)).copy()
+    
+    lam = np.full(n, 1e-2)
+    nit = np.zeros(n, dtype=int)
+    active, success = np.ones(n, dtype=bool), np.zeros(n, dtype=bool)
+    rss = np.sum((model(t, *p.T[..., np.newaxis], dt=dt) - traces)**2, axis=1)
+    
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        f0, jac = _jac(model, t, p[active], dt)
+        A = np.einsum('ntk,ntl->nkl', jac, jac)
+        g = np.einsum('ntk,nt->nk', jac, f0 - traces[active])
+        damping = lam[active, np.newaxis, np.newaxis]*np.eye(k)*np.diagonal(A, axis1=1, axis2=2)[:, np.newaxis, :]
+        
+        p_new = p[active] - np.linalg.solve(A + damping, g[..., np.newaxis])[..., 0]
+        rss_new = np.sum((model(t, *p_new.T[..., np.newaxis], dt=dt) - traces[active])**2, axis=1)
+        
+        accept = rss_new < rss[active]
+        converged = accept & (rss[active] - rss_new <= ftol*rss[active])
+        idx = np.flatnonzero(active)
+        p[idx[accept]], rss[idx[accept]] = p_new[accept], rss_new[accept]
+        lam[idx] = np.where(accept, lam[idx]/10, lam[idx]*10)
+        nit[idx] += 1
+        success[idx[converged]] = True
+        active[idx[converged | (lam[idx] > 1e10)]] = False
+    
+    f0, jac = _jac(model, t, p, dt)
+    A = np.einsum('ntk,ntl->nkl', jac, jac)
+    cov = np.linalg.pinv(A)*(rss/max(n_t - k, 1))[:, np.newaxis, np.newaxis]
+    
+    result = np.zeros(n, dtype=[(name, float) for name in names] + [(name + '_err', float) for name in names] + 
+                      [('rss', float), ('success', bool), ('nit', int)])
+    for i, name in enumerate(names):
+        result[name], result[name + '_err'] = p[:, i], np.sqrt(np.diagonal(cov, axis1=1, axis2=2)[:, i])
+    result['rss'], result['success'], result['nit'] = rss, success, nit
+    
+    return result
+
+
+def bias(t, params, dt, model=bb_single):
+    """
+    Bistable bias at times 't' (the model less its baseline, I0), given the fitted parameters 'params' (dict or record of fit_batch(...)).
+    """
+    return model(t, *[params[name] for name in model_params(model)], dt=dt) - params['I0']
+
+
+def correct(chunks, params, dt, sampling_interval, t_start=0, model=bb_single, dtype=None):
+    """
+    Subtract the bistable bias from raw PMT output read in chunks (arrays with time along the last axis, e.g. blocks of a recording), 
+    as a streaming preprocessing stage; 'sampling_interval' is the time between samples and 't_start' the time of the first one.
+    The bias is computed in the precision 'dtype' (config.DTYPE by default), from the times modulo the period 'dt' 
+    (the models are periodic), which float32 represents accurately.
+    Yields the corrected chunks.
+    """
+    dtype = config.get_dtype(dtype)
+    n = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=dtype)
+        t = np.mod(t_start + (n + np.arange(chunk.shape[-1]))*sampling_interval, dt).astype(dtype, copy=False)
+        n += chunk.shape[-1]
+        
+        yield chunk - bias(t, params, dt, model=model)
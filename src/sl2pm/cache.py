@@ -0,0 +1,197 @@
+## On-disk cache of fitting results, keyed by a content hash of the data, the model, the calibration and the options,
+## so that repeated tracking runs over the same recordings only refit the chunks that changed
+
+import functools
+import hashlib
+import importlib.metadata
+import os
+import tempfile
+import types
+import numpy as np
+import sl2pm
+from . import config, kernels, profiling
+
+
+def _version():
+    """
+    Version of the installed package, from its metadata (sl2pm.__version__ if it is not installed, e.g. run from the source tree).
+    """
+    try:
+        return importlib.metadata.version('sl2pm')
+    except importlib.metadata.PackageNotFoundError:
+        return '.'.join(map(str, sl2pm.__version__))
+
+
+VERSION = _version()
+
+
+def _update(h, obj):
+    """
+    Feed a canonical byte representation of 'obj' to the hash 'h': arrays by their dtype, shape and content,
+    functions by their qualified name, bytecode and the contents of their closures, partial functions by their function, 
+    arguments and keywords, bound methods by their function and instance, containers recursively, 
+    other objects by their class and attributes.
+    Raises TypeError for objects that have no such representation, such as callables known only by their address.
+    """
+    if isinstance(obj, (np.ndarray, np.generic)):
+        obj = np.ascontiguousarray(obj)
+        h.update(f'ndarray:{obj.dtype.descr}:{obj.shape}:'.encode())
+        h.update(repr(obj.tolist()).encode() if obj.dtype.hasobject else obj.data)
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        h.update(f'{type(obj).__name__}:{obj!r};'.encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}:{len(obj)}['.encode())
+        for item in obj:
+            _update(h, item)
+        h.update(b']')
+    elif isinstance(obj, dict):
+        h.update(f'dict:{len(obj)}{{'.encode())
+        for k in sorted(obj, key=repr):
+            _update(h, k)
+            _update(h, obj[k])
+        h.update(b'}')
+    elif isinstance(obj, functools.partial):
+        h.update(b'partial:')
+        _update(h, (obj.func, obj.args, obj.keywords))
+    elif isinstance(obj, types.MethodType):
+        h.update(b'method:')
+        _update(h, (obj.__func__, obj.__self__))
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        h.update(f'function:{obj.__module__}.{obj.__qualname__};'.encode())
+        code = getattr(obj, '__code__', None)
+        if code is not None:
+            h.update(code.co_code)
+            _update(h, [c for c in code.co_consts if not hasattr(c, 'co_code')])
+            # the values a closure captured, but not the function itself (a recursive closure)
+            try:
+                cells = [cell.cell_contents for cell in obj.__closure__ or ()]
+            except ValueError:
+                raise TypeError(f"Cannot hash {obj!r} for a cache key: its closure has an empty cell") from None
+            _update(h, [None if cell is obj else cell for cell in cells])
+    elif hasattr(obj, '__dict__'):
+        h.update(f'object:{type(obj).__module__}.{type(obj).__qualname__}'.encode())
+        _update(h, vars(obj))
+    elif ' at 0x' in repr(obj):
+        raise TypeError(f"Cannot hash {obj!r} for a cache key: it is known only by its address")
+    else:
+        h.update(f'{type(obj).__qualname__}:{obj!r};'.encode())
+
+
+def key(*parts):
+    """
+    SHA-256 hex digest of 'parts' (arrays, scalars, strings, lists, tuples, dicts, functions, and objects such as
+    track_vessel.ReducedModel or pmt.NLLTable), e.g. of a chunk of data, the model, its fixed parameters, the calibration and the optimizer options.
+    The version of the package (VERSION, from its metadata), the backend (kernels.BACKEND) and the precision (config.DTYPE) are part of every key,
+    as the hash of a function does not cover the functions it calls: results cached before an upgrade are not reused.
+    """
+    h = hashlib.sha256()
+    _update(h, (VERSION, kernels.BACKEND, config.DTYPE.name))
+    _update(h, parts)
+
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of arrays (e.g. fitting results of chunks of frames or line-profiles) in 'directory', one .npy file per key.
+    When the files exceed 'max_bytes' in total, the least recently used ones are removed.
+    Files are written to temporary files and then renamed, so that worker processes can share a cache safely:
+    a reader sees either a complete file or none, and concurrent writers of the same key write the same result.
+    """
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory, self.max_bytes = os.fspath(directory), max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """
+        The array cached for 'key', or None; marks it as recently used.
+        """
+        path = self._path(key)
+        try:
+            result = np.load(path, allow_pickle=False)
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, or removed by another process meanwhile
+            return None
+
+        return result
+
+    def put(self, key, result):
+        """
+        Cache the array 'result' for 'key', then remove the least recently used files beyond max_bytes.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.save(file, np.asarray(result), allow_pickle=False)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def entries(self):
+        """
+        Keys, sizes (bytes) and times of last use of the cached results, least recently used first.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.name[:-4], stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        """
+        Remove the least recently used results until they take at most max_bytes in total.
+        """
+        entries = self.entries()
+        excess = sum(size for _, size, _ in entries) - self.max_bytes
+        for k, size, _ in entries:
+            if excess <= 0:
+                break
+            try:
+                os.remove(self._path(k))
+            except FileNotFoundError:
+                pass
+            excess -= size
+
+    def clear(self):
+        for k, _, _ in self.entries():
+            try:
+                os.remove(self._path(k))
+            except FileNotFoundError:
+                pass
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def __len__(self):
+        return len(self.entries())
+
+
+def cached_call(cache, func, *args):
+    """
+    func(*args), an array, or its result cached in 'cache' (a ResultCache, or None for no caching) under the key of 'func' and 'args'.
+    Meant to be submitted to worker processes in place of func, e.g. pool.submit(cached_call, cache, _fit_rows, ...).
+    """
+    if cache is None:
+        return func(*args)
+
+    k = key(func, *args)
+    result = cache.get(k)
+    if result is None:
+        profiling.count('cache.misses')
+        result = func(*args)
+        cache.put(k, result)
+    else:
+        profiling.count('cache.hits')
+
+    return result
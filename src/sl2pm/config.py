@@ -0,0 +1,44 @@
+## Package-wide settings: the floating-point precision of the models and likelihoods
+
+import numpy as np
+from contextlib import contextmanager
+
+
+DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+
+# Precision of model evaluation and of the (PMT output x pixel) arrays of the likelihoods;
+# sums of log-likelihoods and gradients are always accumulated in float64
+DTYPE = np.dtype(np.float64)
+
+
+def get_dtype(dtype=None):
+    """
+    The floating-point type 'dtype' (float32 or float64), or the package-wide DTYPE if None.
+    """
+    dtype = DTYPE if dtype is None else np.dtype(dtype)
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported precision {dtype}, use float32 or float64")
+
+    return dtype
+
+
+def set_dtype(dtype):
+    """
+    Set the package-wide precision (np.float32 or np.float64) of the models and likelihoods.
+    The tracking functions pass it on to their worker processes.
+    """
+    global DTYPE
+    DTYPE = get_dtype(dtype)
+
+
+@contextmanager
+def precision(dtype):
+    """
+    Context manager setting the package-wide precision within a block, e.g. 'with config.precision(np.float32): ...'.
+    """
+    previous = DTYPE
+    set_dtype(dtype)
+    try:
+        yield
+    finally:
+        set_dtype(previous)
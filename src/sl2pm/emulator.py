@@ -0,0 +1,225 @@
+## Emulators of the models of line-profiles of blood vessels for a fixed PSF calibration (s_xy, l, and s_gcx):
+## the unit-intensity profile shapes are tabulated over a grid of distances from the vessel center and radii,
+## so that evaluating a profile at any xc and R is an interpolation.
+
+import inspect
+import numpy as np
+from scipy.ndimage import spline_filter1d
+from scipy.special import ive
+from . import models
+from .quadrature import quadrature
+
+
+def wall_modes(x_psf, s_xy, l, R_wall, n_modes=16, n_phi=64, rule='gauss-legendre'):
+    """
+    Fourier modes of f_wall(...) in the wall-density anisotropy:
+    f_wall(x_psf, s_xy, l, R_wall, a1) = sum(wall_mode_weights(a1)*wall_modes(x_psf, s_xy, l, R_wall)),
+    with the modes along the first axis.
+    """
+    phi, w = quadrature(n_phi, rule).on(0, np.pi, x_psf, s_xy, l, R_wall)
+    integrand = 2*R_wall*models.gaussian(R_wall*np.cos(phi) - x_psf, s_xy)*models.laplace(R_wall*np.sin(phi), l)
+
+    return np.array([np.sum(w*np.cos(k*phi)*integrand, axis=0) for k in range(n_modes)])
+
+
+def wall_mode_weights(a1, n_modes=16):
+    """
+    Weights of the Fourier modes of f_wall(...), from exp(a1*cos(phi))/I0(a1) = 1 + 2*sum(Ik(a1)/I0(a1)*cos(k*phi)),
+    and their derivatives with respect to a1.
+    """
+    k = np.arange(n_modes).reshape((-1,) + (1,)*np.ndim(a1))
+    I = ive(k, a1)/ive(0, a1)
+    dI = 0.5*(ive(k - 1, a1) + ive(k + 1, a1))/ive(0, a1) - I*ive(1, a1)/ive(0, a1)
+    c = np.where(k == 0, 1, 2)
+
+    return c*I, c*dI
+
+
+def bspline_weights(t, derivative=0):
+    """
+    Weights of the four nearest nodes in cubic B-spline interpolation at fractional positions 't' between nodes
+    (or their derivatives), with the nodes along the first axis.
+    """
+    w = np.empty((4,) + np.shape(t))
+    if derivative:
+        w[0], w[1], w[3] = -0.5*(1 - t)**2, (1.5*t - 2)*t, 0.5*t**2
+        w[2] = -w[0] - w[1] - w[3]
+    else:
+        w[0], w[1], w[3] = (1 - t)**3/6, (0.5*t - 1)*t**2 + 2/3, t**3/6
+        w[2] = 1 - w[0] - w[1] - w[3]
+
+    return w
+
+
+class ProfileEmulator:
+    """
+    Tabulated unit-intensity shapes of the line-profiles of a blood vessel for fixed s_xy, l, and (optionally) s_gcx:
+    F_lumen(u, R), the Fourier modes of f_wall(u, R, a1), and the glycocalyx term of F_plasma(u, R_lum, R_wall),
+    on a grid of u = x - xc and R in 'R_range' with step 'delta' (s_xy/8 by default), interpolated with bicubic splines.
+    Outside of the grid, u and R are clamped to it, so 'R_range' must cover the radii of the vessel.
+    The emulated models are available as ProfileEmulator.model(name), see EmulatedModel.
+    """
+    def __init__(self, s_xy, l, R_range, s_gcx=None, delta=None, n_modes=16):
+        self.s_xy, self.l, self.s_gcx, self.n_modes = s_xy, l, s_gcx, n_modes
+        self.delta = s_xy/8 if delta is None else delta
+
+        # the grid extends 8 nodes beyond 'R_range' and the profiles, so that the splines are accurate within them
+        R_min, R_max = R_range[0] - 8*self.delta, R_range[1] + 8*self.delta
+        u_max = R_max + 8*s_xy
+        self.u = np.arange(-u_max, u_max + self.delta, self.delta)
+        self.R = np.arange(R_min, R_max + self.delta, self.delta)
+        self.R_range = R_range
+        u, R = self.u[:, np.newaxis], self.R[np.newaxis]
+
+        tables = [models.F_lumen(u, s_xy, l, R, n_r=128, rule='tanh-sinh'), *wall_modes(u, s_xy, l, R, n_modes)]
+        if s_gcx is not None:
+            # F_gcx(u, R_lum, R_wall) = gcx(u, R_lum) - exp((R_lum - R_wall)/s_gcx)*gcx(u, R_wall),
+            # where gcx(u, R) is the glycocalyx term of a glycocalyx with no outer boundary
+            tables.append(models.F_gcx(u, s_xy, l, R, R + 40*s_gcx, s_gcx, n_phi=64, rule='gauss-legendre'))
+
+        self.coefs = spline_filter1d(spline_filter1d(np.array(tables), axis=1), axis=2)
+        self.lumen, self.wall, self.gcx = 0, slice(1, 1 + n_modes), 1 + n_modes
+
+    def _nodes(self, v, grid, derivative):
+        """
+        Indices of the four nearest nodes of 'grid' to 'v' (clamped to the grid) and their spline weights.
+        """
+        t = np.clip((v - grid[0])/self.delta, 1, len(grid) - 3)
+        i = t.astype(int)
+
+        return i + np.arange(-1, 3).reshape((4,) + (1,)*i.ndim), bspline_weights(t - i, derivative)/self.delta**derivative
+
+    def _ev(self, tables, u, R, du=0, dR=0):
+        """
+        Tables (index or slice) interpolated at u and R, clamped to the grid, or their derivatives.
+        """
+        u, R = np.asarray(u), np.asarray(R)
+        (i_u, w_u), (i_R, w_R) = self._nodes(u, self.u, du), self._nodes(R, self.R, dR)
+        ndim = max(u.ndim, R.ndim)
+        i_u, w_u = [np.reshape(a, (4, 1) + (1,)*(ndim - u.ndim) + u.shape) for a in (i_u, w_u)]
+        i_R, w_R = [np.reshape(a, (4,) + (1,)*(ndim - R.ndim) + R.shape) for a in (i_R, w_R)]
+
+        return np.sum(w_u*w_R*self.coefs[tables][..., i_u, i_R], axis=(-ndim - 2, -ndim - 1))
+
+    def F_lumen(self, u, R, du=0, dR=0):
+        """
+        Emulated models.F_lumen(u, s_xy, l, R) or its derivatives.
+        """
+        return self._ev(self.lumen, u, R, du, dR)
+
+    def f_wall(self, u, R, a1, du=0, dR=0, da1=0):
+        """
+        Emulated models.f_wall(u, s_xy, l, R, a1) or its derivatives.
+        """
+        c, modes = wall_mode_weights(a1, self.n_modes)[da1], self._ev(self.wall, u, R, du, dR)
+
+        return np.sum(np.reshape(c, c.shape + (1,)*(modes.ndim - c.ndim))*modes, axis=0)
+
+    def F_plasma(self, u, R_lum, R_wall, du=0, dR_lum=0, dR_wall=0):
+        """
+        Emulated models.F_plasma(u, s_xy, l, R_lum, R_wall, s_gcx) or its (first) derivatives.
+        """
+        E = np.exp((R_lum - R_wall)/self.s_gcx)
+        if dR_lum:
+            return self.F_lumen(u, R_lum, dR=1) + self._ev(self.gcx, u, R_lum, dR=1) - E*self._ev(self.gcx, u, R_wall)/self.s_gcx
+        if dR_wall:
+            return E*(self._ev(self.gcx, u, R_wall)/self.s_gcx - self._ev(self.gcx, u, R_wall, dR=1))
+
+        return self.F_lumen(u, R_lum, du) + self._ev(self.gcx, u, R_lum, du) - E*self._ev(self.gcx, u, R_wall, du)
+
+    def L_plasma_no_glx(self, x, xc, R_lum, I, b):
+        """
+        Emulated models.L_plasma_no_glx(x, xc, s_xy, l, R_lum, I, b).
+        """
+        return (I - b)*self.F_lumen(x - xc, R_lum) + b
+
+    def L_plasma_no_glx_jac(self, x, xc, R_lum, I, b):
+        """
+        Derivatives of L_plasma_no_glx(...) with respect to xc, R_lum, I, and b.
+        """
+        F = self.F_lumen(x - xc, R_lum)
+
+        return np.array([-(I - b)*self.F_lumen(x - xc, R_lum, du=1),
+                         (I - b)*self.F_lumen(x - xc, R_lum, dR=1),
+                         F,
+                         1 - F])
+
+    def L_wall(self, x, xc, R_wall, a1, I, b_plasma, b_tissue):
+        """
+        Emulated models.L_wall(x, xc, s_xy, l, R_wall, a1, I, b_plasma, b_tissue).
+        """
+        return I*self.f_wall(x - xc, R_wall, a1) + (b_plasma - b_tissue)*self.F_lumen(x - xc, R_wall) + b_tissue
+
+    def L_wall_jac(self, x, xc, R_wall, a1, I, b_plasma, b_tissue):
+        """
+        Derivatives of L_wall(...) with respect to xc, R_wall, a1, I, b_plasma, and b_tissue.
+        """
+        u = x - xc
+        f, F = self.f_wall(u, R_wall, a1), self.F_lumen(u, R_wall)
+
+        return np.array([-I*self.f_wall(u, R_wall, a1, du=1) - (b_plasma - b_tissue)*self.F_lumen(u, R_wall, du=1),
+                         I*self.f_wall(u, R_wall, a1, dR=1) + (b_plasma - b_tissue)*self.F_lumen(u, R_wall, dR=1),
+                         I*self.f_wall(u, R_wall, a1, da1=1),
+                         f,
+                         F,
+                         1 - F])
+
+    def L_plasma(self, x, xc, R_lum, R_wall, I, b):
+        """
+        Emulated models.L_plasma(x, xc, s_xy, l, R_lum, R_wall, s_gcx, I, b).
+        """
+        return (I - b)*self.F_plasma(x - xc, R_lum, R_wall) + b
+
+    def L_plasma_jac(self, x, xc, R_lum, R_wall, I, b):
+        """
+        Derivatives of L_plasma(...) with respect to xc, R_lum, R_wall, I, and b.
+        """
+        F = self.F_plasma(x - xc, R_lum, R_wall)
+
+        return np.array([-(I - b)*self.F_plasma(x - xc, R_lum, R_wall, du=1),
+                         (I - b)*self.F_plasma(x - xc, R_lum, R_wall, dR_lum=1),
+                         (I - b)*self.F_plasma(x - xc, R_lum, R_wall, dR_wall=1),
+                         F,
+                         1 - F])
+
+    def model(self, name):
+        """
+        Emulated model 'name' ('L_plasma_no_glx', 'L_wall', or 'L_plasma'), for fitting with track_vessel.mle(...)
+        or track_vessel.track_kymogram(...).
+        """
+        return EmulatedModel(self, name)
+
+    def max_error(self, n_samples=64, a1_range=(-2, 2), seed=0):
+        """
+        Max absolute error of the emulated unit-intensity profiles (I=1, b=0) against the exact models,
+        for 'n_samples' random centers, radii in 'R_range', and a1 in 'a1_range'.
+        """
+        rng = np.random.default_rng(seed)
+        x = np.linspace(-self.R_range[1] - 4*self.s_xy, self.R_range[1] + 4*self.s_xy, 256)
+        xc = rng.uniform(-self.delta, self.delta, (n_samples, 1))
+        R_lum, R_wall = np.sort(rng.uniform(*self.R_range, (2, n_samples, 1)), axis=0)
+        a1 = rng.uniform(*a1_range, (n_samples, 1))
+        exact = dict(n_r=128, n_phi=64, rule='gauss-legendre')
+
+        errors = {'L_plasma_no_glx': self.L_plasma_no_glx(x, xc, R_lum, 1, 0) - models.L_plasma_no_glx(x, xc, self.s_xy, self.l, R_lum, 1, 0, n_r=128, rule='tanh-sinh'),
+                  'L_wall': self.L_wall(x, xc, R_wall, a1, 1, 0, 0) - models.L_wall(x, xc, self.s_xy, self.l, R_wall, a1, 1, 0, 0, **exact)}
+        if self.s_gcx is not None:
+            errors['L_plasma'] = self.L_plasma(x, xc, R_lum, R_wall, 1, 0) - models.L_plasma(x, xc, self.s_xy, self.l, R_lum, R_wall, self.s_gcx, 1, 0, **exact)
+
+        return {name: np.abs(error).max() for name, error in errors.items()}
+
+
+class EmulatedModel:
+    """
+    Emulated model of line-profiles, func(x, *params), with the derivatives with respect to its parameters,
+    func.jac(x, *params). It can be sent to worker processes.
+    """
+    def __init__(self, emulator, name):
+        self.emulator, self.name = emulator, name
+        self.__signature__ = inspect.signature(getattr(emulator, name))
+
+    def __call__(self, x, *p):
+        return getattr(self.emulator, self.name)(x, *p)
+
+    def jac(self, x, *p):
+        return getattr(self.emulator, self.name + '_jac')(x, *p)
@@ -0,0 +1,159 @@
+## Fisher information, Cramér-Rao bounds, and observed-information error bars of the fitted parameters
+
+import numpy as np
+from functools import lru_cache
+from scipy.special import gammaln, xlogy
+from . import pmt
+from .models import gaussian, jacobian
+
+
+@lru_cache(maxsize=16)
+def _information_table(alpha, sigma, delta_s, s_max, n_e):
+    """
+    log(e) and log(i(e)), the Fisher information about 'e' in one PMT output, on a grid of expected photon counts that fit in s_max.
+    The densities of PMT output given n detected photons, convolved with the Gaussian noise, are computed once for all 'e':
+    q(s, e) = sum_n Poisson(n, e)*h_n(s), and dq/de = sum_n (Poisson(n - 1, e) - Poisson(n, e))*h_n(s).
+    """
+    gain = pmt.gain(alpha)
+    e_max = (s_max - 8*sigma)/(gain + 8*np.sqrt(4/3*gain))
+    e = np.geomspace(1e-3, max(e_max, 2e-3), n_e)
+    s = np.arange(-8*sigma, s_max, delta_s)
+
+    table = pmt.f_table(alpha, delta_s, s_max)
+    n_max = table.n_max(e)
+    kernel = gaussian(s[:, np.newaxis] - table.s, sigma)
+    h = np.hstack([gaussian(s, sigma)[:, np.newaxis], (kernel*table.weights) @ table.g[:n_max].T])
+
+    n = np.arange(n_max + 1)[:, np.newaxis]
+    poisson = np.exp(xlogy(n, e) - e - gammaln(n + 1))
+    q0 = h @ poisson
+    dq_de = h @ (np.vstack([np.zeros(len(e)), poisson[:-1]]) - poisson)
+    info = np.sum(np.where(q0 > 0, dq_de**2/np.where(q0 > 0, q0, 1), 0), axis=0)*delta_s
+
+    return np.log(e), np.log(info)
+
+
+def _gaussian_information(e, alpha, sigma):
+    """
+    Fisher information about 'e' in one PMT output in the Gaussian approximation of its distribution, for many detected photons.
+    """
+    var = pmt.pmt_output_var(pmt.pmt_output(e, alpha), alpha, sigma)
+
+    return pmt.gain(alpha)**2/var + 0.5*(4*pmt.gain(alpha)/alpha/var)**2
+
+
+def photon_information(e, alpha, sigma, n_aver=None, delta_s=2, s_max=1024, n_e=64):
+    """
+    Expected Fisher information about the expected photon count 'e' (any shape) in a PMT output.
+    With n_aver=None, for the full PMT model, pmt.q(...) (as used for QDs and RBCs), tabulated once per calibration
+    on a grid of 'n_e' photon counts up to what fits in 's_max' (beyond it, the Gaussian approximation is used);
+    otherwise, for the average of 'n_aver' PMT outputs, pmt.nll_q_mean(...) (as used for vessels).
+    """
+    e = np.abs(np.asarray(e, dtype=float))
+    if n_aver is not None:
+        return pmt.fisher_q_mean(e, alpha, sigma, n_aver)
+
+    log_e, log_info = _information_table(float(abs(alpha)), float(abs(sigma)), delta_s, s_max, n_e)
+    log_e_clipped = np.log(np.clip(e, np.exp(log_e[0]), None))
+    info = np.exp(np.interp(log_e_clipped, log_e, log_info, left=np.nan, right=np.nan))
+
+    return np.where(e > np.exp(log_e[-1]), _gaussian_information(e, alpha, sigma), info)
+
+
+def _model_jac(func, coords, p, h=1e-6):
+    """
+    Expected photon counts, [fit, pixel], and their derivatives with respect to the parameters, [fit, parameter, pixel],
+    of 'func' at the parameters 'p' [fit, parameter], evaluated for all fits at once when 'func' broadcasts over them.
+    Uses the derivatives in models.JACOBIANS, or central differences for other models.
+    """
+    jac = jacobian(func)
+    if jac is None:
+        def jac(*args):
+            coords, p = args[:len(coords)], np.array(args[len(coords):], dtype=float)
+            dp = h*np.maximum(np.abs(p), 1)
+            return np.array([(func(*coords, *(p + dp_k*e_k)) - func(*coords, *(p - dp_k*e_k)))/(2*dp_k)
+                             for dp_k, e_k in zip(dp, np.eye(len(p)))])
+
+    n, n_par = p.shape
+    shape = np.shape(func(*coords, *p[0]))
+    batch = p.T.reshape((n_par, n) + (1,)*len(shape))
+
+    try:
+        e, J = np.asarray(func(*coords, *batch)), np.asarray(jac(*coords, *batch))
+        assert e.shape == (n,) + shape and J.shape == (n_par, n) + shape
+    except (AssertionError, ValueError):
+        # models that do not broadcast over a leading axis of parameters, e.g. L_wall_plasma
+        e = np.array([func(*coords, *p_k) for p_k in p])
+        J = np.moveaxis(np.array([np.broadcast_to(jac(*coords, *p_k), (n_par,) + shape) for p_k in p]), 0, 1)
+
+    return e.reshape(n, -1), np.moveaxis(J.reshape(n_par, n, -1), 0, 1)
+
+
+def fisher_information(func, coords, p, calibration, n_aver=None, mask=None, **kwargs):
+    """
+    Expected Fisher information matrices, [fit, parameter, parameter], of the parameters 'p' ([fit, parameter], or one set of parameters)
+    of a model 'func' of expected photon counts (e.g. models.qd_blurred, rbc, L_plasma) on the coordinates 'coords'
+    (a tuple, e.g. (X, Y) for QDs, or the x-coordinates of a line-profile), given the PMT 'calibration' (alpha, sigma, mu),
+    for the likelihood of pmt.q(...) or, with n_aver, of pmt.nll_q_mean(...); 'mask' selects the pixels that are fitted.
+    kwargs are passed to photon_information(...).
+    """
+    alpha, sigma = calibration[:2]
+    coords = coords if isinstance(coords, tuple) else (coords,)
+    p = np.atleast_2d(np.asarray(p, dtype=float))
+
+    e, J = _model_jac(func, coords, p)
+    info = photon_information(e, alpha, sigma, n_aver=None if n_aver is None else np.reshape(np.broadcast_to(n_aver, e.shape[1:]), -1), **kwargs)
+    if mask is not None:
+        info = info*np.reshape(mask, -1)
+
+    return np.einsum('nkp,np,nlp->nkl', J, info, J)
+
+
+def crb(information):
+    """
+    Cramér-Rao bounds (the smallest achievable STDs of unbiased estimates) of the parameters, [fit, parameter],
+    from Fisher information matrices, [fit, parameter, parameter].
+    """
+    return np.sqrt(np.diagonal(np.linalg.pinv(information, hermitian=True), axis1=-2, axis2=-1))
+
+
+def precision(func, coords, p, calibration, n_aver=None, **kwargs):
+    """
+    Cramér-Rao bounds of the parameters 'p' ([fit, parameter], or one set) of a model 'func' (see fisher_information(...)),
+    e.g. to predict before an experiment the precision of localization achievable with a photon budget.
+    """
+    return crb(fisher_information(func, coords, p, calibration, n_aver=n_aver, **kwargs))
+
+
+def observed_information(nll_grad, p, args=(), h=1e-5):
+    """
+    Observed Fisher information (Hessian of the negative log-likelihood), [parameter, parameter], at the fitted parameters 'p',
+    from central differences of the gradient; 'nll_grad'(p, *args) returns the negative log-likelihood and its gradient,
+    e.g. track_qd.neg_loglike_grad or track_rbc.neg_loglike_grad.
+    """
+    p = np.asarray(p, dtype=float)
+    dp = h*np.maximum(np.abs(p), 1)
+    H = np.array([(nll_grad(p + dp_k*e_k, *args)[1] - nll_grad(p - dp_k*e_k, *args)[1])/(2*dp_k) for dp_k, e_k in zip(dp, np.eye(len(p)))])
+
+    return 0.5*(H + H.T)
+
+
+def observed_errors(nll_grad, p, args, h=1e-5):
+    """
+    Error bars, [fit, parameter], from the observed information of many fits: 'p' [fit, parameter] and 'args' [fit] (e.g. the images and the calibration).
+    """
+    return crb(np.array([observed_information(nll_grad, p_k, args_k, h=h) for p_k, args_k in zip(p, args)]))
+
+
+def with_crb(records, func, coords, calibration, n_aver=None, **kwargs):
+    """
+    Fitting results (structured array of misc.fit_dtype(...), e.g. from track_qd.track_stack(...)) with the error bars ('<name>_err')
+    replaced by the Cramér-Rao bounds at the fitted parameters, instead of the BFGS approximation of the inverse Hessian.
+    """
+    names = [name for name in records.dtype.names if name + '_err' in records.dtype.names]
+    records = records.copy()
+    errors = precision(func, coords, np.transpose([records[name] for name in names]), calibration, n_aver=n_aver, **kwargs)
+    for name, err in zip(names, errors.T):
+        records[name + '_err'] = err
+
+    return records
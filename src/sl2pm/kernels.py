@@ -0,0 +1,295 @@
+## Optional compiled backend: fused loops for the hot integrands of the models (F_lumen, f_wall, F_gcx, qd_blurred),
+## the PMT densities (pmt.q, q_grad) and the likelihood of averaged PMT outputs (pmt.nll_q_mean, nll_q_mean_de),
+## compiled with Numba (nogil, so that fits can run in threads in parallel) when it is installed.
+## The kernels are plain Python loops over pixels and quadrature nodes that need no temporary arrays of (nodes x pixels);
+## without Numba, the models and pmt use their NumPy expressions instead.
+
+import math
+import os
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+BACKENDS = ('numpy', 'numba')
+
+# 'numba' if Numba is installed, unless the environment variable SL2PM_BACKEND=numpy
+BACKEND = 'numba' if numba is not None and os.environ.get('SL2PM_BACKEND', 'numba') != 'numpy' else 'numpy'
+
+
+def set_backend(backend):
+    """
+    Select the backend of the models and PMT densities: 'numba' (the compiled kernels, requires Numba) or 'numpy'.
+    """
+    global BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', use one of {list(BACKENDS)}")
+    if backend == 'numba' and numba is None:
+        raise ImportError("The 'numba' backend requires Numba: pip install sl2pm[jit]")
+    BACKEND = backend
+
+
+def applies(x, *params):
+    """
+    Whether the compiled kernels are used for the coordinates or PMT outputs 'x' (or the precision of a computation, a dtype)
+    and 'params': with the 'numba' backend, for scalar parameters in float64 (the NumPy expressions broadcast over arrays
+    of parameters and keep float32, see config.py).
+    """
+    dtype = np.dtype(x) if isinstance(x, (np.dtype, type)) else np.asarray(x).dtype
+    return BACKEND == 'numba' and all(np.ndim(p) == 0 for p in params) and np.result_type(dtype, np.float32) == np.float64
+
+
+def _jit(func):
+    return numba.njit(nogil=True, cache=True)(func) if numba is not None else func
+
+
+###-------------------------------------------------------------------
+###--------------------------Kernels----------------------------------
+
+SQRT_2PI = math.sqrt(2*math.pi)
+# the variance of the PMT output is clamped here, as in pmt._clamped_var(...)
+EPS = np.finfo(np.float64).eps
+MAX_FLOAT = np.finfo(np.float64).max
+
+
+def _erfcx(z):
+    """
+    Scaled complementary error function, exp(z**2)*erfc(z), as scipy.special.erfcx: its asymptotic series for large z.
+    """
+    if z < 10.0:
+        return math.exp(z*z)*math.erfc(z)
+
+    # asymptotic series, converged to double precision for z >= 10
+    inv_2z2, term, total = 1/(2*z*z), 1.0, 1.0
+    for k in range(1, 13):
+        term *= -(2*k - 1)*inv_2z2
+        total += term
+
+    return total/(z*math.sqrt(math.pi))
+
+
+_erfcx = _jit(_erfcx)
+
+
+def _f_lumen(x_psf, s_xy, l, R_lum, nodes, weights):
+    """
+    models.F_lumen(...) for 1D float64 'x_psf' and scalar parameters, with the quadrature 'nodes' and 'weights' on [-1, 1].
+    """
+    n = len(nodes)
+    r, decay = np.empty(n), np.empty(n)
+    for k in range(n):
+        r[k] = R_lum*nodes[k]
+        decay[k] = R_lum*weights[k]*(1 - math.exp(-math.sqrt(max(R_lum*R_lum - r[k]*r[k], 0.0))/l))
+
+    out = np.empty(len(x_psf))
+    for i in range(len(x_psf)):
+        total = 0.0
+        for k in range(n):
+            d = r[k] - x_psf[i]
+            total += decay[k]*math.exp(-d*d/(2*s_xy*s_xy))
+        out[i] = total/(SQRT_2PI*abs(s_xy))
+
+    return out
+
+
+def _f_wall(x_psf, s_xy, l, R_wall, a1, i0_a1, nodes, weights):
+    """
+    models.f_wall(...) for 1D float64 'x_psf' and scalar parameters; 'i0_a1' is np.i0(a1).
+    """
+    n = len(nodes)
+    c, amp = np.empty(n), np.empty(n)
+    for k in range(n):
+        phi = 0.5*math.pi*(nodes[k] + 1)
+        c[k] = R_wall*math.cos(phi)
+        amp[k] = (math.pi*weights[k]*R_wall*math.exp(a1*math.cos(phi))/i0_a1
+                  *math.exp(-abs(R_wall*math.sin(phi))/l)/(2*l)/(SQRT_2PI*abs(s_xy)))
+
+    out = np.empty(len(x_psf))
+    for i in range(len(x_psf)):
+        total = 0.0
+        for k in range(n):
+            d = c[k] - x_psf[i]
+            total += amp[k]*math.exp(-d*d/(2*s_xy*s_xy))
+        out[i] = total
+
+    return out
+
+
+def _f_gcx(x_psf, s_xy, l, R_lum, R_wall, s_gcx, nodes, weights):
+    """
+    models.F_gcx(...) for 1D float64 'x_psf' and scalar parameters.
+    """
+    out = np.empty(len(x_psf))
+    sqrt_pi = math.sqrt(math.pi)
+    for i in range(len(x_psf)):
+        x = x_psf[i]
+        total = 0.0
+        for k in range(len(nodes)):
+            phi = 0.5*math.pi*(nodes[k] + 1)
+            a = math.sqrt(math.cos(phi)**2/s_xy**2/2)
+            b = (x*math.cos(phi)/s_xy**2 - abs(math.sin(phi))/l - 1/s_gcx)/2/a
+            base = -x*x/s_xy**2/2 + R_lum/s_gcx
+            e1 = math.exp(-a*a*R_lum*R_lum + 2*b*a*R_lum + base)*(1 + sqrt_pi*b*_erfcx(a*R_lum - b))/2/a**2
+            e2 = math.exp(-a*a*R_wall*R_wall + 2*b*a*R_wall + base)*(1 + sqrt_pi*b*_erfcx(a*R_wall - b))/2/a**2
+            total += 0.5*math.pi*weights[k]*(e1 - e2)
+        out[i] = total/math.sqrt(2*math.pi*s_xy**2)/l
+
+    return out
+
+
+def _qd_blurred(x, y, b, A, xo, yo, sx, sy, theta):
+    """
+    models.qd_blurred(...) for 1D float64 coordinates 'x', 'y' and scalar parameters.
+    """
+    b, A, sx, sy = abs(b), abs(A), abs(sx), abs(sy)
+    Q11 = math.cos(theta)**2/sx**2 + math.sin(theta)**2/sy**2
+    Q22 = math.sin(theta)**2/sx**2 + math.cos(theta)**2/sy**2
+    Q12 = 0.5*(math.sin(2*theta)/sx**2 - math.sin(2*theta)/sy**2)
+    amp = 0.5*A*math.sqrt(Q11*Q22 - Q12**2)/math.pi
+
+    out = np.empty(len(x))
+    for i in range(len(x)):
+        dx, dy = x[i] - xo, y[i] - yo
+        out[i] = b + amp*math.exp(-0.5*(Q11*dx*dx + 2*Q12*dx*dy + Q22*dy*dy))
+
+    return out
+
+
+def _q(ds, e, sigma, s, weights, g, n_max, grad):
+    """
+    pmt.q(...) for flat float64 PMT outputs relative to mu, 'ds', and expected photon counts 'e' (>= 0), given the grid of PMT outputs 's',
+    its trapezoidal 'weights' and the Gamma densities 'g' [n - 1, s] of FTable, summed over n = 1, ..., n_max detected photons;
+    with 'grad', also q1 (the sum with the Poisson probabilities shifted by one photon, up to n_max + 1), so that dq/de = q1 - q.
+    """
+    n_s = len(s)
+    f0, f1 = np.empty(n_s), np.empty(n_s)
+    q0, q1 = np.empty(len(ds)), np.empty(len(ds) if grad else 0)
+    for i in range(len(ds)):
+        f0[:] = 0.0
+        f1[:] = 0.0
+        log_e = math.log(e[i]) if e[i] > 0 else 0.0
+        for n in range(1, n_max + 2 if grad else n_max + 1):
+            # Poisson probabilities of n and n - 1 detected photons
+            p_n = math.exp(n*log_e - e[i] - math.lgamma(n + 1)) if e[i] > 0 else 0.0
+            p_prev = math.exp((n - 1)*log_e - e[i] - math.lgamma(n)) if e[i] > 0 else float(n == 1)
+            for j in range(n_s):
+                if n <= n_max:
+                    f0[j] += g[n - 1, j]*p_n
+                if grad:
+                    f1[j] += g[n - 1, j]*p_prev
+
+        total0, total1 = 0.0, 0.0
+        for j in range(n_s):
+            d = ds[i] - s[j]
+            kernel = weights[j]*math.exp(-d*d/(2*sigma*sigma))/(SQRT_2PI*sigma)
+            total0 += kernel*f0[j]
+            total1 += kernel*f1[j]
+        q0[i] = math.exp(-e[i])*math.exp(-ds[i]*ds[i]/(2*sigma*sigma))/(SQRT_2PI*sigma) + total0
+        if grad:
+            q1[i] = total1
+
+    return q0, q1
+
+
+def _nll_q_mean(s, e, a, sigma, n_aver):
+    """
+    pmt.nll_q_mean(...) for flat float64 PMT outputs 's' and expected photon counts 'e', and 'n_aver' of the same size or of size 1.
+    Masked pixels, with no PMT outputs averaged (n_aver = 0, e.g. from preprocess.profiles(...)) or a NaN output, do not contribute.
+    """
+    total = 0.0
+    for i in range(len(s)):
+        n = n_aver[i] if len(n_aver) > 1 else n_aver[0]
+        if n == 0 or math.isnan(s[i]):
+            continue
+        var = max(4*e[i]/a + sigma*sigma, EPS)
+        term = math.log(2*math.pi*var/n) + n*(s[i] - 3*e[i]/a)**2/var
+        if not math.isnan(term):
+            total += term
+
+    return 0.5*total
+
+
+def _nll_q_mean_de(s, e, a, sigma, n_aver):
+    """
+    pmt.nll_q_mean_de(...) for flat float64 arrays, as in _nll_q_mean(...).
+    """
+    out = np.empty(len(s))
+    for i in range(len(s)):
+        n = n_aver[i] if len(n_aver) > 1 else n_aver[0]
+        if n == 0 or math.isnan(s[i]):
+            out[i] = 0.0
+            continue
+        var = 4*e[i]/a + sigma*sigma
+        dvar_de = 4/a if var > EPS else 0.0
+        var = max(var, EPS)
+        ds = s[i] - 3*e[i]/a
+        de = 0.5*dvar_de/var - n*ds*(3/a)/var - 0.5*n*ds*ds*dvar_de/var**2
+        # as np.nan_to_num(...)
+        out[i] = 0.0 if math.isnan(de) else max(min(de, MAX_FLOAT), -MAX_FLOAT)
+
+    return out
+
+
+f_lumen_kernel, f_wall_kernel, f_gcx_kernel, qd_blurred_kernel = [_jit(func) for func in (_f_lumen, _f_wall, _f_gcx, _qd_blurred)]
+q_kernel, nll_q_mean_kernel, nll_q_mean_de_kernel = [_jit(func) for func in (_q, _nll_q_mean, _nll_q_mean_de)]
+
+
+###-------------------------------------------------------------------
+###-------------------------Wrappers----------------------------------
+
+def _flat(x):
+    x = np.asarray(x, dtype=np.float64)
+    return np.ascontiguousarray(x).ravel(), x.shape
+
+
+def f_lumen(x_psf, s_xy, l, R_lum, quadrature):
+    x, shape = _flat(x_psf)
+    return f_lumen_kernel(x, float(s_xy), float(l), float(R_lum), quadrature.nodes, quadrature.weights).reshape(shape)
+
+
+def f_wall(x_psf, s_xy, l, R_wall, a1, quadrature):
+    x, shape = _flat(x_psf)
+    return f_wall_kernel(x, float(s_xy), float(l), float(R_wall), float(a1), float(np.i0(a1)), quadrature.nodes, quadrature.weights).reshape(shape)
+
+
+def f_gcx(x_psf, s_xy, l, R_lum, R_wall, s_gcx, quadrature):
+    x, shape = _flat(x_psf)
+    return f_gcx_kernel(x, float(s_xy), float(l), float(R_lum), float(R_wall), float(s_gcx), quadrature.nodes, quadrature.weights).reshape(shape)
+
+
+def qd_blurred(x, y, *p):
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    return qd_blurred_kernel(np.ascontiguousarray(x).ravel(), np.ascontiguousarray(y).ravel(), *[float(v) for v in p]).reshape(x.shape)
+
+
+def q(ds, e, sigma, table, grad=False):
+    """
+    q0 and, with 'grad', q1 of pmt.q_grad(...) for flat PMT outputs relative to mu, 'ds', and expected photon counts 'e', given the FTable 'table'.
+    """
+    n_max = table.n_max(e)
+    if n_max + 1 > len(table.g):
+        table._extend(n_max + 1)
+
+    return q_kernel(np.ascontiguousarray(ds, dtype=np.float64), np.ascontiguousarray(e, dtype=np.float64), float(sigma),
+                    table.s.astype(np.float64), table.weights, table.g, n_max, grad)
+
+
+def _likelihood_args(s, e, n_aver):
+    s, e = np.asarray(s, dtype=np.float64), np.asarray(e, dtype=np.float64)
+    n_aver = np.asarray(n_aver, dtype=np.float64)
+    n_aver = np.ascontiguousarray(np.broadcast_to(n_aver, s.shape)).ravel() if n_aver.ndim else n_aver.reshape(1)
+
+    return np.ascontiguousarray(s).ravel(), np.ascontiguousarray(e).ravel(), n_aver
+
+
+def nll_q_mean(s, e, a, sigma, n_aver):
+    s_flat, e_flat, n_flat = _likelihood_args(s, e, n_aver)
+    return nll_q_mean_kernel(s_flat, e_flat, float(a), float(sigma), n_flat)
+
+
+def nll_q_mean_de(s, e, a, sigma, n_aver):
+    s_flat, e_flat, n_flat = _likelihood_args(s, e, n_aver)
+    return nll_q_mean_de_kernel(s_flat, e_flat, float(a), float(sigma), n_flat).reshape(np.shape(s))
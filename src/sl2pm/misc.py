@@ -1,8 +1,77 @@
+import time
 import numpy as np
+from . import profiling
 
 
 def fitted_params(opt_result, p_names):
     """ 
     Parse fitted parameters and their error bars from optimization result (fit).
+    The inverse Hessian, opt_result.hess_inv, can be a dense or a sparse matrix.
     """
-    return {name: (val, std) for name, val, std in zip(p_names, opt_result.x, np.sqrt(np.diag(opt_result.hess_inv)))}
\ No newline at end of file
+    return {name: (val, std) for name, val, std in zip(p_names, opt_result.x, np.sqrt(opt_result.hess_inv.diagonal()))}
+
+
+def fit_dtype(p_names):
+    """ 
+    Structured dtype of fitting results: fitted parameters, their error bars ('<name>_err'), 
+    the negative log-likelihood ('nll'), the convergence flag ('success'), and the number of iterations ('nit').
+    """
+    return np.dtype([(name, float) for name in p_names] + [(name + '_err', float) for name in p_names] + 
+                    [('nll', float), ('success', bool), ('nit', int)])
+
+
+def fit_record(opt_result):
+    """ 
+    Fitting result as a record of fit_dtype(...).
+    """
+    return (*opt_result.x, *np.sqrt(opt_result.hess_inv.diagonal()), opt_result.fun, opt_result.success, opt_result.nit)
+
+
+def positive_definite(H, rtol=1e-3):
+    """ 
+    Symmetric positive-definite matrix closest to H, with eigenvalues clipped at 'rtol' of the largest one.
+    """
+    w, v = np.linalg.eigh(0.5*(H + H.T))
+    H = (v*np.maximum(w, rtol*w.max())) @ v.T
+    
+    return np.triu(H) + np.triu(H, 1).T
+
+
+def minimize_bfgs(fun, p0, args=(), jac=True, dtype=np.float64, options=None, callback=None, stall=1e-4, model=None):
+    """
+    Minimize fun(p, *args, dtype) (returning also its gradient if 'jac') with BFGS, evaluating it in the precision 'dtype'.
+    Rounding errors of float32 make line searches fail near the minimum, so in float32 the iterations stop at 10 times
+    the gradient tolerance ('gtol' in 'options'), or once an iteration decreases fun by less than 'stall' (relative),
+    then continue in float64 from their solution and inverse Hessian, usually for 1-2 iterations; nit, nfev and njev count both.
+    When profiling (see profiling.py), the fit is recorded with the name of the 'model'.
+    """
+    start = time.perf_counter()
+    res = _minimize_bfgs(fun, p0, args=args, jac=jac, dtype=dtype, options=options, callback=callback, stall=stall)
+    profiling.record_fit(fun, model, res, time.perf_counter() - start)
+
+    return res
+
+
+def _minimize_bfgs(fun, p0, args=(), jac=True, dtype=np.float64, options=None, callback=None, stall=1e-4):
+    from scipy.optimize import minimize
+
+    options = dict(options or {})
+    if np.dtype(dtype) == np.float64:
+        return minimize(fun, p0, args=(*args, dtype), jac=jac, method='bfgs', callback=callback, options=options)
+
+    last = [np.inf]
+    def stop(intermediate_result):
+        if callback is not None:
+            callback(intermediate_result.x)
+        if last[0] - intermediate_result.fun < stall*abs(intermediate_result.fun):
+            raise StopIteration
+        last[0] = intermediate_result.fun
+
+    coarse = minimize(fun, p0, args=(*args, dtype), jac=jac, method='bfgs', callback=stop,
+                      options={**options, 'gtol': 10*options.get('gtol', 1e-5)})
+    res = minimize(fun, coarse.x, args=(*args, np.float64), jac=jac, method='bfgs', callback=callback,
+                   options={**options, 'hess_inv0': positive_definite(coarse.hess_inv)})
+    for name in ['nit', 'nfev', 'njev']:
+        res[name] = res.get(name, 0) + coarse.get(name, 0)
+
+    return res
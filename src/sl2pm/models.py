@@ -2,7 +2,15 @@
 ## needed for tracking QDs, RBCs, and blood vessels 
 
 import numpy as np
-from scipy.special import erf, erfcx
+from functools import partial
+from scipy.special import erf, erfcx, i0e, i1e
+from . import kernels
+from .quadrature import quadrature
+
+# Default quadratures of the integrals over phi and r in the models of vessels' line-profiles (see benchmarks/bench_quadrature.py):
+# Gauss-Legendre, with relative errors below ~5e-4 for s_xy >= 0.5, l >= 0.3, and radii up to 30 pixels 
+# (below 1e-5 for typical s_xy ~ 1.5, l ~ 4, R ~ 10), where the trapezoidal rule with 256 nodes errs by up to ~0.1
+RULE, N_PHI, N_R = 'gauss-legendre', 64, 128
 
 ###-------------------------------------------------------------------
 ###------------------------Quantum dots-------------------------------
@@ -11,6 +19,9 @@ def qd_blurred(x, y, b, A, xo, yo, sx, sy, theta):
     2D rotationally-asymmetric Gaussian.
     This function is fitted to images of nanoparticles with MLE to estimate the nanoparticle's positions. 
     """
+    if kernels.applies(x, b, A, xo, yo, sx, sy, theta):
+        return kernels.qd_blurred(x, y, b, A, xo, yo, sx, sy, theta)
+
     b, A, sx, sy = np.abs(b), np.abs(A), np.abs(sx), np.abs(sy)
     
     dx, dy = x - xo, y - yo
@@ -27,6 +38,29 @@ def qd_blurred(x, y, b, A, xo, yo, sx, sy, theta):
     
     return expr
 
+
+def qd_blurred_jac(x, y, b, A, xo, yo, sx, sy, theta):
+    """ 
+    Derivatives of qd_blurred(...) with respect to its parameters (b, A, xo, yo, sx, sy, theta).
+    """
+    sign_b, sign_A, sign_sx, sign_sy = np.sign(b), np.sign(A), np.sign(sx), np.sign(sy)
+    b, A, sx, sy = np.abs(b), np.abs(A), np.abs(sx), np.abs(sy)
+    
+    dx, dy = x - xo, y - yo
+    
+    u = np.cos(theta)*dx + np.sin(theta)*dy
+    v = -np.sin(theta)*dx + np.cos(theta)*dy
+    
+    peak = np.exp(-0.5*(u**2/sx**2 + v**2/sy**2))/(2*np.pi*sx*sy)
+    
+    return np.array([sign_b*np.ones_like(peak), 
+                     sign_A*peak, 
+                     A*peak*(np.cos(theta)*u/sx**2 - np.sin(theta)*v/sy**2), 
+                     A*peak*(np.sin(theta)*u/sx**2 + np.cos(theta)*v/sy**2), 
+                     sign_sx*A*peak*(u**2/sx**3 - 1/sx), 
+                     sign_sy*A*peak*(v**2/sy**3 - 1/sy), 
+                     -A*peak*u*v*(1/sx**2 - 1/sy**2)])
+
 ###-------------------------------------------------------------------
 ###---------------------------RBCs------------------------------------
 def rbc(x, b, A, s, xo):
@@ -41,6 +75,26 @@ def rbc_inv(x, b, A, s, xo):
     """
     return b + 0.5*A*(1 - erf((x - xo)/(np.sqrt(2)*s)))
 
+
+def rbc_jac(x, b, A, s, xo):
+    """ 
+    Derivatives of rbc(...) with respect to its parameters (b, A, s, xo).
+    """
+    z = (x - xo)/(np.sqrt(2)*s)
+    edge = A*np.exp(-z**2)/np.sqrt(2*np.pi)/s
+    
+    return np.array([np.ones_like(z), 0.5*(1 + erf(z)), -np.sqrt(2)*z*edge, -edge])
+
+
+def rbc_inv_jac(x, b, A, s, xo):
+    """ 
+    Derivatives of rbc_inv(...) with respect to its parameters (b, A, s, xo).
+    """
+    z = (x - xo)/(np.sqrt(2)*s)
+    edge = A*np.exp(-z**2)/np.sqrt(2*np.pi)/s
+    
+    return np.array([np.ones_like(z), 0.5*(1 - erf(z)), np.sqrt(2)*z*edge, edge])
+
 ###-------------------------------------------------------------------
 ###-----------------------Blood vessels-------------------------------
 def gaussian(x, sigma):
@@ -57,113 +111,359 @@ def laplace(x, l):
     return np.exp(-np.abs(x)/l)/(2*l)
 
 
-def f_wall(x_psf, s_xy, l, R_wall, a1, n_phi=256):
+def f_wall(x_psf, s_xy, l, R_wall, a1, n_phi=N_PHI, rule=RULE):
     """
     Part of the expression for L_wall and L_wall_plasma.
+    The integrand is even in phi, so the integral over phi is computed on [0, pi], 
+    where it is smooth, with an n_phi-point quadrature 'rule' (see quadrature.py).
     """
-    phi = np.linspace(-np.pi, np.pi, n_phi)
-    X_PSF, PHI = np.meshgrid(x_psf, phi)
+    if kernels.applies(x_psf, s_xy, l, R_wall, a1):
+        return kernels.f_wall(x_psf, s_xy, l, R_wall, a1, quadrature(n_phi, rule))
+
+    phi, w = quadrature(n_phi, rule).on(0, np.pi, x_psf, s_xy, l, R_wall, a1)
     
-    rho = np.exp(a1*np.cos(PHI))/np.i0(a1)
-    integrand = R_wall*rho*gaussian(R_wall*np.cos(PHI) - X_PSF, s_xy)*laplace(R_wall*np.sin(PHI), l)
+    rho = np.exp(a1*np.cos(phi))/np.i0(a1)
+    integrand = R_wall*rho*gaussian(R_wall*np.cos(phi) - x_psf, s_xy)*laplace(R_wall*np.sin(phi), l)
 
-    return np.trapz(integrand, x=phi, axis=0)
+    return 2*np.sum(w*integrand, axis=0)
+
+
+def f_wall_jac(x_psf, s_xy, l, R_wall, a1, n_phi=N_PHI, rule=RULE):
+    """
+    Derivatives of f_wall(...) with respect to x_psf, s_xy, l, R_wall, and a1.
+    """
+    phi, w = quadrature(n_phi, rule).on(0, np.pi, x_psf, s_xy, l, R_wall, a1)
+    
+    d = R_wall*np.cos(phi) - x_psf
+    base = np.exp(a1*np.cos(phi))/np.i0(a1)*gaussian(d, s_xy)*laplace(R_wall*np.sin(phi), l)
+    integrand = R_wall*base
+    
+    return 2*np.sum(w*np.array([integrand*d/s_xy**2, 
+                                integrand*(d**2/s_xy**3 - 1/s_xy), 
+                                integrand*(np.abs(R_wall*np.sin(phi))/l**2 - 1/l), 
+                                base*(1 - R_wall*np.cos(phi)*d/s_xy**2 - np.abs(R_wall*np.sin(phi))/l), 
+                                integrand*(np.cos(phi) - i1e(a1)/i0e(a1))]), axis=1)
 
 
-def F_lumen(x_psf, s_xy, l, R_lum, n_r=256):
+def F_lumen(x_psf, s_xy, l, R_lum, n_r=N_R, rule=RULE):
     """
     Part of the expression for L_plasma_no_glx.
+    The integral over r is computed with an n_r-point quadrature 'rule' (see quadrature.py).
     """
-    r = np.linspace(-R_lum, R_lum, n_r)
-    X_PSF, R = np.meshgrid(x_psf, r)
+    if kernels.applies(x_psf, s_xy, l, R_lum):
+        return kernels.f_lumen(x_psf, s_xy, l, R_lum, quadrature(n_r, rule))
+
+    r, w = quadrature(n_r, rule).on(-R_lum, R_lum, x_psf, s_xy, l)
 
-    integrand = gaussian(R - X_PSF, s_xy)*(1 - np.exp(-np.sqrt(R_lum**2 - R**2)/l))
+    integrand = gaussian(r - x_psf, s_xy)*(1 - np.exp(-np.sqrt(np.maximum(R_lum**2 - r**2, 0))/l))
 
-    return np.trapz(integrand, x=r, axis=0)
+    return np.sum(w*integrand, axis=0)
 
 
-def F_gcx(x_psf, s_xy, l, R_lum, R_wall, s_gcx, n_phi=256):
+def F_lumen_jac(x_psf, s_xy, l, R_lum, n_r=N_R, rule=RULE):
+    """
+    Derivatives of F_lumen(...) with respect to x_psf, s_xy, l, and R_lum.
+    Uses the substitution r = R_lum*u, which integrates over the same nodes as F_lumen(...).
+    """
+    u, w = quadrature(n_r, rule).on(-1, 1, x_psf, s_xy, l, R_lum)
+    c = np.sqrt(np.maximum(1 - u**2, 0))
+    
+    d = R_lum*u - x_psf
+    g = gaussian(d, s_xy)
+    decay = np.exp(-R_lum*c/l)
+    integrand = R_lum*g*(1 - decay)
+
+    return np.sum(w*np.array([integrand*d/s_xy**2, 
+                              integrand*(d**2/s_xy**3 - 1/s_xy), 
+                              -R_lum**2*c*g*decay/l**2, 
+                              g*(1 - decay)*(1 - R_lum*u*d/s_xy**2) + R_lum*c*g*decay/l]), axis=1)
+
+
+def F_gcx(x_psf, s_xy, l, R_lum, R_wall, s_gcx, n_phi=N_PHI, rule=RULE):
     """
     Part of the expression for F_plasma.
+    The integral over phi is computed with an n_phi-point quadrature 'rule' (see quadrature.py); 
+    the integrand is singular at phi = pi/2, which must not be a node (use an even n_phi).
+    """
+    if kernels.applies(x_psf, s_xy, l, R_lum, R_wall, s_gcx):
+        return kernels.f_gcx(x_psf, s_xy, l, R_lum, R_wall, s_gcx, quadrature(n_phi, rule))
+
+    phi, w = quadrature(n_phi, rule).on(0, np.pi, x_psf, s_xy, l, R_lum, R_wall, s_gcx)
+    
+    a = np.sqrt(np.cos(phi)**2/s_xy**2/2)
+    b = (x_psf*np.cos(phi)/s_xy**2 - np.abs(np.sin(phi))/l - 1/s_gcx)/2/a
+    
+    e1 = np.exp(-a**2*R_lum**2 + 2*b*a*R_lum - x_psf**2/s_xy**2/2 + R_lum/s_gcx)*(1 + np.sqrt(np.pi)*b*erfcx(a*R_lum - b))/2/a**2
+    e2 = np.exp(-a**2*R_wall**2 + 2*b*a*R_wall - x_psf**2/s_xy**2/2 + R_lum/s_gcx)*(1 + np.sqrt(np.pi)*b*erfcx(a*R_wall - b))/2/a**2
+
+    return np.sum(w*(e1 - e2), axis=0)/np.sqrt(2*np.pi*s_xy**2)/l
+
+
+def F_gcx_jac(x_psf, s_xy, l, R_lum, R_wall, s_gcx, n_phi=N_PHI, rule=RULE, n_r=16):
     """
-    phi = np.linspace(0, np.pi, n_phi)
-    X, PHI = np.meshgrid(x_psf, phi)
+    Derivatives of F_gcx(...) with respect to x_psf, s_xy, l, R_lum, R_wall, and s_gcx.
+    F_gcx(...) is the integral of r*exp(E(r, phi)) over the glycocalyx, R_lum < r < R_wall, 0 < phi < pi;
+    the radial integrals of the derivatives are computed with n_r-point Gauss-Legendre quadrature.
+    """
+    phi, w_phi = quadrature(n_phi, rule).on(0, np.pi, x_psf, s_xy, l, R_lum, R_wall, s_gcx)
+    r, w_r = quadrature(n_r, 'gauss-legendre').on(R_lum, R_wall, phi)
+    phi, w_phi = phi[np.newaxis], w_phi[np.newaxis]
+    
+    norm = 1/np.sqrt(2*np.pi*s_xy**2)/l
+    
+    def r_exp(r):
+        return r*np.exp(-(r*np.cos(phi) - x_psf)**2/s_xy**2/2 - r*np.abs(np.sin(phi))/l - (r - R_lum)/s_gcx)*norm
     
-    a = np.sqrt(np.cos(PHI)**2/s_xy**2/2)
-    b = (X*np.cos(PHI)/s_xy**2 - np.abs(np.sin(PHI))/l - 1/s_gcx)/2/a
+    d = r*np.cos(phi) - x_psf
+    integrand = r_exp(r)
     
-    e1 = np.exp(-a**2*R_lum**2 + 2*b*a*R_lum - X**2/s_xy**2/2 + R_lum/s_gcx)*(1 + np.sqrt(np.pi)*b*erfcx(a*R_lum - b))/2/a**2
-    e2 = np.exp(-a**2*R_wall**2 + 2*b*a*R_wall - X**2/s_xy**2/2 + R_lum/s_gcx)*(1 + np.sqrt(np.pi)*b*erfcx(a*R_wall - b))/2/a**2
+    def integral(values):
+        return np.sum(w_phi*values, axis=(0, 1))
 
-    return np.trapz(e1 - e2, dx=phi[1]-phi[0], axis=0)/np.sqrt(2*np.pi*s_xy**2)/l
+    return np.array([integral(w_r*integrand*d/s_xy**2), 
+                     integral(w_r*integrand*(d**2/s_xy**3 - 1/s_xy)), 
+                     integral(w_r*integrand*(r*np.abs(np.sin(phi))/l**2 - 1/l)), 
+                     integral(w_r*integrand/s_gcx) - integral(r_exp(R_lum)), 
+                     integral(r_exp(R_wall)), 
+                     integral(w_r*integrand*(r - R_lum)/s_gcx**2)])
 
 
-def F_plasma(x_psf, s_xy, l, R_lum, R_wall, s_gcx, n_phi=256, n_r=256):
+def F_plasma(x_psf, s_xy, l, R_lum, R_wall, s_gcx, n_phi=N_PHI, n_r=N_R, rule=RULE):
     """
     Part of the expression for L_plasma and L_wall_plasma.
     """
-    return F_lumen(x_psf, s_xy, l, R_lum, n_r=n_r) + F_gcx(x_psf, s_xy, l, R_lum, R_wall, s_gcx, n_phi=n_phi)
+    return F_lumen(x_psf, s_xy, l, R_lum, n_r=n_r, rule=rule) + F_gcx(x_psf, s_xy, l, R_lum, R_wall, s_gcx, n_phi=n_phi, rule=rule)
 
 
-def L_plasma(x, xc, s_xy, l, R_lum, R_wall, s_gcx, I, b, n_phi=256, n_r=256):
+def L_plasma(x, xc, s_xy, l, R_lum, R_wall, s_gcx, I, b, n_phi=N_PHI, n_r=N_R, rule=RULE):
     """ 
     Full expression (with glycocalyx) for plasma line-scans of fluorescence.
     This function is fitted to line-profiles of plasma-fluorescence with MLE to track capillary walls (Protocol A).
     """
-    return (I - b)*F_plasma(x - xc, s_xy, l, R_lum, R_wall, s_gcx, n_phi=n_phi, n_r=n_r) + b
+    return (I - b)*F_plasma(x - xc, s_xy, l, R_lum, R_wall, s_gcx, n_phi=n_phi, n_r=n_r, rule=rule) + b
 
 
-def L_plasma_no_glx(x, xc, s_xy, l, R_lum, I, b, n_r=256):
+def L_plasma_no_glx(x, xc, s_xy, l, R_lum, I, b, n_r=N_R, rule=RULE):
     """ 
     Simplified (no glycocalyx) expression for plasma line-scans of fluorescence.
     This function is fitted to line-profiles of plasma-fluorescence with MLE to track capillary walls (Protocol B).
     """
-    return (I - b)*F_lumen(x - xc, s_xy, l, R_lum, n_r=n_r) + b
+    return (I - b)*F_lumen(x - xc, s_xy, l, R_lum, n_r=n_r, rule=rule) + b
 
 
-def L_wall(x, xc, s_xy, l, R_wall, a1, I, b_plasma, b_tissue, n_r=256, n_phi=256):
+def L_wall(x, xc, s_xy, l, R_wall, a1, I, b_plasma, b_tissue, n_r=N_R, n_phi=N_PHI, rule=RULE):
     """ 
     Expression for plasma wall-scans of fluorescence.
     This function is fitted to line-profiles of wall-fluorescence with MLE to track capillary walls (Protocol C).
     """
-    return I*f_wall(x - xc, s_xy, l, R_wall, a1, n_phi=n_phi) + (b_plasma - b_tissue)*F_lumen(x - xc, s_xy, l, R_wall, n_r=n_r) + b_tissue
+    return I*f_wall(x - xc, s_xy, l, R_wall, a1, n_phi=n_phi, rule=rule) + (b_plasma - b_tissue)*F_lumen(x - xc, s_xy, l, R_wall, n_r=n_r, rule=rule) + b_tissue
 
 
-def L_wall_plasma(x, xc, s_xy, l, R_lum, R_wall, s_gcx, a1, Iw, Ip, b_plasma, b_tissue_wall, b_tissue_plasma, n_r=256, n_phi=256):
+def L_wall_plasma(x, xc, s_xy, l, R_lum, R_wall, s_gcx, a1, Iw, Ip, b_plasma, b_tissue_wall, b_tissue_plasma, n_r=N_R, n_phi=N_PHI, rule=RULE):
     """ 
     Expressions for wall and plasma wall-scans of fluorescence.
     This function is fitted to line-profiles of wall- and plasma-fluorescence with MLE to track capillary walls (Protocol A).
     """
-    return np.array([L_wall(x, xc, s_xy, l, R_wall, a1, Iw, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi),
-                     L_plasma(x, xc, s_xy, l, R_lum, R_wall, s_gcx, Ip, b_tissue_plasma, n_r=n_r, n_phi=n_phi)]) 
+    return np.array([L_wall(x, xc, s_xy, l, R_wall, a1, Iw, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi, rule=rule),
+                     L_plasma(x, xc, s_xy, l, R_lum, R_wall, s_gcx, Ip, b_tissue_plasma, n_r=n_r, n_phi=n_phi, rule=rule)]) 
+
+
+def L_plasma_jac(x, xc, s_xy, l, R_lum, R_wall, s_gcx, I, b, n_phi=N_PHI, n_r=N_R, rule=RULE):
+    """ 
+    Derivatives of L_plasma(...) with respect to its parameters (xc, s_xy, l, R_lum, R_wall, s_gcx, I, b).
+    """
+    F = F_plasma(x - xc, s_xy, l, R_lum, R_wall, s_gcx, n_phi=n_phi, n_r=n_r, rule=rule)
+    dF_lumen = F_lumen_jac(x - xc, s_xy, l, R_lum, n_r=n_r, rule=rule)
+    dF_gcx = F_gcx_jac(x - xc, s_xy, l, R_lum, R_wall, s_gcx, n_phi=n_phi, rule=rule)
+    
+    return np.array([-(I - b)*(dF_lumen[0] + dF_gcx[0]), 
+                     (I - b)*(dF_lumen[1] + dF_gcx[1]), 
+                     (I - b)*(dF_lumen[2] + dF_gcx[2]), 
+                     (I - b)*(dF_lumen[3] + dF_gcx[3]), 
+                     (I - b)*dF_gcx[4], 
+                     (I - b)*dF_gcx[5], 
+                     F, 
+                     1 - F])
+
+
+def L_plasma_no_glx_jac(x, xc, s_xy, l, R_lum, I, b, n_r=N_R, rule=RULE):
+    """ 
+    Derivatives of L_plasma_no_glx(...) with respect to its parameters (xc, s_xy, l, R_lum, I, b).
+    """
+    F = F_lumen(x - xc, s_xy, l, R_lum, n_r=n_r, rule=rule)
+    dF = F_lumen_jac(x - xc, s_xy, l, R_lum, n_r=n_r, rule=rule)
+    
+    return np.array([-(I - b)*dF[0], (I - b)*dF[1], (I - b)*dF[2], (I - b)*dF[3], F, 1 - F])
+
+
+def L_wall_jac(x, xc, s_xy, l, R_wall, a1, I, b_plasma, b_tissue, n_r=N_R, n_phi=N_PHI, rule=RULE):
+    """ 
+    Derivatives of L_wall(...) with respect to its parameters (xc, s_xy, l, R_wall, a1, I, b_plasma, b_tissue).
+    """
+    f = f_wall(x - xc, s_xy, l, R_wall, a1, n_phi=n_phi, rule=rule)
+    df = f_wall_jac(x - xc, s_xy, l, R_wall, a1, n_phi=n_phi, rule=rule)
+    F = F_lumen(x - xc, s_xy, l, R_wall, n_r=n_r, rule=rule)
+    dF = F_lumen_jac(x - xc, s_xy, l, R_wall, n_r=n_r, rule=rule)
+    
+    db = b_plasma - b_tissue
+    
+    return np.array([-(I*df[0] + db*dF[0]), 
+                     I*df[1] + db*dF[1], 
+                     I*df[2] + db*dF[2], 
+                     I*df[3] + db*dF[3], 
+                     I*df[4], 
+                     f, 
+                     F, 
+                     1 - F])
+
+
+def L_wall_plasma_jac(x, xc, s_xy, l, R_lum, R_wall, s_gcx, a1, Iw, Ip, b_plasma, b_tissue_wall, b_tissue_plasma, n_r=N_R, n_phi=N_PHI, rule=RULE):
+    """ 
+    Derivatives of L_wall_plasma(...) with respect to its parameters 
+    (xc, s_xy, l, R_lum, R_wall, s_gcx, a1, Iw, Ip, b_plasma, b_tissue_wall, b_tissue_plasma).
+    """
+    Jw = L_wall_jac(x, xc, s_xy, l, R_wall, a1, Iw, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi, rule=rule)
+    Jp = L_plasma_jac(x, xc, s_xy, l, R_lum, R_wall, s_gcx, Ip, b_tissue_plasma, n_r=n_r, n_phi=n_phi, rule=rule)
+    zeros = np.zeros_like(Jw[0])
+    
+    return np.stack([[Jw[0], Jw[1], Jw[2], zeros, Jw[3], zeros, Jw[4], Jw[5], zeros, Jw[6], Jw[7], zeros], 
+                     [Jp[0], Jp[1], Jp[2], Jp[3], Jp[4], Jp[5], zeros, zeros, Jp[6], zeros, zeros, Jp[7]]], axis=1)
 
 
 #-------------------Ultimate Fit--------------------
 
-def L_multi(x, s_xy, l, dR, s_gcx, b_plasma, b_tissue_wall, b_tissue_plasma, *pars, n_r=128, n_phi=128):
+def L_multi(x, s_xy, l, dR, s_gcx, b_plasma, b_tissue_wall, b_tissue_plasma, *pars, n_r=N_R, n_phi=N_PHI, rule=RULE):
     """ Expressions for consecutive pairs (in time) of wall and plasma line-scans of fluorescence.
     Used in Protocol A for tracking capillary walls.
     """
-    Iw, Ip, R_wall, xc, a1 = np.reshape(np.asarray(pars), [5, len(pars)//5])    
-    return np.array([[L_wall(x, xc_i, s_xy, l, R_wall_i, a1_i, Iw_i, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi),
-                     L_plasma(x, xc_i, s_xy, l, R_wall_i - dR, R_wall_i, s_gcx, Ip_i, b_tissue_plasma, n_r=n_r, n_phi=n_phi)] 
-                    for Iw_i, Ip_i, R_wall_i, xc_i, a1_i in zip(Iw, Ip, R_wall, xc, a1)])
+    Iw, Ip, R_wall, xc, a1 = np.reshape(np.asarray(pars), [5, len(pars)//5, 1])    
+    return np.stack([L_wall(x, xc, s_xy, l, R_wall, a1, Iw, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi, rule=rule),
+                     L_plasma(x, xc, s_xy, l, R_wall - dR, R_wall, s_gcx, Ip, b_tissue_plasma, n_r=n_r, n_phi=n_phi, rule=rule)], axis=1)
 
 
-def L_multi_wall(x, s_xy, l, b_plasma, b_tissue_wall, *pars, n_r=128, n_phi=128):
+def L_multi_wall(x, s_xy, l, b_plasma, b_tissue_wall, *pars, n_r=N_R, n_phi=N_PHI, rule=RULE):
     """ Expressions for consecutive (in time) wall-scans of fluorescence.
     Used in Protocol C for tracking capillary walls.
     """
-    Iw, R_wall, xc, a1 = np.reshape(np.asarray(pars), [4, len(pars)//4])    
-    return np.array([L_wall(x, xc_i, s_xy, l, R_wall_i, a1_i, Iw_i, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi)
-                    for Iw_i, R_wall_i, xc_i, a1_i in zip(Iw, R_wall, xc, a1)])
+    Iw, R_wall, xc, a1 = np.reshape(np.asarray(pars), [4, len(pars)//4, 1])    
+    return L_wall(x, xc, s_xy, l, R_wall, a1, Iw, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi, rule=rule)
 
 
-def L_multi_plasma(x, s_xy, l, b_tissue_plasma, *pars, n_r=128):
+def L_multi_plasma(x, s_xy, l, b_tissue_plasma, *pars, n_r=N_R, rule=RULE):
     """ Expressions for consecutive (in time) plasma-scans of fluorescence.
     Used in Protocol B for tracking capillary walls.
     """
-    Ip, R_plasma, xc = np.reshape(np.asarray(pars), [3, len(pars)//3])    
-    return np.array([L_plasma_no_glx(x, xc_i, s_xy, l, R_plasma_i, Ip_i, b_tissue_plasma, n_r=n_r)
-                    for Ip_i, R_plasma_i, xc_i in zip(Ip, R_plasma, xc)])
-    
\ No newline at end of file
+    Ip, R_plasma, xc = np.reshape(np.asarray(pars), [3, len(pars)//3, 1])    
+    return L_plasma_no_glx(x, xc, s_xy, l, R_plasma, Ip, b_tissue_plasma, n_r=n_r, rule=rule)
+
+
+def L_multi_block_jac(x, s_xy, l, dR, s_gcx, b_plasma, b_tissue_wall, b_tissue_plasma, *pars, n_r=N_R, n_phi=N_PHI, rule=RULE):
+    """ 
+    Derivatives of L_multi(...) with respect to the parameters shared by all line-scans, 
+    (s_xy, l, dR, s_gcx, b_plasma, b_tissue_wall, b_tissue_plasma), with shape (7, n_scans, 2, len(x)),
+    and with respect to the parameters of each line-scan, (Iw, Ip, R_wall, xc, a1), with shape (5, n_scans, 2, len(x)).
+    """
+    Iw, Ip, R_wall, xc, a1 = np.reshape(np.asarray(pars), [5, len(pars)//5, 1])
+    Jw = L_wall_jac(x, xc, s_xy, l, R_wall, a1, Iw, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi, rule=rule)
+    Jp = L_plasma_jac(x, xc, s_xy, l, R_wall - dR, R_wall, s_gcx, Ip, b_tissue_plasma, n_r=n_r, n_phi=n_phi, rule=rule)
+    zeros = np.zeros_like(Jw[0])
+    
+    shared = np.array([[Jw[1], Jw[2], zeros, zeros, Jw[6], Jw[7], zeros], 
+                       [Jp[1], Jp[2], -Jp[3], Jp[5], zeros, zeros, Jp[7]]])
+    scans = np.array([[Jw[5], zeros, Jw[3], Jw[0], Jw[4]], 
+                      [zeros, Jp[6], Jp[3] + Jp[4], Jp[0], zeros]])
+    
+    return np.moveaxis(shared, 0, 2), np.moveaxis(scans, 0, 2)
+
+
+def L_multi_wall_block_jac(x, s_xy, l, b_plasma, b_tissue_wall, *pars, n_r=N_R, n_phi=N_PHI, rule=RULE):
+    """ 
+    Derivatives of L_multi_wall(...) with respect to the parameters shared by all line-scans, (s_xy, l, b_plasma, b_tissue_wall), 
+    and with respect to the parameters of each line-scan, (Iw, R_wall, xc, a1).
+    """
+    Iw, R_wall, xc, a1 = np.reshape(np.asarray(pars), [4, len(pars)//4, 1])
+    Jw = L_wall_jac(x, xc, s_xy, l, R_wall, a1, Iw, b_plasma, b_tissue_wall, n_r=n_r, n_phi=n_phi, rule=rule)
+    
+    return Jw[[1, 2, 6, 7]], Jw[[5, 3, 0, 4]]
+
+
+def L_multi_plasma_block_jac(x, s_xy, l, b_tissue_plasma, *pars, n_r=N_R, rule=RULE):
+    """ 
+    Derivatives of L_multi_plasma(...) with respect to the parameters shared by all line-scans, (s_xy, l, b_tissue_plasma), 
+    and with respect to the parameters of each line-scan, (Ip, R_plasma, xc).
+    """
+    Ip, R_plasma, xc = np.reshape(np.asarray(pars), [3, len(pars)//3, 1])
+    Jp = L_plasma_no_glx_jac(x, xc, s_xy, l, R_plasma, Ip, b_tissue_plasma, n_r=n_r, rule=rule)
+    
+    return Jp[[1, 2, 5]], Jp[[4, 3, 0]]
+
+
+def dense_jac(shared, scans):
+    """ 
+    Derivatives of an ultimate-fit model with respect to all of its parameters, 
+    given the derivatives with respect to the shared parameters and to the parameters of each line-scan.
+    """
+    n_shared, (n_block, n) = len(shared), scans.shape[:2]
+    
+    J = np.zeros((n_shared + n_block*n,) + shared.shape[1:])
+    J[:n_shared] = shared
+    for k in range(n_block):
+        J[n_shared + k*n + np.arange(n), np.arange(n)] = scans[k]
+        
+    return J
+
+
+def L_multi_jac(x, s_xy, l, dR, s_gcx, b_plasma, b_tissue_wall, b_tissue_plasma, *pars, n_r=N_R, n_phi=N_PHI, rule=RULE):
+    """ 
+    Derivatives of L_multi(...) with respect to its parameters.
+    """
+    return dense_jac(*L_multi_block_jac(x, s_xy, l, dR, s_gcx, b_plasma, b_tissue_wall, b_tissue_plasma, *pars, n_r=n_r, n_phi=n_phi, rule=rule))
+
+
+def L_multi_wall_jac(x, s_xy, l, b_plasma, b_tissue_wall, *pars, n_r=N_R, n_phi=N_PHI, rule=RULE):
+    """ 
+    Derivatives of L_multi_wall(...) with respect to its parameters.
+    """
+    return dense_jac(*L_multi_wall_block_jac(x, s_xy, l, b_plasma, b_tissue_wall, *pars, n_r=n_r, n_phi=n_phi, rule=rule))
+
+
+def L_multi_plasma_jac(x, s_xy, l, b_tissue_plasma, *pars, n_r=N_R, rule=RULE):
+    """ 
+    Derivatives of L_multi_plasma(...) with respect to its parameters.
+    """
+    return dense_jac(*L_multi_plasma_block_jac(x, s_xy, l, b_tissue_plasma, *pars, n_r=n_r, rule=rule))
+
+
+# Derivatives of the models with respect to their parameters, used for fitting with analytic gradients
+JACOBIANS = {
+    qd_blurred: qd_blurred_jac, 
+    rbc: rbc_jac, 
+    rbc_inv: rbc_inv_jac, 
+    L_plasma: L_plasma_jac, 
+    L_plasma_no_glx: L_plasma_no_glx_jac, 
+    L_wall: L_wall_jac, 
+    L_wall_plasma: L_wall_plasma_jac, 
+    L_multi: L_multi_jac, 
+    L_multi_wall: L_multi_wall_jac, 
+    L_multi_plasma: L_multi_plasma_jac, 
+}
+
+# Derivatives of the ultimate-fit models with respect to the shared parameters and to the parameters of each line-scan
+BLOCK_JACOBIANS = {
+    L_multi: L_multi_block_jac, 
+    L_multi_wall: L_multi_wall_block_jac, 
+    L_multi_plasma: L_multi_plasma_block_jac, 
+}
+
+
+def jacobian(func, jacobians=JACOBIANS):
+    """ 
+    Derivatives of a model with respect to its parameters, looked up in 'jacobians' (None if unknown).
+    Models with some arguments bound by functools.partial (e.g. n_phi, n_r, or rule of the quadratures) 
+    get the derivatives with the same arguments bound.
+    """
+    if isinstance(func, partial):
+        jac = jacobian(func.func, jacobians)
+        return None if jac is None else partial(jac, *func.args, **func.keywords)
+    
+    return jacobians.get(func)
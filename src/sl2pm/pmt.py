@@ -1,6 +1,11 @@
+import json
+import os
+import threading
 import numpy as np
-from mpmath import fp
-from scipy.special import gamma
+from functools import lru_cache
+from typing import NamedTuple
+from scipy.special import gamma, gammaln, xlogy
+from . import config, kernels, profiling
 from .models import gaussian
 
 
@@ -32,6 +37,8 @@ def f(s, e, a):
     Probability density of PMT output 's', given the expected photon count 'e'.
     The function is used in q(...).
     """
+    from mpmath import fp
+    
     b1, b2, b3 = 4/3, 5/3, 2
     
     z = e*a**3*s**3/27
@@ -42,27 +49,564 @@ def f(s, e, a):
         return e*a**3*s**2*np.exp(-e - a*s + 4*z**0.25)*gamma(b1)*gamma(b2)*gamma(b3)*z**(0.25*(1.5 - b1 - b2 - b3))/8/np.sqrt(2)/np.pi**1.5
 
 
-def q(s, e, a, mu, sigma, delta_s=1, s_max=1024):
+def n_terms(z, rtol=1e-10):
+    """
+    Number of terms of the series over detected photons, f = sum_n Poisson(n; e)*Gamma(s; 3n, a), 
+    needed to keep the relative truncation error of f(...) below 'rtol' for all z = e*(a*s)**3 up to 'z'.
+    """
+    if z <= 0:
+        return 1
+    
+    n = np.arange(1, int(2*(z/27)**0.25) + 64)
+    log_t = xlogy(n, z) - gammaln(n + 1) - gammaln(3*n)
+    log_tail = np.logaddexp.accumulate(log_t[::-1])[::-1]
+    below_rtol = np.exp(log_tail - log_tail[0]) < rtol
+    
+    return int(below_rtol.argmax()) if below_rtol.any() else len(n)
+
+
+def _flush_tiny(x):
+    """
+    Set to zero (in place) the values of 'x' below the square root of the smallest normal number in its precision,
+    so that their products are not subnormal numbers, on which arithmetic is slow (float32 values below ~1e-19).
+    """
+    x[np.abs(x) < np.sqrt(np.finfo(x.dtype).tiny)] = 0
+    
+    return x
+
+
+class FTable:
+    """
+    Probability densities f(...) of PMT output on the grid of PMT outputs used in q(...), 
+    tabulated for a fixed alpha 'a' and evaluated for many expected photon counts 'e' at once.
+    The Gamma densities of the PMT output given n detected photons are computed once and reused;
+    the series over n is truncated with n_terms(...) to keep the relative error below 'rtol'.
+    """
+    def __init__(self, a, delta_s=1, s_max=1024, rtol=1e-10):
+        self.a, self.rtol = a, rtol
+        self.s = np.arange(0, s_max, delta_s)
+        self.g = np.empty((0, len(self.s)))
+        self._g_cast = {}
+        self._lock = threading.Lock()
+        
+        self.weights = np.full(len(self.s), float(delta_s))
+        self.weights[[0, -1]] /= 2
+
+    def _extend(self, n_max):
+        # locked, as the table is shared by the threads fitting in parallel (see kernels.py)
+        with self._lock:
+            n = np.arange(len(self.g) + 1, n_max + 1)[:, np.newaxis]
+            log_g = 3*n*np.log(self.a) + xlogy(3*n - 1, self.s) - self.a*self.s - gammaln(3*n)
+            self.g = np.vstack([self.g, np.exp(log_g)])
+
+    def poisson(self, e, n_max, shift=0):
+        """
+        Poisson probabilities of detecting n - shift photons, n = 1, ..., n_max, given the expected photon count 'e'.
+        """
+        n = np.arange(1 - shift, n_max + 1 - shift)[:, np.newaxis]
+        return np.exp(xlogy(n, e) - e - gammaln(n + 1))
+
+    def n_max(self, e):
+        n_max = n_terms(np.max(e, initial=0)*(self.a*self.s[-1])**3, self.rtol)
+        if n_max > len(self.g):
+            self._extend(n_max)
+        return n_max
+
+    def g_as(self, dtype, n_max):
+        """
+        The first 'n_max' rows of the Gamma densities, g, in the precision 'dtype' (casts are kept for reuse).
+        """
+        if dtype == self.g.dtype:
+            return self.g[:n_max]
+        if dtype not in self._g_cast or len(self._g_cast[dtype]) != len(self.g):
+            self._g_cast[dtype] = _flush_tiny(self.g.astype(dtype))
+        
+        return self._g_cast[dtype][:n_max]
+
+    @profiling.timed('pmt.f')
+    def __call__(self, e, shift=0, out=None):
+        """
+        f(s, e, a) for all 's' on the grid, returned with shape (len(s), *e.shape).
+        With shift=1, the Poisson probabilities are shifted by one photon, which gives df/de + f.
+        The result can be written to 'out', an array of shape (len(s), e.size), and is computed in its precision.
+        """
+        e = np.asarray(e, dtype=float)
+        n_max = self.n_max(e) + shift
+        if n_max > len(self.g):
+            self._extend(n_max)
+        
+        dtype = self.g.dtype if out is None else out.dtype
+        poisson = self.poisson(e.ravel(), n_max, shift=shift)
+        poisson = poisson if dtype == poisson.dtype else _flush_tiny(poisson.astype(dtype))
+        f_s = np.matmul(self.g_as(dtype, n_max).T, poisson, out=out)
+        
+        return f_s if out is not None else f_s.reshape(self.s.shape + e.shape)
+
+
+@lru_cache(maxsize=16)
+@profiling.timed('pmt.f_table')
+def f_table(a, delta_s=1, s_max=1024, rtol=1e-10):
+    """
+    FTable for the PMT calibration 'a' and the grid of PMT outputs (delta_s, s_max), cached for reuse between calls of q(...).
+    """
+    return FTable(a, delta_s=delta_s, s_max=s_max, rtol=rtol)
+
+
+MEMORY_BUDGET = 64*2**20
+
+
+class Scratch(threading.local):
+    """
+    Scratch buffers (one per thread) reused between evaluations of q(...), e.g. over the iterations of an optimizer.
+    A buffer is only re-allocated when a larger one is requested.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def __call__(self, slot, shape, dtype=float):
+        size, slot = int(np.prod(shape)), (slot, np.dtype(dtype))
+        if slot not in self.buffers or self.buffers[slot].size < size:
+            self.buffers[slot] = np.empty(size, dtype=dtype)
+        
+        return self.buffers[slot][:size].reshape(shape)
+
+
+scratch = Scratch()
+
+
+def _chunks(s, e, mu, n_s, n_buffers, max_bytes, dtype=float):
+    """ 
+    Flat PMT outputs (relative to mu) and expected photon counts, their broadcast shape, and slices of pixels 
+    such that 'n_buffers' arrays of (n_s, pixels) of 'dtype' fit in 'max_bytes' (MEMORY_BUDGET by default).
+    """
+    ds, e = np.broadcast_arrays(np.asarray(s, dtype=float) - mu, np.atleast_1d(e).astype(float))
+    max_bytes = MEMORY_BUDGET if max_bytes is None else max_bytes
+    size = int(max(1, min(ds.size, max_bytes//(np.dtype(dtype).itemsize*n_buffers*n_s))))
+    
+    return ds.ravel(), e.ravel(), ds.shape, [slice(i, i + size) for i in range(0, ds.size, size)]
+
+
+def _kernel(ds, dummy_s, sigma, dtype=float):
+    """ 
+    gaussian(ds - dummy_s, sigma) for the pixels in a chunk, [dummy_s, pixel], computed in a scratch buffer of 'dtype'.
+    """
+    kernel = scratch('kernel', (len(dummy_s), len(ds)), dtype)
+    np.subtract(ds.astype(dtype, copy=False), dummy_s.astype(dtype, copy=False)[:, np.newaxis], out=kernel)
+    np.square(kernel, out=kernel)
+    kernel *= -0.5/sigma**2
+    np.exp(kernel, out=kernel)
+    kernel *= 1/np.sqrt(2*np.pi*sigma**2)
+    
+    return kernel
+
+
+def _convolve(kernel, table, e, weights, shift=0):
+    """ 
+    Integral (trapezoidal rule with 'weights') over the PMT outputs of the 'kernel' times f(...), computed in a scratch buffer
+    in the precision of the kernel.
+    """
+    f_s = table(e, shift=shift, out=scratch('f', kernel.shape, kernel.dtype))
+    f_s *= kernel
+    
+    return weights.astype(kernel.dtype, copy=False) @ f_s
+
+
+def _clip_tiny(q, dtype):
+    """ 
+    Probability densities computed in the precision 'dtype' clipped at its smallest normal number,
+    where they underflow (far in the tails), so that their logarithms stay finite.
+    """
+    return q if dtype == np.float64 else np.maximum(q, np.finfo(dtype).tiny, out=q)
+
+
+@profiling.timed('pmt.q')
+def q(s, e, a, mu, sigma, delta_s=1, s_max=1024, max_bytes=None, dtype=None):
     """ 
     Probability density of PMT output 's', given the expected photon count 'e', convolved with the Gaussian PMT noise.  
     Used for tracking QDs and RBCs.
+    Evaluated in chunks of pixels using reused scratch buffers of at most 'max_bytes' (MEMORY_BUDGET by default) in total, 
+    in the precision 'dtype' (config.DTYPE by default); the result is float64 (in float32, accurate to ~1e-6 above ~1e-19).
+    """
+    e, a, sigma = np.abs(np.atleast_1d(e)), np.abs(a), np.abs(sigma)
+    dtype = config.get_dtype(dtype)
+    table = f_table(float(a), delta_s, s_max)
+    if kernels.applies(dtype, a, mu, sigma):
+        ds, e = np.broadcast_arrays(np.asarray(s, dtype=float) - mu, e)
+        return kernels.q(ds.ravel(), e.ravel(), sigma, table)[0].reshape(ds.shape)
+
+    ds, e, shape, chunks = _chunks(s, e, mu, len(table.s), 2, max_bytes, dtype)
+    
+    out = np.exp(-e)*gaussian(ds, sigma)
+    for c in chunks:
+        out[c] += _convolve(_kernel(ds[c], table.s, sigma, dtype), table, e[c], table.weights)
+    
+    return _clip_tiny(out, dtype).reshape(shape)
+
+
+@profiling.timed('pmt.q_grad')
+def q_grad(s, e, a, mu, sigma, delta_s=1, s_max=1024, max_bytes=None, dtype=None):
+    """ 
+    q(...) and its derivative with respect to the expected photon count 'e'.
+    The derivative is dq/de = q1 - q, where q1 is q(...) with the number of detected photons shifted by one.
     """
-    dummy_s = np.arange(0, s_max, delta_s)[:, np.newaxis]
+    sign_e = np.sign(np.atleast_1d(e))
+    e, a, sigma = np.abs(np.atleast_1d(e)), np.abs(a), np.abs(sigma)
+    dtype = config.get_dtype(dtype)
+    table = f_table(float(a), delta_s, s_max)
+    if kernels.applies(dtype, a, mu, sigma):
+        ds, e = np.broadcast_arrays(np.asarray(s, dtype=float) - mu, e)
+        q0, q1 = [q.reshape(ds.shape) for q in kernels.q(ds.ravel(), e.ravel(), sigma, table, grad=True)]
+        return q0, sign_e*(q1 - q0)
+
+    ds, e_flat, shape, chunks = _chunks(s, e, mu, len(table.s), 2, max_bytes, dtype)
     
-    ds = s - mu
+    q0, q1 = np.exp(-e_flat)*gaussian(ds, sigma), np.empty(len(ds))
+    for c in chunks:
+        kernel = _kernel(ds[c], table.s, sigma, dtype)
+        q0[c] += _convolve(kernel, table, e_flat[c], table.weights)
+        q1[c] = _convolve(kernel, table, e_flat[c], table.weights, shift=1)
+    q0, q1 = _clip_tiny(q0, dtype).reshape(shape), q1.reshape(shape)
     
-    e, a, sigma = np.abs(e), np.abs(a), np.abs(sigma)
+    return q0, sign_e*(q1 - q0)
+
+
+def nll_q(s, e, a, mu, sigma, delta_s=1, s_max=1024, max_bytes=None, dtype=None):
+    """
+    Negative log-likelihood of PMT outputs 's' given the expected photon counts 'e'.
+    Used for tracking QDs and RBCs.
+    """
+    return np.sum(-np.log(q(s, e, a, mu, sigma, delta_s=delta_s, s_max=s_max, max_bytes=max_bytes, dtype=dtype)))
+
+
+def nll_q_grad(s, e, a, mu, sigma, delta_s=1, s_max=1024, max_bytes=None, dtype=None):
+    """
+    nll_q(...) and its derivatives with respect to the expected photon counts 'e'.
+    """
+    q0, dq_de = q_grad(s, e, a, mu, sigma, delta_s=delta_s, s_max=s_max, max_bytes=max_bytes, dtype=dtype)
     
-    return np.exp(-e)*gaussian(ds, sigma) + np.trapz(gaussian(ds - dummy_s, sigma)*f(dummy_s, e, a), x=dummy_s[:, 0], axis=0)
+    return np.sum(-np.log(q0)), -dq_de/q0
 
 
-def nll_q_mean(s, e, a, sigma, n_aver, mu=0):
+class NLLTable:
+    """
+    Negative log-likelihood, -log q(...), tabulated for a fixed PMT calibration (alpha, mu, sigma) 
+    on a grid of digitized PMT outputs, s = s_range[0], s_range[0] + 1, ..., s_range[1], and a log-spaced grid of expected photon counts 'e'.
+    Queries gather the rows of the table by the PMT output of each pixel and interpolate linearly in log(e).
+    Pairs outside of the table (PMT outputs outside of 's_range', expected photon counts outside of 'e_range', or NaNs) 
+    are evaluated exactly with q(...).
+    The table can be saved to disk with save(...) and loaded back with NLLTable.load(...).
+    """
+    def __init__(self, alpha, mu, sigma, s_range, e_range=(1e-3, 1e2), n_e=1024, delta_s=1, s_max=1024, table=None):
+        self.alpha, self.mu, self.sigma = alpha, mu, sigma
+        self.s = np.arange(s_range[0], s_range[1] + 1)
+        self.log_e = np.linspace(np.log(e_range[0]), np.log(e_range[1]), n_e)
+        self.delta_s, self.s_max = delta_s, s_max
+        self.table = self.build() if table is None else table
+
+    def build(self):
+        """
+        Compute -log q(s, e) on the grid.
+        """
+        e = np.exp(self.log_e)
+        a, sigma = np.abs(self.alpha), np.abs(self.sigma)
+        table = f_table(float(a), self.delta_s, self.s_max)
+        
+        ds = (self.s - self.mu)[:, np.newaxis]
+        convolution = (gaussian(ds - table.s, sigma)*table.weights) @ table(e)
+
+        return -np.log(np.exp(-e)*gaussian(ds, sigma) + convolution)
+
+    def _index(self, s, e):
+        """
+        Rows and columns of the table cells of the pairs of PMT outputs 's' and expected photon counts 'e', the interpolation weights in log(e), 
+        and a mask of the pairs outside of the table (or NaN), which are left to the exact q(...).
+        """
+        s, e = np.broadcast_arrays(np.asarray(s, dtype=float), np.abs(e))
+        with np.errstate(divide='ignore'):
+            u = (np.log(e) - self.log_e[0])/(self.log_e[1] - self.log_e[0])
+        i = np.rint(s - self.s[0])
+        outside = ~((i >= 0) & (i < len(self.s)) & (u >= 0) & (u <= len(self.log_e) - 1))
+        
+        rows, u = np.where(outside, 0, i).astype(int), np.where(outside, 0, u)
+        cols = np.minimum(u.astype(int), len(self.log_e) - 2)
+        
+        return rows, cols, u - cols, outside
+
+    def _exact(self, s, e, outside):
+        s, e = np.broadcast_arrays(s, e)
+        
+        return q_grad(s[outside], e[outside], self.alpha, self.mu, self.sigma, delta_s=self.delta_s, s_max=self.s_max)
+
+    def __call__(self, s, e):
+        """
+        -log q(s, e, alpha, mu, sigma) for each pair of PMT output 's' and expected photon count 'e'.
+        """
+        rows, cols, w, outside = self._index(s, e)
+        nll = (1 - w)*self.table[rows, cols] + w*self.table[rows, cols + 1]
+        if np.any(outside):
+            nll[outside] = -np.log(self._exact(s, e, outside)[0])
+        
+        return nll
+
+    @profiling.timed('pmt.NLLTable.nll')
+    def nll(self, s, e):
+        """ 
+        Negative log-likelihood of PMT outputs 's' given the expected photon counts 'e'.
+        """
+        return np.sum(self(s, e))
+
+    @profiling.timed('pmt.NLLTable.nll_grad')
+    def nll_grad(self, s, e):
+        """ 
+        nll(...) and its derivatives with respect to the expected photon counts 'e'.
+        """
+        rows, cols, w, outside = self._index(s, e)
+        left, right = self.table[rows, cols], self.table[rows, cols + 1]
+        
+        nll = (1 - w)*left + w*right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grad = (right - left)/(self.log_e[1] - self.log_e[0])/np.broadcast_to(e, nll.shape)
+        if np.any(outside):
+            q0, dq_de = self._exact(s, e, outside)
+            nll[outside], grad[outside] = -np.log(q0), -dq_de/q0
+
+        return np.sum(nll), grad
+
+    def save(self, path):
+        np.savez(path, 
+                 table=self.table, 
+                 s_range=self.s[[0, -1]], 
+                 e_range=np.exp(self.log_e[[0, -1]]), 
+                 calibration=[self.alpha, self.mu, self.sigma], 
+                 quadrature=[self.delta_s, self.s_max])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            alpha, mu, sigma = data['calibration']
+            delta_s, s_max = data['quadrature']
+            return cls(alpha, mu, sigma, data['s_range'], e_range=data['e_range'], n_e=data['table'].shape[1], 
+                       delta_s=delta_s, s_max=s_max, table=data['table'])
+
+
+def _clamped_var(e, a, sigma, dtype):
+    """
+    pmt_output_var(...) clamped at the machine epsilon of 'dtype', where expected photon counts 'e' (negative, e.g. in line searches) 
+    would make it negative, so that the likelihood stays finite; and its derivative with respect to 'e', 0 where clamped.
+    """
+    var = pmt_output_var(e, a, sigma)
+    floor = np.finfo(dtype).eps
+    
+    return np.maximum(var, floor), np.where(var > floor, 4/a, 0).astype(dtype)
+
+
+def _masked_counts(n_aver, dtype):
+    """
+    Numbers of PMT outputs averaged 'n_aver' in the precision 'dtype', with NaNs for masked pixels (0), 
+    so that their terms are NaNs, skipped like those of NaN outputs, instead of divisions by zero.
+    """
+    n_aver = np.asarray(n_aver, dtype=dtype)
+    
+    return np.where(n_aver > 0, n_aver, np.nan).astype(dtype, copy=False)
+
+
+@profiling.timed('pmt.nll_q_mean')
+def nll_q_mean(s, e, a, sigma, n_aver, mu=0, dtype=None):
     """
     Negative log-likelihood of probability density of an average of 'n' PMT outputs with expected photon count 'e'
     based on the Central Limit Theorem. 
     Used for tracking capillaries.
+    Masked pixels, with no PMT outputs averaged (n_aver = 0, e.g. from preprocess.profiles(...)) or a NaN output, do not contribute.
+    The terms are computed in the precision 'dtype' (config.DTYPE by default) and summed in float64.
+    """
+    dtype = config.get_dtype(dtype)
+    if kernels.applies(dtype, a, sigma) and np.shape(s) == np.shape(e):
+        return kernels.nll_q_mean(s, e, a, sigma, n_aver)
+
+    s, e, n_aver = np.asarray(s, dtype=dtype), np.asarray(e, dtype=dtype), _masked_counts(n_aver, dtype)
+    var, _ = _clamped_var(e, a, sigma, dtype)
+    
+    return 0.5*np.nansum(np.log(2*np.pi*var/n_aver) + n_aver*(s - pmt_output(e, a))**2/var, dtype=np.float64)
+
+
+@profiling.timed('pmt.nll_q_mean_de')
+def nll_q_mean_de(s, e, a, sigma, n_aver, mu=0, dtype=None):
+    """
+    Derivatives of nll_q_mean(...) with respect to the expected photon counts 'e', in the precision 'dtype' (config.DTYPE by default).
+    Masked pixels (see nll_q_mean(...)) do not contribute.
+    """
+    dtype = config.get_dtype(dtype)
+    if kernels.applies(dtype, a, sigma) and np.shape(s) == np.shape(e):
+        return kernels.nll_q_mean_de(s, e, a, sigma, n_aver)
+
+    s, e, n_aver = np.asarray(s, dtype=dtype), np.asarray(e, dtype=dtype), _masked_counts(n_aver, dtype)
+    var, dvar_de = _clamped_var(e, a, sigma, dtype)
+    ds = s - pmt_output(e, a)
+    
+    return np.nan_to_num(0.5*dvar_de/var - n_aver*ds*(3/a)/var - 0.5*n_aver*ds**2*dvar_de/var**2)
+
+
+def fisher_q_mean(e, a, sigma, n_aver):
+    """
+    Expected Fisher information about the expected photon count 'e' in an average of 'n_aver' PMT outputs,
+    for the likelihood in nll_q_mean(...).
     """
     var = pmt_output_var(e, a, sigma)
     
-    return 0.5*np.nansum(np.log(2*np.pi*var/n_aver) + n_aver*(s - pmt_output(e, a))**2/var)
+    return n_aver*(3/a)**2/var + 0.5*(4/a/var)**2
+
+
+###------------------------------###
+### PMT calibration               ###
+
+class Calibration(NamedTuple):
+    """
+    PMT calibration: 'alpha', the inverse scale of the single-photon PMT output, 
+    'sigma', the STD of the dark noise, and 'mu', the mean dark output.
+    Unpacks into the PMT arguments of the trackers, e.g. track_qd.mle_fit(image, *calibration), 
+    and is saved to (loaded from) the JSON calibration files of the sl2pm command line.
+    """
+    alpha: float
+    sigma: float
+    mu: float = 0.0
+
+    def save(self, path):
+        """ 
+        Save to a JSON file, keeping the other entries of an existing file (e.g. the PSF calibration).
+        """
+        calibration = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                calibration = json.load(file)
+
+        with open(path, 'w') as file:
+            json.dump({**calibration, **{name: float(val) for name, val in self._asdict().items()}}, file, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            calibration = json.load(file)
+
+        return cls(**{name: calibration[name] for name in cls._fields if name in calibration})
+
+
+def pixel_moments(frames, chunk_size=64):
+    """ 
+    Number of frames, mean, and variance (ddof=0) of PMT output for each pixel over a stack of 'frames' (first axis),
+    computed in one pass over chunks of 'chunk_size' frames (Welford's algorithm for chunks), 
+    so that memory-mapped stacks are read from disk once.
+    """
+    n, mean, m2 = 0, 0.0, 0.0
+    for i in range(0, len(frames), chunk_size):
+        chunk = np.asarray(frames[i: i + chunk_size], dtype=float)
+        n_chunk, mean_chunk = len(chunk), chunk.mean(axis=0)
+        delta = mean_chunk - mean
+        
+        mean = mean + delta*n_chunk/(n + n_chunk)
+        m2 = m2 + ((chunk - mean_chunk)**2).sum(axis=0) + delta**2*n*n_chunk/(n + n_chunk)
+        n += n_chunk
+
+    return n, mean, m2/n
+
+
+def output_moments(stacks, per_pixel=False, chunk_size=64):
+    """ 
+    Means and variances (ddof=1) of PMT output for a sequence of image stacks, [frame, y, x], or line-scan stacks, [frame, x], 
+    recorded at different laser intensities.
+    With per_pixel=False, the moments of each stack are over all of its pixels and frames (uniform fluorescence; a single image, [y, x], will do);
+    with per_pixel=True, every pixel of each stack gives the moments over its frames.
+    """
+    means, variances = [], []
+    for stack in stacks:
+        n, mean, var = pixel_moments(stack, chunk_size=chunk_size)
+        if not per_pixel:
+            # the moments of all pixels combined from the moments of each pixel
+            n, mean, var = n*mean.size, mean.mean(), var.mean() + mean.var()
+        
+        means.append(np.ravel(mean))
+        variances.append(np.ravel(var)*n/(n - 1))
+
+    return np.concatenate(means), np.concatenate(variances)
+
+
+def output_histogram(frames, chunk_size=64):
+    """ 
+    Digitized PMT outputs (rounded to integers) in a stack of 'frames' and their counts, computed over chunks of 'chunk_size' frames.
+    """
+    values, counts = [], []
+    for i in range(0, len(frames), chunk_size):
+        s, c = np.unique(np.rint(np.asarray(frames[i: i + chunk_size], dtype=float)), return_counts=True)
+        values.append(s)
+        counts.append(c)
+
+    values, index = np.unique(np.concatenate(values), return_inverse=True)
+    
+    return values, np.bincount(index, weights=np.concatenate(counts))
+
+
+def fit_output_var(means, variances):
+    """ 
+    Fit the variance of PMT output vs its mean (above the dark output) with pmt_output_var(...), by least squares.
+    The fit is not weighted: weights from the variances bias it, since the errors of sample means and variances are correlated.
+    Returns the fitted (alpha, sigma) and their covariance matrix.
+    """
+    from scipy.optimize import curve_fit
+    
+    slope, intercept = np.polyfit(means, variances, 1)
+    
+    return curve_fit(pmt_output_var, means, variances, p0=[4/slope, np.sqrt(max(intercept, 1e-12))])
+
+
+def nll_calibration(p, histograms, dark, s_max):
+    """ 
+    Negative log-likelihood of the histograms of PMT output recorded at different laser intensities, given 
+    p = [log(alpha), log(sigma), mu, log(e) for each histogram except 'dark'], where 'e' are the expected photon counts.
+    The expected photon count of the 'dark' histogram (laser off) is 0.
+    """
+    log_alpha, log_sigma, mu, *log_e = p
+    e = np.insert(np.exp(log_e), dark, 0) if dark is not None else np.exp(log_e)
+    
+    return -sum(np.sum(c*np.log(q(s, e_k, np.exp(log_alpha), mu, np.exp(log_sigma), s_max=s_max))) 
+                for (s, c), e_k in zip(histograms, e))
+
 
+def calibrate(stacks, dark=0, per_pixel=False, refine=False, chunk_size=64, minimize_options=None):
+    """ 
+    PMT calibration from image stacks of a fluorescent slide recorded at different laser intensities, 
+    the 'dark' one (index) with the laser off (see output_moments(...) for 'stacks' and 'per_pixel').
+    The mean dark output gives 'mu', and the variance of PMT output vs its mean gives 'alpha' and 'sigma'.
+    With refine=True, alpha, sigma, and mu are refined by MLE on the full distribution of PMT output, q(...),
+    with the expected photon count of each stack as nuisance parameters (a second pass over the stacks).
+    Without a dark stack (dark=None), 'mu' is fitted by the MLE (refine=True is implied), 
+    starting from an even split of the variance of the stack with the lowest mean output between the photon and PMT noise.
+    """
+    from scipy.optimize import minimize
+    
+    means, variances = output_moments(stacks, per_pixel=per_pixel, chunk_size=chunk_size)
+    
+    starts = np.cumsum([0] + [np.size(stack[0]) if per_pixel else 1 for stack in stacks])
+    if dark is not None:
+        mu = np.mean(means[starts[dark]: starts[dark + 1]])
+        (alpha, sigma), cov = fit_output_var(means - mu, variances)
+    else:
+        # the slope of the variance vs mean does not depend on 'mu'
+        lowest = min(range(len(stacks)), key=lambda k: np.mean(means[starts[k]: starts[k + 1]]))
+        mean, var = np.mean(means[starts[lowest]: starts[lowest + 1]]), np.mean(variances[starts[lowest]: starts[lowest + 1]])
+        slope = np.polyfit(means, variances, 1)[0]
+        alpha, sigma, mu = 4/slope, np.sqrt(var/2), mean - var/(2*slope)
+    
+    calibration = Calibration(float(alpha), float(np.abs(sigma)), float(mu))
+    if not refine and dark is not None:
+        return calibration
+
+    histograms = [output_histogram(stack, chunk_size=chunk_size) for stack in stacks]
+    e = [max(np.mean(means[starts[k]: starts[k + 1]]) - mu, 1e-3)*alpha/3 for k in range(len(stacks)) if k != dark]
+    s_max = int(max(s[-1] for s, c in histograms) - mu + 10*sigma)
+    
+    res = minimize(nll_calibration, 
+                   [np.log(alpha), np.log(calibration.sigma), mu, *np.log(e)], 
+                   args=(histograms, dark, s_max), 
+                   method='L-BFGS-B', 
+                   options={'ftol': 1e-12, **(minimize_options or {})})
+    
+    return Calibration(float(np.exp(res.x[0])), float(np.exp(res.x[1])), float(res.x[2]))
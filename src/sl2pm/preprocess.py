@@ -0,0 +1,86 @@
+## Streaming preprocessing of kymograms for tracking vessels: masking of the rows shadowed by RBCs
+## and binning of the remaining rows into line-profiles with per-pixel counts of averaged PMT outputs (n_aver of pmt.nll_q_mean)
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+
+def lumen_columns(block):
+    """
+    Columns of a block of a plasma kymogram [row, x] inside the vessel's lumen: where the time-averaged line-profile
+    is above half-way between its minimum and maximum.
+    """
+    profile = np.nanmean(block, axis=0)
+    lo, hi = np.nanmin(profile), np.nanmax(profile)
+
+    return profile > 0.5*(lo + hi)
+
+
+def rbc_rows(lumen_mean, threshold=3, sigma=2):
+    """
+    Mask of the rows shadowed by RBCs, given the mean PMT output in the lumen of each row, 'lumen_mean':
+    where it, smoothed over rows (Gaussian, STD=sigma rows), falls 'threshold' robust STDs (from the median absolute deviation)
+    below its median, as RBCs block the fluorescence of the labelled plasma.
+    """
+    smoothed = gaussian_filter1d(np.nan_to_num(lumen_mean, nan=np.nanmedian(lumen_mean)), sigma) if sigma else lumen_mean
+    median = np.median(smoothed)
+    noise = 1.4826*np.median(np.abs(smoothed - median))
+
+    return smoothed < median - threshold*noise
+
+
+def bin_rows(block, n_aver, mask=None):
+    """
+    Average the rows of a block [row, x] in bins of 'n_aver' consecutive rows (the last one partial if the rows do not fill it),
+    skipping the rows in 'mask' (boolean, [row]) and NaNs.
+    Returns the line-profiles [bin, x] (NaN where no PMT output was averaged) and the numbers of PMT outputs averaged, [bin, x].
+    """
+    block = np.asarray(block, dtype=float)
+    n_rows, shape = len(block), block.shape[1:]
+    n_bins = -(-n_rows//n_aver)
+
+    rows = np.full((n_bins*n_aver,) + shape, np.nan)
+    rows[:n_rows] = block
+    if mask is not None:
+        rows[:n_rows][np.asarray(mask, dtype=bool)] = np.nan
+    rows = rows.reshape((n_bins, n_aver) + shape)
+
+    counts = np.sum(~np.isnan(rows), axis=1)
+    sums = np.nansum(rows, axis=1)
+
+    return np.where(counts > 0, sums/np.maximum(counts, 1), np.nan), counts
+
+
+def profiles(kymogram, n_aver, lumen=None, threshold=3, sigma=2, block_size=4096, min_count=1):
+    """
+    Stream a kymogram [row, x] (e.g. memory-mapped with np.load(..., mmap_mode='r')) in blocks of about 'block_size' rows
+    (a multiple of n_aver), so that memory stays bounded, into line-profiles ready for fitting.
+    In each block, the rows shadowed by RBCs are masked with rbc_rows(...) (no masking if threshold=None), from the mean PMT output
+    in the 'lumen' columns (a boolean mask, slice, or indexes of columns; by default lumen_columns(...) of the block) smoothed over
+    rows across the boundaries of the blocks; the other rows are averaged in bins of 'n_aver' rows with bin_rows(...).
+    Pixels averaged over fewer than 'min_count' PMT outputs are set to NaN, and bins with no such pixels are dropped.
+    Yields, for each block, the indexes of the bins (row // n_aver), the line-profiles [bin, x], and the numbers of PMT outputs
+    averaged in their pixels [bin, x], e.g. for track_vessel.track_kymogram(y, ..., n_aver=counts, ...) or StreamingTracker.update(y, n_aver=count).
+    """
+    n_rows = len(kymogram)
+    block_size = max(block_size//n_aver, 1)*n_aver
+    halo = int(4*sigma + 0.5) if threshold is not None and sigma else 0
+
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        block = np.asarray(kymogram[start: stop], dtype=float)
+
+        mask = None
+        if threshold is not None:
+            columns = lumen_columns(block) if lumen is None else lumen
+            # the rows around the block, for smoothing across its boundaries
+            before = np.asarray(kymogram[max(start - halo, 0): start], dtype=float)[:, columns]
+            after = np.asarray(kymogram[stop: min(stop + halo, n_rows)], dtype=float)[:, columns]
+            lumen_mean = np.nanmean(np.concatenate([before, block[:, columns], after]), axis=1)
+            mask = rbc_rows(lumen_mean, threshold=threshold, sigma=sigma)[len(before): len(before) + len(block)]
+
+        y, counts = bin_rows(block, n_aver, mask=mask)
+        y[counts < min_count] = np.nan
+        keep = np.any(counts >= min_count, axis=tuple(range(1, counts.ndim)))
+
+        yield start//n_aver + np.flatnonzero(keep), y[keep], np.where(counts >= min_count, counts, 0)[keep]
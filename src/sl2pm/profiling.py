@@ -0,0 +1,187 @@
+## Opt-in instrumentation of the fits: numbers of calls and times of their stages (pmt densities, models, OLS seeding, BFGS),
+## and a record of every fit, aggregated across worker processes into a table or JSON
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+class _Current(threading.local):
+    # The Profile being recorded, or None (instrumentation off, the default), per thread, 
+    # so that the fits in a pool of threads are profiled as in worker processes
+    profile = None
+
+
+_current = _Current()
+
+FIT_FIELDS = ['function', 'model', 'index', 'time', 'nit', 'nfev', 'njev', 'success']
+
+
+class Profile:
+    """
+    Instrumentation data: the number of calls ('counts') and the total time ('times', s) of each stage by name, e.g. 'pmt.q',
+    'models.L_plasma_no_glx', 'track_qd.ols_fit' or 'misc.minimize_bfgs' (times of nested stages are included in the outer ones),
+    and a record of every fit ('fits', dicts of FIT_FIELDS): the tracking module, the model, the index of the frame (line-profile,
+    line-scan window) within the call of the tracking function, the time (s), the numbers of BFGS iterations and of evaluations
+    of the objective and its gradient, and the convergence flag.
+    """
+    def __init__(self):
+        self.counts, self.times, self.fits = {}, {}, []
+
+    def add(self, name, seconds=0.0, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def merge(self, other, start=0):
+        """
+        Add the counts, times and fits of the Profile 'other' (e.g. of a worker process), with the indexes of its fits shifted by 'start'.
+        """
+        for name, n in other.counts.items():
+            self.add(name, other.times[name], n)
+        self.fits.extend({**fit, 'index': fit['index'] + start} for fit in other.fits)
+
+    def stages(self):
+        """
+        Calls, total time (s) and time per call (s) of the stages, the slowest first.
+        """
+        return sorted([dict(name=name, calls=n, time=self.times[name], time_per_call=self.times[name]/max(n, 1)) for name, n in self.counts.items()],
+                      key=lambda stage: -stage['time'])
+
+    def models(self):
+        """
+        Summary of the fits by tracking module and model: numbers of fits and of converged fits, total time (s),
+        mean numbers of iterations and of evaluations, and the index of the slowest fit.
+        """
+        groups = {}
+        for fit in self.fits:
+            groups.setdefault((fit['function'], fit['model']), []).append(fit)
+
+        return [dict(function=function, model=model, fits=len(fits), converged=sum(fit['success'] for fit in fits),
+                     time=sum(fit['time'] for fit in fits), nit=sum(fit['nit'] for fit in fits)/len(fits),
+                     nfev=sum(fit['nfev'] for fit in fits)/len(fits), slowest=max(fits, key=lambda fit: fit['time'])['index'])
+                for (function, model), fits in groups.items()]
+
+    def to_dict(self):
+        return dict(stages=self.stages(), models=self.models(), fits=self.fits)
+
+    def save(self, path):
+        """
+        Write the stages, the summary by model and the fits as JSON.
+        """
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+    def table(self):
+        """
+        The stages and the summary by model as a text table.
+        """
+        lines = [f"{'stage':<40}{'calls':>10}{'time, s':>12}{'per call, ms':>14}"]
+        lines += [f"{s['name']:<40}{s['calls']:>10}{s['time']:>12.3f}{1e3*s['time_per_call']:>14.3f}" for s in self.stages()]
+        lines += ['', f"{'fits':<40}{'n':>10}{'converged':>11}{'time, s':>12}{'nit':>8}{'nfev':>8}{'slowest':>9}"]
+        lines += [f"{m['function'] + ' ' + str(m['model']):<40}{m['fits']:>10}{m['converged']:>11}{m['time']:>12.3f}{m['nit']:>8.1f}{m['nfev']:>8.1f}{m['slowest']:>9}"
+                  for m in self.models()]
+
+        return '\n'.join(lines)
+
+
+def enabled():
+    return _current.profile is not None
+
+
+@contextmanager
+def profile():
+    """
+    Record a Profile of the fits within a block, e.g. 'with profiling.profile() as p: track_qd.track_stack(...)', then 'print(p.table())'.
+    Within the block (in the calling thread), the tracking functions record their worker processes (or threads) too. An inner block records only into its own Profile.
+    """
+    previous, _current.profile = _current.profile, Profile()
+    try:
+        yield _current.profile
+    finally:
+        _current.profile = previous
+
+
+def count(name, n=1):
+    """
+    Count 'n' calls of the stage 'name', without timing it.
+    """
+    if _current.profile is not None:
+        _current.profile.add(name, n=n)
+
+
+@contextmanager
+def stage(name):
+    """
+    Count and time a block as the stage 'name'.
+    """
+    if _current.profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _current.profile is not None:
+            _current.profile.add(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """
+    Decorator counting and timing the calls of a function as the stage 'name'; adds a check of the current Profile when off.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.profile is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if _current.profile is not None:
+                    _current.profile.add(name, time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+def record_fit(fun, model, res, seconds):
+    """
+    Record a fit of 'model' (name) minimizing the objective 'fun', with the result 'res' (scipy.optimize.OptimizeResult) in 'seconds'.
+    """
+    if _current.profile is None:
+        return
+
+    p = _current.profile
+    p.add('misc.minimize_bfgs', seconds)
+    p.fits.append(dict(function=getattr(fun, '__module__', '').rsplit('.', 1)[-1], model=model, index=len(p.fits),
+                       time=seconds, nit=int(res.get('nit', 0)), nfev=int(res.get('nfev', 0)), njev=int(res.get('njev', 0)),
+                       success=bool(res.success)))
+
+
+def run(enabled, func, *args, **kwargs):
+    """
+    func(*args, **kwargs) and, if 'enabled', the Profile of the call (else None), e.g. fitting a chunk of frames in a worker process:
+    pool.submit(profiling.run, profiling.enabled(), cached_call, cache, _fit_frames, ...); pass the output to collect(...).
+    """
+    if not enabled:
+        return func(*args, **kwargs), None
+
+    with profile() as p:
+        result = func(*args, **kwargs)
+
+    return result, p
+
+
+def collect(output, start=0):
+    """
+    The result of run(...), merging its Profile, with the indexes of its fits shifted by 'start', into the one being recorded.
+    """
+    result, p = output
+    if p is not None and _current.profile is not None:
+        _current.profile.merge(p, start=start)
+
+    return result
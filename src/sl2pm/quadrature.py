@@ -0,0 +1,72 @@
+## Quadrature rules for the integrals in the models of line-profiles of blood vessels
+
+import numpy as np
+from functools import lru_cache
+
+
+def trapz_rule(n):
+    """
+    Trapezoidal rule with n equidistant nodes on [-1, 1] (the rule of np.trapz on np.linspace(-1, 1, n)).
+    """
+    weights = np.full(n, 2/(n - 1))
+    weights[[0, -1]] /= 2
+
+    return np.linspace(-1, 1, n), weights
+
+
+def gauss_legendre_rule(n):
+    """
+    Gauss-Legendre rule with n nodes on [-1, 1].
+    """
+    return np.polynomial.legendre.leggauss(n)
+
+
+def tanh_sinh_rule(n, t_max=3.2):
+    """
+    Tanh-sinh (double exponential) rule with n nodes on [-1, 1], suited for integrands with endpoint singularities.
+    The nodes are placed at half-steps, t = h*(k + 1/2), so that an even n never puts a node in the middle of the interval.
+    """
+    h = 2*t_max/n
+    t = h*(np.arange(n) - n/2 + 0.5)
+
+    return np.tanh(0.5*np.pi*np.sinh(t)), h*0.5*np.pi*np.cosh(t)/np.cosh(0.5*np.pi*np.sinh(t))**2
+
+
+RULES = {
+    'trapz': trapz_rule,
+    'gauss-legendre': gauss_legendre_rule,
+    'tanh-sinh': tanh_sinh_rule,
+}
+
+
+class Quadrature:
+    """
+    Nodes and weights of a quadrature rule ('trapz', 'gauss-legendre', or 'tanh-sinh') with n nodes on [-1, 1].
+    """
+    def __init__(self, n, rule='trapz'):
+        if rule not in RULES:
+            raise ValueError(f"Unknown quadrature rule '{rule}', use one of {list(RULES)}")
+
+        self.n, self.rule = n, rule
+        self.nodes, self.weights = RULES[rule](n)
+
+    def on(self, lo, hi, *args):
+        """
+        Nodes and weights mapped to the interval [lo, hi] and reshaped to broadcast against the arguments 'args',
+        with the nodes along the first axis, in the precision of the arguments (float32 or float64), 
+        so that the integrands are evaluated in the precision of the line-profiles' coordinates (see config.py).
+        Integrals are then sums of weights*integrand over the first axis.
+        """
+        shape = (-1,) + (1,)*np.broadcast(lo, hi, *args).ndim
+        dtype = np.result_type(lo, hi, *args, np.float32)
+        nodes, weights = np.reshape(self.nodes.astype(dtype, copy=False), shape), np.reshape(self.weights.astype(dtype, copy=False), shape)
+
+        return lo + 0.5*(hi - lo)*(nodes + 1), 0.5*(hi - lo)*weights
+
+
+@lru_cache(maxsize=64)
+def quadrature(n, rule='trapz'):
+    """
+    Quadrature with n nodes, cached for reuse between evaluations of the models.
+    """
+    return Quadrature(n, rule)
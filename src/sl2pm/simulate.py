@@ -0,0 +1,123 @@
+## Synthetic images and kymograms with the PMT noise model of pmt.q(...), and their ground truth
+
+import numpy as np
+from . import bistable_bias
+from .models import qd_blurred, rbc
+
+
+def pmt_sample(e, alpha, sigma, mu=0, n_aver=1, rng=None):
+    """
+    PMT outputs for expected photon counts 'e' (any shape), sampled from the model of q(...):
+    a Poisson number of detected photons n, a Gamma(3n, 1/alpha) PMT output, plus Gaussian noise (mu, sigma).
+    With n_aver > 1, returns the mean of 'n_aver' independent samples (e.g. averaged line-profiles), sampled at once
+    from the sum of the photons, Poisson(n_aver*e).
+    'rng' is a seed or a numpy Generator, for reproducibility.
+    """
+    rng = np.random.default_rng(rng)
+    e = np.asarray(e, dtype=float)
+
+    n = rng.poisson(n_aver*np.abs(e))
+    s = rng.normal(n_aver*mu, np.sqrt(n_aver)*abs(sigma), e.shape)
+    detected = n > 0
+    s[detected] += rng.standard_gamma(3*n[detected])/abs(alpha)
+
+    return s/n_aver
+
+
+def brownian_track(n, D, start=(0, 0), rng=None):
+    """
+    Ground-truth track of a particle diffusing with diffusion coefficient 'D' (pixels^2 per frame) over 'n' frames from 'start',
+    as an array [frame, coordinate].
+    """
+    rng = np.random.default_rng(rng)
+    steps = rng.normal(0, np.sqrt(2*D), (n, len(start)))
+    steps[0] = 0
+
+    return np.asarray(start, dtype=float) + np.cumsum(steps, axis=0)
+
+
+def qd_frames(xo, yo, shape, calibration, b=0.5, A=150, sx=1.5, sy=1.5, theta=0, chunk_size=256, rng=None):
+    """
+    Images [frame, y, x] of QDs at the ground-truth locations 'xo', 'yo' (arrays [frame] for one QD, or [frame, QD] for several),
+    with expected photon counts from models.qd_blurred(...) (background 'b' per pixel, 'A' photons per QD, and PSF 'sx', 'sy', 'theta'),
+    and PMT outputs sampled with pmt_sample(...) for the PMT 'calibration' (alpha, sigma, mu). Frames are generated in chunks of 'chunk_size'.
+    Returns the images and the ground truth, a structured array with the frame index ('frame'), the QD index ('qd'),
+    and the parameters of qd_blurred(...) for each QD in each frame.
+    """
+    rng = np.random.default_rng(rng)
+    alpha, sigma, mu = calibration
+    xo, yo = np.asarray(xo, dtype=float), np.asarray(yo, dtype=float)
+    xo, yo = (xo[:, np.newaxis], yo[:, np.newaxis]) if xo.ndim == 1 else (xo, yo)
+    n_frames, n_qd = xo.shape
+
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    frames = np.empty((n_frames,) + tuple(shape))
+    for i in range(0, n_frames, chunk_size):
+        e = b + qd_blurred(x, y, 0, A, xo[i: i + chunk_size, :, np.newaxis, np.newaxis], yo[i: i + chunk_size, :, np.newaxis, np.newaxis],
+                           sx, sy, theta).sum(axis=1)
+        frames[i: i + chunk_size] = pmt_sample(e, alpha, sigma, mu, rng=rng)
+
+    truth = np.zeros(n_frames*n_qd, dtype=[('frame', int), ('qd', int)] + [(name, float) for name in ['b', 'A', 'xo', 'yo', 'sx', 'sy', 'theta']])
+    truth['frame'], truth['qd'] = np.divmod(np.arange(n_frames*n_qd), n_qd)
+    truth['b'], truth['A'], truth['xo'], truth['yo'], truth['sx'], truth['sy'], truth['theta'] = b, A, xo.ravel(), yo.ravel(), sx, sy, theta
+
+    return frames, truth
+
+
+def rbc_kymogram(n_scans, n_x, calibration, speed=2.0, length=30, spacing=70, b=2, A=14, s=1.5, start=0, rng=None):
+    """
+    Kymogram [line-scan, x] of RBCs of 'length' pixels, 'spacing' pixels apart, moving along the line-scans at 'speed' pixels per line-scan,
+    with expected photon counts 'b' in RBCs and 'b' + 'A' in plasma, interfaces blurred by 's' (see models.rbc(...)),
+    and PMT outputs sampled with pmt_sample(...) for the PMT 'calibration' (alpha, sigma, mu). 'start' shifts the train of RBCs.
+    Returns the kymogram and the ground truth, a structured array with the cell index ('cell'), line-scan index ('t'),
+    polarity ('plasma_before_rbc') and location ('xo') of each RBC/plasma interface within the line-scans.
+    """
+    rng = np.random.default_rng(rng)
+    alpha, sigma, mu = calibration
+    x, t = np.arange(n_x), np.arange(n_scans)[:, np.newaxis]
+
+    # cells occupy [lo, lo + length] and cross the line-scans at some time
+    shifts = (min(0, speed*(n_scans - 1)), max(0, speed*(n_scans - 1)))
+    cells = np.arange(np.floor((-length - start - shifts[1])/spacing) - 1, np.ceil((n_x - start - shifts[0])/spacing) + 2)
+    lo = start + cells*spacing + speed*t
+    hi = lo + length
+
+    shadow = np.zeros((n_scans, n_x))
+    for k in range(len(cells)):
+        shadow += rbc(x, 0, 1, s, lo[:, k: k + 1]) - rbc(x, 0, 1, s, hi[:, k: k + 1])
+    kymogram = pmt_sample(b + A*(1 - shadow), alpha, sigma, mu, rng=rng)
+
+    # interfaces within the line-scans: the intensity drops at lo (plasma/RBC, rbc_inv) and rises at hi (RBC/plasma, rbc)
+    cell = np.broadcast_to(np.arange(len(cells)), lo.shape)
+    scan = np.broadcast_to(t, lo.shape)
+    records = []
+    for loc, plasma_before_rbc in [(lo, False), (hi, True)]:
+        inside = (loc >= 0) & (loc <= n_x - 1)
+        records.append((cell[inside], scan[inside], np.full(inside.sum(), plasma_before_rbc), loc[inside]))
+
+    truth = np.zeros(sum(len(r[0]) for r in records), dtype=[('cell', int), ('t', int), ('plasma_before_rbc', bool), ('xo', float)])
+    for i, name in enumerate(truth.dtype.names):
+        truth[name] = np.concatenate([r[i] for r in records])
+    truth.sort(order=['t', 'xo'])
+
+    return kymogram, truth
+
+
+def vessel_kymogram(x, model, params, n_aver, calibration, rng=None):
+    """
+    Kymogram [line-profile, x] of a vessel, with expected photon counts from a line-profile 'model' (e.g. models.L_plasma, L_wall),
+    given its parameters as a dict of scalars or arrays [line-profile] (the ground truth, e.g. a pulsating R_lum or a drifting xc),
+    and PMT outputs averaged over 'n_aver' samples with pmt_sample(...) for the PMT 'calibration' (alpha, sigma, mu).
+    """
+    params = {name: np.asarray(val, dtype=float)[..., np.newaxis] for name, val in params.items()}
+    e = np.atleast_2d(model(x, **params))
+
+    return pmt_sample(e, *calibration, n_aver=n_aver, rng=rng)
+
+
+def add_bistable_bias(output, t, params, dt, model=bistable_bias.bb_single):
+    """
+    Add bistable bias to PMT 'output' (time along its last axis) sampled at times 't', given the bias parameters 'params'
+    (dict or record of bistable_bias.fit_batch(...)); bistable_bias.correct(...) removes it.
+    """
+    return output + bistable_bias.bias(t, params, dt, model=model)
@@ -0,0 +1,136 @@
+## Append-only on-disk store of tracking results: a structured .npy file, memory-mappable by np.load(..., mmap_mode='r'),
+## grown chunk by chunk, and an index of the committed chunks, so that a crashed run resumes from its last completed chunk
+
+import json
+import os
+import struct
+import numpy as np
+from numpy.lib import format as npy
+
+
+def _header(dtype, n):
+    """
+    Header of a .npy file (version 1.0) of 'n' records of 'dtype', padded with spaces to the size of the header for 10**18 records,
+    so that it can be rewritten in place as the file grows.
+    """
+    prefix = len(npy.magic(1, 0)) + 2
+    header, longest = [repr({'descr': npy.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (k,)}) for k in (n, 10**18)]
+    size = -(-(prefix + len(longest) + 1)//64)*64
+
+    return npy.magic(1, 0) + struct.pack('<H', size - prefix) + header.encode('latin1').ljust(size - prefix - 1) + b'\n'
+
+
+class ResultStore:
+    """
+    Append-only store of fitting results (structured arrays, e.g. of misc.fit_dtype(...) or track_rbc.RBC_KYMOGRAM_DTYPE)
+    in the .npy file 'path', with an index of the committed chunks in '<path>.index.json'.
+    append(...) writes a chunk of records and commits it in the index; the index is replaced atomically and is the
+    authoritative record of what was written, so after a crash the store is truncated back to its last committed chunk
+    when reopened, and len(store) is the row (frame, line-profile) to resume from.
+    The file is a regular .npy file of the committed records: read(...) (or np.load(path, mmap_mode='r')) maps it without copying.
+    'dtype' is required to create a store; to open an existing one, it must match or be None.
+    """
+    def __init__(self, path, dtype=None):
+        self.path = os.fspath(path)
+        self.index_path = self.path + '.index.json'
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                index = json.load(file)
+            self.dtype = npy.descr_to_dtype([tuple(field) for field in index['dtype']])
+            self.chunks = [tuple(chunk) for chunk in index['chunks']]
+            if dtype is not None and np.dtype(dtype) != self.dtype:
+                raise ValueError(f"The store {self.path} holds records of {self.dtype}, not {np.dtype(dtype)}")
+            self._recover()
+        else:
+            if dtype is None:
+                raise ValueError(f"No store at {self.path}: the dtype of its records is needed to create one")
+            self.dtype, self.chunks = np.dtype(dtype), []
+            with open(self.path, 'wb') as file:
+                file.write(_header(self.dtype, 0))
+            self._commit()
+
+        self._offset = len(_header(self.dtype, 0))
+
+    def __len__(self):
+        return self.chunks[-1][1] if self.chunks else 0
+
+    def _commit(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(dict(dtype=npy.dtype_to_descr(self.dtype), chunks=self.chunks), file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.index_path)
+
+    def _recover(self):
+        """
+        Drop the records of a chunk that was being written when a run crashed, and restore the header of the committed ones.
+        """
+        size = len(_header(self.dtype, 0)) + len(self)*self.dtype.itemsize
+        with open(self.path, 'r+b') as file:
+            file.truncate(size)
+            file.write(_header(self.dtype, len(self)))
+
+    def append(self, records):
+        """
+        Write the structured array 'records' as a chunk at the end of the store and commit it. Returns the (start, stop) rows of the chunk.
+        """
+        records = np.ascontiguousarray(records, dtype=self.dtype)
+        start, stop = len(self), len(self) + len(records)
+
+        with open(self.path, 'r+b') as file:
+            file.seek(self._offset + start*self.dtype.itemsize)
+            file.write(records.tobytes())
+            file.seek(0)
+            file.write(_header(self.dtype, stop))
+            file.flush()
+            os.fsync(file.fileno())
+
+        self.chunks.append((start, stop))
+        self._commit()
+
+        return start, stop
+
+    def extend(self, records, chunk_size=256):
+        """
+        Append the records yielded by 'records' (e.g. a tracking generator) in chunks of 'chunk_size', committing each one as it is complete.
+        Returns the number of records appended.
+        """
+        chunk, n = [], 0
+        for record in records:
+            chunk.append(record)
+            if len(chunk) == chunk_size:
+                n += len(chunk)
+                self.append(np.array(chunk, dtype=self.dtype))
+                chunk = []
+        if chunk:
+            n += len(chunk)
+            self.append(np.array(chunk, dtype=self.dtype))
+
+        return n
+
+    def read(self, mmap=True):
+        """
+        All committed records: a read-only memory map of the file (no copy) with mmap, else an array in memory.
+        Fields are views, e.g. store.read()['xo'] can be passed to track_rbc.rbc_speed(...) as it is.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=self.dtype)
+
+        return np.load(self.path, mmap_mode='r' if mmap else None)
+
+    def chunk(self, i):
+        """
+        The records of the i-th chunk, a view of read(...).
+        """
+        start, stop = self.chunks[i]
+        return self.read()[start: stop]
+
+    def truncate(self, n=0):
+        """
+        Keep only the chunks within the first 'n' records, e.g. truncate() to rewrite the store from scratch.
+        """
+        self.chunks = [chunk for chunk in self.chunks if chunk[1] <= n]
+        self._commit()
+        self._recover()
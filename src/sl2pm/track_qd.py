@@ -1,19 +1,35 @@
 import numpy as np
-from . import pmt
-from .models import qd_blurred
-from scipy.optimize import minimize, curve_fit
-from scipy.ndimage import gaussian_filter
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from . import config, pmt, profiling
+from .cache import cached_call
+from .misc import fit_dtype, fit_record, minimize_bfgs, positive_definite
+from .models import qd_blurred, qd_blurred_jac
+from scipy.optimize import curve_fit
+from scipy.ndimage import gaussian_filter, maximum_filter
+from scipy.spatial import cKDTree
+from numpy.lib.stride_tricks import sliding_window_view
 
 
-def make_xy_grid(image):
+@lru_cache(maxsize=16)
+def xy_grid(shape):
     """ 
-    Make 2D grids of x- and y-coordinates. 
+    2D grids of x- and y-coordinates for images of 'shape', cached (read-only) for reuse between evaluations.
     """
-    ny, nx = image.shape
+    ny, nx = shape
     X, Y = np.meshgrid(range(nx), range(ny), indexing='xy')
+    X.flags.writeable, Y.flags.writeable = False, False
     return X, Y
 
 
+def make_xy_grid(image):
+    """ 
+    Make 2D grids of x- and y-coordinates. 
+    """
+    return xy_grid(np.shape(image))
+
+
+@profiling.timed('track_qd.ols_fit')
 def ols_fit(image, sigma_blur=1):
     """ 
     Quick-and-dirty QDs localization by fitting 2D images with ordinary least-squares (OLS) optimization. 
@@ -50,27 +66,283 @@ def p0_ols(image, alpha, sigma_blur=1):
     return [b/pmt.gain(alpha), A/pmt.gain(alpha), xo, yo, sx, sy, theta]
 
 
-def neg_loglike(p, image, alpha, sigma, mu, delta_s=4, s_max=1000):
+@profiling.timed('track_qd.p0_moments')
+def p0_moments(images, alpha, sigma_blur=1, n_std=3):
+    """ 
+    Intitial guesses for parameters of a stack of images [frame, y, x], estimated from the moments of the images, all at once.
+    The background is a low percentile of the blurred image (STD=sigma_blur); the amplitude, center, and covariance 
+    of the QD are the moments of the blurred image above the background, first over the whole image, 
+    then refined within 'n_std' STDs of the first estimates. 
+    """
+    images = np.asarray(images, dtype=float)
+    X, Y = xy_grid(images.shape[1:])
+    
+    blurred = gaussian_filter(images, (0, sigma_blur, sigma_blur))
+    b = np.percentile(blurred, 10, axis=(1, 2))
+    w = np.clip(blurred - b[:, np.newaxis, np.newaxis], 0, None)
+    
+    def moments(w):
+        A = np.maximum(w.sum(axis=(1, 2)), 1e-12)
+        xo, yo = [np.sum(w*Z, axis=(1, 2))/A for Z in (X, Y)]
+        dx, dy = X - xo[:, np.newaxis, np.newaxis], Y - yo[:, np.newaxis, np.newaxis]
+        Cxx, Cyy, Cxy = [np.sum(w*d, axis=(1, 2))/A for d in (dx**2, dy**2, dx*dy)]
+        return A, xo, yo, Cxx, Cyy, Cxy, dx, dy
+    
+    A, xo, yo, Cxx, Cyy, Cxy, dx, dy = moments(w)
+    
+    # refine within the ellipse of 'n_std' STDs, where the QD dominates the noise of the background
+    det = np.maximum(Cxx*Cyy - Cxy**2, 1e-12)[:, np.newaxis, np.newaxis]
+    r2 = (Cyy[:, np.newaxis, np.newaxis]*dx**2 - 2*Cxy[:, np.newaxis, np.newaxis]*dx*dy + Cxx[:, np.newaxis, np.newaxis]*dy**2)/det
+    A, xo, yo, Cxx, Cyy, Cxy, dx, dy = moments(w*(r2 < n_std**2))
+    
+    # covariance of the blurred QD, R*diag(sx**2, sy**2)*R^T, de-blurred
+    theta = 0.5*np.arctan2(2*Cxy, Cxx - Cyy)
+    c, s = np.cos(theta), np.sin(theta)
+    sx2 = Cxx*c**2 + 2*Cxy*s*c + Cyy*s**2 - sigma_blur**2
+    sy2 = Cxx*s**2 - 2*Cxy*s*c + Cyy*c**2 - sigma_blur**2
+    sx, sy = np.sqrt(np.maximum(sx2, 0.25)), np.sqrt(np.maximum(sy2, 0.25))
+    
+    return np.stack([b/pmt.gain(alpha), A/pmt.gain(alpha), xo, yo, sx, sy, theta], axis=1)
+
+
+@profiling.timed('track_qd.neg_loglike')
+def neg_loglike(p, image, alpha, sigma, mu, delta_s=4, s_max=1000, nll_table=None, dtype=None):
     """ 
     Negative log-likelihood for fitting images of QDs.
+    If 'nll_table' (pmt.NLLTable for the same calibration) is given, it is used instead of evaluating pmt.q(...).
     """
+    if nll_table is not None:
+        return nll_table.nll(image.ravel(), qd_blurred(*make_xy_grid(image), *p).ravel())
+    
     return np.sum(-np.log(pmt.q(image.ravel(), 
                                 qd_blurred(*make_xy_grid(image), *p).ravel(), 
                                 alpha, 
                                 mu, 
                                 sigma, 
                                 delta_s=delta_s, 
-                                s_max=s_max)
+                                s_max=s_max, 
+                                dtype=dtype)
                          ))
     
 
-def mle_fit(image, alpha, sigma, mu, p0='ols', sigma_blur=1, delta_s=5, s_max=800, minimize_options=None):
+@profiling.timed('track_qd.neg_loglike_grad')
+def neg_loglike_grad(p, image, alpha, sigma, mu, delta_s=4, s_max=1000, nll_table=None, dtype=None):
+    """ 
+    Negative log-likelihood for fitting images of QDs and its gradient with respect to the parameters 'p'.
+    """
+    X, Y = make_xy_grid(image)
+    with profiling.stage('models.qd_blurred'):
+        e = qd_blurred(X, Y, *p).ravel()
+    
+    if nll_table is not None:
+        nll, dnll_de = nll_table.nll_grad(image.ravel(), e)
+    else:
+        nll, dnll_de = pmt.nll_q_grad(image.ravel(), e, alpha, mu, sigma, delta_s=delta_s, s_max=s_max, dtype=dtype)
+    
+    with profiling.stage('models.qd_blurred_jac'):
+        J = qd_blurred_jac(X, Y, *p).reshape(len(p), -1)
+
+    return nll, J @ dnll_de
+    
+
+def mle_fit(image, alpha, sigma, mu, p0='ols', sigma_blur=1, delta_s=5, s_max=800, minimize_options=None, nll_table=None, dtype=None):
     """ 
     Fit image with MLE.
-    By default, uses initial parameters values estimated with the OLS fitting.
+    By default, uses initial parameters values estimated with the OLS fitting ('ols'); 
+    p0='moments' uses the faster estimates from the moments of the image, p0_moments(...).
+    pmt.q(...) is evaluated in the precision 'dtype' (config.DTYPE by default; see misc.minimize_bfgs(...) for float32).
+    """
+    if isinstance(p0, str) and p0 == 'ols':
+        p0 = p0_ols(image, alpha, sigma_blur=sigma_blur)
+    elif isinstance(p0, str) and p0 == 'moments':
+        p0 = p0_moments(image[np.newaxis], alpha, sigma_blur=sigma_blur)[0]
+    
+    return minimize_bfgs(neg_loglike_grad, 
+                         p0,
+                         args=(image, alpha, sigma, mu, delta_s, s_max, nll_table), 
+                         dtype=config.get_dtype(dtype), 
+                         options=minimize_options, 
+                         model='qd_blurred')
+
+
+def _seeds(images, p0, alpha, sigma_blur=1):
+    """ 
+    Initial guesses, [frame, parameter], for a chunk of 'images': from their moments (p0='moments'), 
+    from OLS fits (p0='ols'), or the given array 'p0'.
+    """
+    if isinstance(p0, str):
+        if p0 == 'moments':
+            return p0_moments(images, alpha, sigma_blur=sigma_blur)
+        if p0 == 'ols':
+            return np.array([p0_ols(image, alpha, sigma_blur=sigma_blur) for image in images])
+        raise ValueError(f"Unknown initial guesses '{p0}', use 'moments', 'ols', or an array")
+    
+    return np.asarray(p0, dtype=float)
+
+
+def _fit_frames(images, seeds, alpha, sigma, mu, warm_start, delta_s, s_max, minimize_options, nll_table, dtype=None):
+    """ 
+    Fit consecutive frames with MLE. With warm_start, each fit starts from the solution for the previous frame,
+    with the QD's position from the frame's own seed, and from its inverse Hessian, which halves the number of evaluations.
     """
-    return minimize(neg_loglike, 
-                       p0_ols(image, alpha, sigma_blur=sigma_blur) if p0 == 'ols' else p0,
-                       args=(image, alpha, sigma, mu, delta_s, s_max), 
-                       method='bfgs', 
-                       options=minimize_options)
\ No newline at end of file
+    records, res = [], None
+    for image, seed in zip(images, seeds):
+        p0, options = seed, minimize_options
+        if warm_start and res is not None and res.success:
+            p0 = np.concatenate([res.x[:2], seed[2:4], res.x[4:]])
+            options = {**(minimize_options or {}), 'hess_inv0': positive_definite(res.hess_inv)}
+        res = mle_fit(np.asarray(image, dtype=float), alpha, sigma, mu, p0=p0, delta_s=delta_s, s_max=s_max, 
+                      minimize_options=options, nll_table=nll_table, dtype=dtype)
+        records.append(fit_record(res))
+    
+    return np.array(records, dtype=fit_dtype(['b', 'A', 'xo', 'yo', 'sx', 'sy', 'theta']))
+
+
+def track_stack(images, calibration, p0='moments', sigma_blur=1, warm_start=True, chunk_size=64, workers=None, 
+                delta_s=5, s_max=800, minimize_options=None, nll_table=None, cache=None, dtype=None, threads=False):
+    """ 
+    Track a QD through a stack of images [frame, y, x] (or a sequence of images of the same shape, e.g. the ROIs, 
+    views of the frames, of extract_rois(...)) with MLE, given the PMT 'calibration' (alpha, sigma, mu).
+    The images are copied to float arrays chunk by chunk, not all at once.
+    Initial guesses are computed for a chunk at once with p0_moments(...) (p0='moments'), for each frame with p0_ols(...) (p0='ols'), 
+    or given as an array, [frame, parameter].
+    Frames are fitted in chunks of 'chunk_size' by a pool of 'workers' processes (all CPUs by default, no pool if workers=1),
+    or threads with 'threads' (with the compiled kernels, which release the GIL, see kernels.py);
+    with warm_start, each fit within a chunk starts from the solution (and the inverse Hessian) for the previous frame.
+    With a 'cache' (cache.ResultCache), the results of chunks fitted before with the same frames, seeds and options are reused.
+    pmt.q(...) is evaluated in the precision 'dtype' (config.DTYPE by default, passed on to the worker processes).
+    Within profiling.profile(), the worker processes are profiled too, with the frames indexed from the first image.
+    Returns a structured array with the fitted parameters, b, A, xo, yo, sx, sy, theta, their error bars ('<name>_err'),
+    the negative log-likelihood ('nll'), convergence flags ('success'), and numbers of iterations ('nit') for each frame.
+    """
+    alpha, sigma, mu = calibration
+    args = (alpha, sigma, mu, warm_start, delta_s, s_max, minimize_options, nll_table, config.get_dtype(dtype))
+    starts = range(0, len(images), chunk_size)
+    
+    def chunk(i):
+        block = np.asarray(images[i: i + chunk_size], dtype=float)
+        return block, _seeds(block, p0 if isinstance(p0, str) else p0[i: i + chunk_size], alpha, sigma_blur=sigma_blur)
+    
+    profile = profiling.enabled()
+    if workers == 1:
+        records = [profiling.collect(profiling.run(profile, cached_call, cache, _fit_frames, *chunk(i), *args), start=i) for i in starts]
+    else:
+        with (ThreadPoolExecutor if threads else ProcessPoolExecutor)(max_workers=workers) as pool:
+            futures = [pool.submit(profiling.run, profile, cached_call, cache, _fit_frames, *chunk(i), *args) for i in starts]
+            records = [profiling.collect(future.result(), start=i) for i, future in zip(starts, futures)]
+    
+    return np.array([record for chunk in records for record in chunk], 
+                    dtype=fit_dtype(['b', 'A', 'xo', 'yo', 'sx', 'sy', 'theta']))
+
+
+###------------------------------------------------###
+### Detection of QDs in full-field frames           ###
+
+def log_filter(frames, sigma):
+    """ 
+    Scale-normalized Laplacian of Gaussian (LoG) of a stack of frames [frame, y, x], positive at bright spots of size ~sigma.
+    """
+    frames = np.asarray(frames, dtype=float)
+    
+    return -sigma**2*(gaussian_filter(frames, (0, sigma, sigma), order=(0, 2, 0)) + gaussian_filter(frames, (0, sigma, sigma), order=(0, 0, 2)))
+
+
+def _suppress(y, x, response, min_distance):
+    """ 
+    Greedy non-maximum suppression of candidates at (y, x) in one frame: from the strongest 'response' down, 
+    a candidate is kept unless it is closer than 'min_distance' to a candidate already kept, 
+    so that a suppressed candidate does not suppress others. Returns the indexes of the kept candidates.
+    """
+    tree = cKDTree(np.column_stack([y, x]))
+    suppressed, kept = np.zeros(len(y), dtype=bool), []
+    for i in np.argsort(-response, kind='stable'):
+        if not suppressed[i]:
+            kept.append(i)
+            # the query ball is closed, the distance is strict: exclude neighbours at exactly min_distance
+            neighbours = tree.query_ball_point((y[i], x[i]), min_distance)
+            close = [j for j in neighbours if (y[j] - y[i])**2 + (x[j] - x[i])**2 < min_distance**2]
+            suppressed[close] = True
+    
+    return np.array(kept, dtype=int)
+
+
+def detect_spots(frames, sigma=1.5, threshold=5, min_distance=None):
+    """ 
+    Candidate QDs in a stack of frames [frame, y, x]: local maxima of the LoG response (see log_filter(...)) 
+    above 'threshold' robust STDs (from the median absolute deviation) of the response of each frame.
+    Of the candidates closer than 'min_distance' (2*sigma by default), only the one with the strongest response is kept.
+    Returns the frame indexes, y and x coordinates (pixels) of the candidates, and their responses.
+    """
+    frames = np.asarray(frames, dtype=float)
+    frames = frames[np.newaxis] if frames.ndim == 2 else frames
+    min_distance = 2*sigma if min_distance is None else min_distance
+    
+    response = log_filter(frames, sigma)
+    median = np.median(response, axis=(1, 2), keepdims=True)
+    noise = 1.4826*np.median(np.abs(response - median), axis=(1, 2), keepdims=True)
+    
+    size = 2*int(np.ceil(min_distance)) + 1
+    peaks = (response == maximum_filter(response, size=(1, size, size))) & (response > median + threshold*noise)
+    t, y, x = np.nonzero(peaks)
+    
+    # overlap suppression, frame by frame: keep the candidates that are not within min_distance of a stronger kept one
+    keep = np.zeros(len(t), dtype=bool)
+    for frame in np.split(np.arange(len(t)), np.flatnonzero(np.diff(t)) + 1):
+        keep[frame[_suppress(y[frame], x[frame], response[t[frame], y[frame], x[frame]], min_distance)]] = True
+    t, y, x = t[keep], y[keep], x[keep]
+    
+    order = np.lexsort((x, y, t))
+    t, y, x = t[order], y[order], x[order]
+    
+    return t, y, x, response[t, y, x]
+
+
+def extract_rois(frame, y, x, half_size):
+    """ 
+    Square ROIs of (2*half_size + 1) pixels centered at (y, x) in a frame, as views of the frame (no copies), 
+    shifted to stay within the frame near its edges.
+    Returns the ROIs and the (y, x) coordinates of their corners in the frame.
+    """
+    size = 2*half_size + 1
+    windows = sliding_window_view(frame, (size, size))
+    y0 = np.clip(np.asarray(y) - half_size, 0, windows.shape[0] - 1)
+    x0 = np.clip(np.asarray(x) - half_size, 0, windows.shape[1] - 1)
+    
+    return [windows[i, j] for i, j in zip(y0, x0)], y0, x0
+
+
+def track_frames(frames, calibration, sigma=1.5, threshold=5, min_distance=None, half_size=None, 
+                 chunk_size=64, workers=None, delta_s=5, s_max=800, minimize_options=None, nll_table=None, dtype=None):
+    """ 
+    Detect QDs in full-field frames [frame, y, x] with detect_spots(...) and fit each of them with MLE 
+    within a ROI of (2*half_size + 1) pixels (half_size=ceil(4*sigma) by default), given the PMT 'calibration'.
+    The ROIs of all frames are fitted together with track_stack(...), in chunks by a pool of 'workers' processes.
+    Returns a structured array with the frame index ('frame') and the fitting results of each QD (see track_stack(...)), 
+    with xo and yo in the coordinates of the frame.
+    """
+    frames = np.asarray(frames)
+    frames = frames[np.newaxis] if frames.ndim == 2 else frames
+    half_size = int(np.ceil(4*sigma)) if half_size is None else half_size
+    
+    t, y, x, response = detect_spots(frames, sigma=sigma, threshold=threshold, min_distance=min_distance)
+    rois, y0, x0 = [], [], []
+    for k in range(len(frames)):
+        rois_k, y0_k, x0_k = extract_rois(frames[k], y[t == k], x[t == k], half_size)
+        rois += rois_k
+        y0.append(y0_k)
+        x0.append(x0_k)
+    y0, x0 = np.concatenate(y0), np.concatenate(x0)
+    
+    fits_dtype = fit_dtype(['b', 'A', 'xo', 'yo', 'sx', 'sy', 'theta'])
+    fits = (track_stack(rois, calibration, warm_start=False, chunk_size=chunk_size, workers=workers, 
+                        delta_s=delta_s, s_max=s_max, minimize_options=minimize_options, nll_table=nll_table, dtype=dtype) 
+            if rois else np.zeros(0, dtype=fits_dtype))
+    
+    result = np.zeros(len(fits), dtype=[('frame', int)] + fits_dtype.descr)
+    result['frame'] = t
+    for name in fits_dtype.names:
+        result[name] = fits[name]
+    result['xo'] += x0
+    result['yo'] += y0
+    
+    return result
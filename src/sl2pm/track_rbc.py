@@ -1,11 +1,17 @@
 import numpy as np
-from . import pmt
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from . import config, pmt, profiling
+from .cache import cached_call
+from .misc import fit_dtype, fit_record, minimize_bfgs
 from scipy.special import erf
-from scipy.optimize import minimize, curve_fit
-from scipy.ndimage import gaussian_filter1d
-from .models import rbc, rbc_inv
+from scipy.optimize import curve_fit
+from scipy.ndimage import gaussian_filter1d, maximum_filter1d
+from numpy.lib.stride_tricks import sliding_window_view
+from .models import rbc, rbc_inv, rbc_jac, rbc_inv_jac
 
 
+@profiling.timed('track_rbc.ols_fit')
 def ols_fit(linescan, plasma_before_rbc=True, sigma_blur=1.5):
     """ 
     Quick-and-dirty RBCs localization by fitting line-scans with ordinary least-squares (OLS) optimization.
@@ -30,32 +36,61 @@ def p0_ols(linescan, alpha, plasma_before_rbc=True, sigma_blur=1.5):
     return [b/pmt.gain(alpha), A/pmt.gain(alpha), s, xo]
 
 
-def neg_loglike(p, linescan, alpha, sigma, mu, plasma_before_rbc=True, delta_s=4, s_max=1000):
+@profiling.timed('track_rbc.neg_loglike')
+def neg_loglike(p, linescan, alpha, sigma, mu, plasma_before_rbc=True, delta_s=4, s_max=1000, nll_table=None, dtype=None):
     """ 
     Negative log-likelihood for localizing RBCs.
+    If 'nll_table' (pmt.NLLTable for the same calibration) is given, it is used instead of evaluating pmt.q(...).
     """
     fit_func = rbc if plasma_before_rbc else rbc_inv
     
+    if nll_table is not None:
+        return nll_table.nll(linescan, fit_func(np.arange(len(linescan)), *p))
+    
     return np.sum(-np.log(pmt.q(linescan, 
                                 fit_func(np.arange(len(linescan)), *p), 
                                 alpha, 
                                 mu, 
                                 sigma, 
                                 delta_s=delta_s, 
-                                s_max=s_max)
+                                s_max=s_max, 
+                                dtype=dtype)
                          ))
 
 
-def mle_fit(linescan, alpha, sigma, mu, p0='ols', plasma_before_rbc=True, sigma_blur=1, delta_s=3, s_max=800, minimize_options=None):
+@profiling.timed('track_rbc.neg_loglike_grad')
+def neg_loglike_grad(p, linescan, alpha, sigma, mu, plasma_before_rbc=True, delta_s=4, s_max=1000, nll_table=None, dtype=None):
+    """ 
+    Negative log-likelihood for localizing RBCs and its gradient with respect to the parameters 'p'.
+    """
+    x = np.arange(len(linescan))
+    fit_func, fit_jac = (rbc, rbc_jac) if plasma_before_rbc else (rbc_inv, rbc_inv_jac)
+    with profiling.stage('models.' + fit_func.__name__):
+        e = fit_func(x, *p)
+    
+    if nll_table is not None:
+        nll, dnll_de = nll_table.nll_grad(linescan, e)
+    else:
+        nll, dnll_de = pmt.nll_q_grad(linescan, e, alpha, mu, sigma, delta_s=delta_s, s_max=s_max, dtype=dtype)
+    
+    with profiling.stage('models.' + fit_jac.__name__):
+        J = fit_jac(x, *p)
+
+    return nll, J @ dnll_de
+
+
+def mle_fit(linescan, alpha, sigma, mu, p0='ols', plasma_before_rbc=True, sigma_blur=1, delta_s=3, s_max=800, minimize_options=None, nll_table=None, dtype=None):
     """ 
     Fit a line-scan with MLE.
     By default, uses initial parameters values estimated with the OLS fitting.
+    pmt.q(...) is evaluated in the precision 'dtype' (config.DTYPE by default; see misc.minimize_bfgs(...) for float32).
     """
-    return minimize(neg_loglike, 
-                       p0_ols(linescan, alpha, sigma_blur=sigma_blur) if p0 == 'ols' else p0,
-                       args=(linescan, alpha, sigma, mu, plasma_before_rbc, delta_s, s_max), 
-                       method='bfgs', 
-                       options=minimize_options)
+    return minimize_bfgs(neg_loglike_grad, 
+                         p0_ols(linescan, alpha, plasma_before_rbc=plasma_before_rbc, sigma_blur=sigma_blur) if isinstance(p0, str) else p0,
+                         args=(linescan, alpha, sigma, mu, plasma_before_rbc, delta_s, s_max, nll_table), 
+                         dtype=config.get_dtype(dtype), 
+                         options=minimize_options, 
+                         model='rbc' if plasma_before_rbc else 'rbc_inv')
     
 
 def rbc_speed(t, x, x_err):
@@ -73,3 +108,228 @@ def rbc_speed(t, x, x_err):
                  x_mean_err=np.sqrt(cov[1, 1] + 2*to*cov[0, 1] + cov[0, 0]*to**2))
 
 
+###------------------------------------------------###
+### RBCs in kymograms                               ###
+
+def detect_edges(kymogram, sigma_blur=3, threshold=3, min_distance=None):
+    """ 
+    RBC/plasma interfaces in a kymogram [line-scan, x]: local maxima along x of the magnitude of the Gaussian-blurred (STD=sigma_blur) 
+    derivative of the line-scans, above 'threshold' robust STDs (from the median absolute deviation) of the derivative,
+    and at least 'min_distance' (3*sigma_blur by default) apart.
+    Returns the line-scan indexes, sub-pixel x-coordinates (parabolic interpolation of the peaks), 
+    and polarities (plasma_before_rbc, i.e. True where the intensity increases along x) of the interfaces.
+    """
+    kymogram = np.asarray(kymogram, dtype=float)
+    min_distance = 3*sigma_blur if min_distance is None else min_distance
+    
+    grad = gaussian_filter1d(kymogram, sigma_blur, axis=1, order=1)
+    mag = np.abs(grad)
+    noise = 1.4826*np.median(np.abs(grad - np.median(grad)))
+    
+    peaks = (mag == maximum_filter1d(mag, 2*int(np.ceil(min_distance)) + 1, axis=1)) & (mag > threshold*noise)
+    peaks[:, [0, -1]] = False
+    t, x = np.nonzero(peaks)
+    
+    left, centre, right = mag[t, x - 1], mag[t, x], mag[t, x + 1]
+    curvature = left - 2*centre + right
+    shift = np.where(curvature < 0, 0.5*(left - right)/np.where(curvature < 0, curvature, -1), 0)
+    
+    return t, x + shift, grad[t, x] > 0
+
+
+def link_edges(t, x, polarity, max_shift=16, max_gap=2, start=None):
+    """ 
+    Link interfaces (line-scan indexes 't', x-coordinates 'x', and 'polarity', as from detect_edges(...)) through line-scans into tracks:
+    each interface continues the nearest interface of the same polarity in the previous line-scan, within 'max_shift' pixels,
+    or else the nearest one not continued yet in the 'max_gap' line-scans before that (within 'max_shift' pixels per line-scan),
+    with ties resolved in favour of the closest pair; so a track survives up to 'max_gap' missed detections in a row.
+    Interfaces before the line-scan 'start' (e.g. the ends of the tracks of a previous block) are only continued.
+    The front and the rear interface of every RBC are tracked separately, see pair_cells(...).
+    Returns track labels (0, 1, ...) of the interfaces, in order of appearance.
+    """
+    t, x, polarity = np.asarray(t), np.asarray(x, dtype=float), np.asarray(polarity, dtype=bool)
+    n = len(t)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    
+    # sort by (polarity, line-scan, x) and search the earlier line-scans on a single key
+    order = np.lexsort((x, t, polarity))
+    width = np.ptp(x) + 2*max_shift*(max_gap + 1) + 1
+    group = polarity[order]*(np.ptp(t) + max_gap + 3) + t[order] - t.min()
+    key = group*width + x[order]
+    
+    pred, continued = np.full(n, -1), np.zeros(n, dtype=bool)
+    linkable = np.ones(n, dtype=bool) if start is None else t[order] >= start
+    for lag in range(1, max_gap + 2):
+        heads, tails = np.flatnonzero((pred < 0) & linkable), np.flatnonzero(~continued)
+        if len(heads) == 0 or len(tails) == 0:
+            break
+        target = key[heads] - lag*width
+        j = np.searchsorted(key[tails], target)
+        lo, hi = np.clip(j - 1, 0, len(tails) - 1), np.clip(j, 0, len(tails) - 1)
+        nearest = tails[np.where(np.abs(key[tails[lo]] - target) <= np.abs(key[tails[hi]] - target), lo, hi)]
+        distance = np.abs(key[nearest] - target)
+        
+        # one-to-one: of the interfaces continuing the same one, keep the closest
+        claims = np.flatnonzero(distance <= max_shift*lag)
+        claims = claims[np.lexsort((distance[claims], nearest[claims]))]
+        first = np.r_[True, nearest[claims][1:] != nearest[claims][:-1]] if len(claims) else np.zeros(0, dtype=bool)
+        pred[heads[claims[first]]] = nearest[claims[first]]
+        continued[nearest[claims[first]]] = True
+    
+    # label every interface with the first interface of its chain (pointer jumping)
+    root = np.where(pred < 0, np.arange(n), pred)
+    while True:
+        nxt = root[root]
+        if np.array_equal(nxt, root):
+            break
+        root = nxt
+    
+    labels = np.empty(n, dtype=int)
+    labels[order] = order[root]
+    _, first_seen, labels = np.unique(labels, return_index=True, return_inverse=True)
+    
+    return np.argsort(np.argsort(first_seen))[labels]
+
+
+def pair_cells(tracks):
+    """ 
+    Cell labels of the interfaces tracked by track_kymogram(...) (its results concatenated). 
+    In every line-scan, each interface where the intensity drops along x (the edge of an RBC's shadow at lower x) 
+    is paired with the next interface along x if the intensity rises there; then the interface tracks paired most often 
+    are paired into cells, one to one. The tracks left unpaired (e.g. of RBCs partly outside of the line-scans) are cells of their own.
+    Returns the cell labels (0, 1, ...) of the interfaces, in order of appearance.
+    """
+    fitted = tracks[tracks['success']]
+    fitted = fitted[np.lexsort((fitted['xo'], fitted['t']))]
+    drop, rise = fitted[:-1], fitted[1:]
+    paired = ~drop['plasma_before_rbc'] & rise['plasma_before_rbc'] & (drop['t'] == rise['t'])
+    pairs, counts = np.unique(np.column_stack([drop['interface'][paired], rise['interface'][paired]]), axis=0, return_counts=True)
+    
+    partner = {}
+    for a, b in pairs[np.argsort(-counts, kind='stable')]:
+        if a not in partner and b not in partner:
+            partner[a], partner[b] = b, a
+    
+    labels = np.array([min(i, partner.get(i, i)) for i in tracks['interface']], dtype=int)
+    _, first_seen, labels = np.unique(labels, return_index=True, return_inverse=True)
+    
+    return np.argsort(np.argsort(first_seen))[labels]
+
+
+def _fit_edges(linescans, seeds, polarities, alpha, sigma, mu, delta_s, s_max, minimize_options, nll_table, dtype=None):
+    """ 
+    Fit the line-scans around RBC/plasma interfaces with MLE.
+    """
+    return np.array([fit_record(mle_fit(linescan, alpha, sigma, mu, p0=p0, plasma_before_rbc=polarity, delta_s=delta_s, s_max=s_max, 
+                                        minimize_options=minimize_options, nll_table=nll_table, dtype=dtype)) 
+                     for linescan, p0, polarity in zip(linescans, seeds, polarities)], dtype=fit_dtype(['b', 'A', 's', 'xo']))
+
+
+RBC_KYMOGRAM_DTYPE = np.dtype([('interface', int), ('t', int), ('plasma_before_rbc', bool)] + fit_dtype(['b', 'A', 's', 'xo']).descr)
+
+
+def track_kymogram(kymogram, calibration, sigma_blur=3, threshold=3, max_shift=16, max_gap=2, half_width=16, block_size=4096, 
+                   chunk_size=64, workers=None, delta_s=3, s_max=800, minimize_options=None, nll_table=None, cache=None, dtype=None, threads=False):
+    """ 
+    Track RBCs through a kymogram [line-scan, x] with MLE, given the PMT 'calibration' (alpha, sigma, mu).
+    The kymogram (e.g. memory-mapped with np.load(..., mmap_mode='r')) is read in blocks of 'block_size' line-scans, 
+    so that memory stays bounded: the RBC/plasma interfaces of each block are found with detect_edges(...) and linked 
+    through the line-scans with link_edges(...), across gaps of up to 'max_gap' line-scans, continuing the tracks of the previous block 
+    (those ending within 'max_gap' line-scans of it); then the line-scans within 'half_width' pixels 
+    of each interface are fitted in chunks of 'chunk_size' by a pool of 'workers' processes (all CPUs by default, no pool if workers=1),
+    or threads with 'threads' (with the compiled kernels, which release the GIL, see kernels.py).
+    With a 'cache' (cache.ResultCache), the results of chunks fitted before with the same line-scans, seeds and options are reused.
+    pmt.q(...) is evaluated in the precision 'dtype' (config.DTYPE by default, passed on to the worker processes).
+    Within profiling.profile(), the worker processes are profiled too, with the fits indexed in the order of the yielded interfaces.
+    Yields, for each block, a structured array (RBC_KYMOGRAM_DTYPE) with the track labels of the interfaces ('interface'), line-scan indexes ('t'), 
+    polarities ('plasma_before_rbc') and the fitting results (see misc.fit_dtype(...)) of the interfaces, with xo in pixels of the line-scans.
+    The interfaces are paired into cells afterwards, with pair_cells(...) or cell_speeds(...).
+    """
+    alpha, sigma, mu = calibration
+    size = 2*half_width + 1
+    gain = pmt.gain(alpha)
+    carry, n_tracks, n_fitted = (np.zeros(0, dtype=int), np.zeros(0), np.zeros(0, dtype=bool), np.zeros(0, dtype=int)), 0, 0
+    profile = profiling.enabled()
+    
+    with (ThreadPoolExecutor if threads else ProcessPoolExecutor)(max_workers=workers) if workers != 1 else nullcontext() as pool:
+        for start in range(0, len(kymogram), block_size):
+            block = np.asarray(kymogram[start: start + block_size], dtype=float)
+            t, x, polarity = detect_edges(block, sigma_blur=sigma_blur, threshold=threshold)
+            t = t + start
+            
+            # continue the tracks ending in the last line-scans of the previous block
+            n_carry = len(carry[0])
+            labels = link_edges(np.r_[carry[0], t], np.r_[carry[1], x], np.r_[carry[2], polarity], max_shift=max_shift, max_gap=max_gap, start=start)
+            carried = np.full(labels.max() + 1 if len(labels) else 0, -1)
+            carried[labels[:n_carry]] = carry[3]
+            new = carried < 0
+            carried[new] = n_tracks + np.arange(new.sum())
+            n_tracks += new.sum()
+            tracks = carried[labels[n_carry:]]
+            
+            # the last interface of each track, if the track can still continue in the next block
+            ends = [np.r_[carry[0], t], np.r_[carry[1], x], np.r_[carry[2], polarity], np.r_[carry[3], tracks]]
+            order = np.lexsort((ends[0], ends[3]))
+            last = order[np.r_[ends[3][order][1:] != ends[3][order][:-1], True]] if len(order) else order
+            last = last[ends[0][last] >= start + len(block) - 1 - max_gap]
+            carry = tuple(end[last] for end in ends)
+            
+            # fit windows around the interfaces, seeded from the blurred line-scans
+            x0 = np.clip(np.round(x).astype(int) - half_width, 0, max(block.shape[1] - size, 0))
+            linescans = sliding_window_view(block, min(size, block.shape[1]), axis=1)[t - start, x0]
+            blurred = gaussian_filter1d(linescans, sigma_blur, axis=1)
+            lo, hi = blurred.min(axis=1), blurred.max(axis=1)
+            seeds = np.transpose([lo/gain, (hi - lo)/gain, np.ones(len(t)), x - x0])
+            
+            args = (alpha, sigma, mu, delta_s, s_max, minimize_options, nll_table, config.get_dtype(dtype))
+            chunks = range(0, len(t), chunk_size)
+            if pool is None:
+                fits = [profiling.collect(profiling.run(profile, cached_call, cache, _fit_edges, linescans[i: i + chunk_size], seeds[i: i + chunk_size], 
+                                                        polarity[i: i + chunk_size], *args), start=n_fitted + i) 
+                        for i in chunks]
+            else:
+                futures = [pool.submit(profiling.run, profile, cached_call, cache, _fit_edges, linescans[i: i + chunk_size], seeds[i: i + chunk_size], 
+                                       polarity[i: i + chunk_size], *args) 
+                           for i in chunks]
+                fits = [profiling.collect(future.result(), start=n_fitted + i) for i, future in zip(chunks, futures)]
+            n_fitted += len(t)
+            
+            result = np.zeros(len(t), dtype=RBC_KYMOGRAM_DTYPE)
+            result['interface'], result['t'], result['plasma_before_rbc'] = tracks, t, polarity
+            if len(t):
+                fits = np.array([record for chunk in fits for record in chunk], dtype=fit_dtype(['b', 'A', 's', 'xo']))
+                for name in fits.dtype.names:
+                    result[name] = fits[name]
+                result['xo'] += x0
+            
+            yield result
+
+
+def cell_speeds(tracks, dt=1, min_scans=3):
+    """ 
+    Speeds of the cells tracked by track_kymogram(...) (its results concatenated, paired into cells with pair_cells(...)), 
+    with rbc_speed(...) from the locations of their centres, midway between their two interfaces, in the line-scans where both are fitted,
+    or from the locations of their only interface; in at least 'min_scans' line-scans. 'dt' is the time between line-scans.
+    Returns a structured array with the cell labels ('cell'), numbers of interfaces ('n_edges'), numbers of line-scans ('n'), 
+    and the results of rbc_speed(...) for each cell (in pixels per unit of 'dt').
+    """
+    fields = ['speed', 'speed_err', 'intercept', 'intercept_err', 'x_mean', 'x_mean_err']
+    cells = pair_cells(tracks)
+    cells, tracks = cells[tracks['success']], tracks[tracks['success']]
+    
+    records = []
+    for cell in np.unique(cells):
+        edges = [tracks[(cells == cell) & (tracks['plasma_before_rbc'] == polarity)] for polarity in (False, True)]
+        edges = [edge for edge in edges if len(edge)]
+        if len(edges) == 2:
+            t, i, j = np.intersect1d(edges[0]['t'], edges[1]['t'], return_indices=True)
+            x = 0.5*(edges[0]['xo'][i] + edges[1]['xo'][j])
+            x_err = 0.5*np.hypot(edges[0]['xo_err'][i], edges[1]['xo_err'][j])
+        else:
+            t, x, x_err = edges[0]['t'], edges[0]['xo'], edges[0]['xo_err']
+        if len(t) >= min_scans:
+            speed = rbc_speed(t*dt, x, x_err)
+            records.append((cell, len(edges), len(t), *[speed[name] for name in fields]))
+    
+    return np.array(records, dtype=[('cell', int), ('n_edges', int), ('n', int)] + [(name, float) for name in fields])
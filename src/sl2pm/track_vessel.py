@@ -1,12 +1,18 @@
+import inspect
+import time
 import numpy as np
-from . import pmt
-from scipy.optimize import minimize, curve_fit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from . import config, pmt, profiling
+from .cache import cached_call
+from scipy.optimize import minimize, curve_fit, OptimizeResult
 from scipy.ndimage import gaussian_filter1d
-from .models import L_wall, L_plasma_no_glx, L_wall_plasma
+from .misc import fit_dtype, minimize_bfgs
+from .models import L_wall, L_plasma, L_plasma_no_glx, L_wall_plasma, BLOCK_JACOBIANS, jacobian
 
 ### ----------------------------------------------- ###
 ### Ordinary least-squares fitting of line-profiles ###
 
+@profiling.timed('track_vessel.ols_plasma')
 def ols_plasma(profile_plasma, sigma_blur=1.5, thr=0.1):
     """
     Quick-and-dirty vessel wall localization by fitting line-profiles of fluorescence with ordinary least-squares (OLS) optimization. 
@@ -27,6 +33,7 @@ def ols_plasma(profile_plasma, sigma_blur=1.5, thr=0.1):
     return p
 
 
+@profiling.timed('track_vessel.ols_wall')
 def ols_wall(profile_wall, sigma_blur=1.5):
     """
     Quick-and-dirty vessel wall localization by fitting line-profiles of fluorescence with ordinary least-squares (OLS) optimization. 
@@ -47,6 +54,7 @@ def ols_wall(profile_wall, sigma_blur=1.5):
     return p
 
 
+@profiling.timed('track_vessel.ols_wall_plasma')
 def ols_wall_plasma(profile_wall, profile_plasma, sigma_blur=1.5):
     """
     Quick-and-dirty vessel wall localization by fitting line-profiles of fluorescence with ordinary least-squares (OLS) optimization. 
@@ -71,15 +79,418 @@ def ols_wall_plasma(profile_wall, profile_plasma, sigma_blur=1.5):
 ###------------------------------###
 ### MLE fitting of line-profiles ###
 
-def mle(x, y, func, p0, n_aver, alpha, sigma, minimize_options=None):
+def mle(x, y, func, p0, n_aver, alpha, sigma, minimize_options=None, jac=None, callback=None, dtype=None):
     """ 
     Fit a line-profile with MLE.
+    Uses analytic gradients if the derivatives of 'func' with respect to its parameters are known 
+    ('jac', by default func.jac or models.jacobian(func)); otherwise, the gradients are approximated with finite differences.
+    'callback'(p) is called after each iteration.
+    The model (in the precision of its coordinates, see quadrature.py) and the likelihood are evaluated in the precision 'dtype' 
+    (config.DTYPE by default; see misc.minimize_bfgs(...) for float32), and their sums in float64.
     """
-    def neg_loglike(p):
+    jac = getattr(func, 'jac', jacobian(func)) if jac is None else jac
+    name = model_name(func)
+    
+    @profiling.timed('track_vessel.neg_loglike')
+    def neg_loglike(p, dtype):
+        with profiling.stage('models.' + name):
+            e = func(np.asarray(x, dtype=dtype), *p)
+        
+        return pmt.nll_q_mean(y, e, alpha, sigma, n_aver, dtype=dtype) 
+
+    @profiling.timed('track_vessel.neg_loglike_grad')
+    def neg_loglike_grad(p, dtype):
+        x_dtype = np.asarray(x, dtype=dtype)
+        with profiling.stage('models.' + name):
+            e = func(x_dtype, *p)
+        dnll_de = np.asarray(np.ravel(pmt.nll_q_mean_de(y, e, alpha, sigma, n_aver, dtype=dtype)), dtype=float)
+        with profiling.stage('models.' + name + '_jac'):
+            J = np.asarray(np.reshape(jac(x_dtype, *p), (len(p), -1)), dtype=float)
+        
+        return pmt.nll_q_mean(y, e, alpha, sigma, n_aver, dtype=dtype), J @ dnll_de
+
+    return minimize_bfgs(neg_loglike if jac is None else neg_loglike_grad, 
+                         p0,
+                         jac=jac is not None, 
+                         dtype=config.get_dtype(dtype),
+                         callback=callback,
+                         options=minimize_options, 
+                         model=name)
+
+
+###-------------------------------------------------------------###
+### Joint MLE fitting of many line-profiles ("ultimate fit")    ###
+
+def _multi_terms(x, y, func, shared, scans, n_aver, alpha, sigma, chunk_size, derivatives=True):
+    """ 
+    Negative log-likelihood of an ultimate-fit model and, optionally, its gradient and expected Fisher information,
+    split into blocks of the shared parameters and of the parameters of each line-scan.
+    Line-scans are evaluated together, in chunks of 'chunk_size'.
+    """
+    n, (n_shared, n_block) = len(scans), (len(shared), scans.shape[1])
+    
+    nll = 0
+    g_shared, A = np.zeros(n_shared), np.zeros((n_shared, n_shared))
+    g_scans, B, D = np.zeros((n, n_block)), np.zeros((n, n_shared, n_block)), np.zeros((n, n_block, n_block))
+    
+    for i in range(0, n, chunk_size):
+        chunk = slice(i, i + chunk_size)
+        pars = scans[chunk].T.ravel()
+        e = func(x, *shared, *pars)
+        nll += pmt.nll_q_mean(y[chunk], e, alpha, sigma, n_aver[chunk])
+        
+        if derivatives:
+            m = len(scans[chunk])
+            J_shared, J_scans = [np.reshape(J, (len(J), m, -1)) for J in jacobian(func, BLOCK_JACOBIANS)(x, *shared, *pars)]
+            de = np.reshape(pmt.nll_q_mean_de(y[chunk], e, alpha, sigma, n_aver[chunk]), (m, -1))
+            w = np.reshape(np.where(np.isnan(y[chunk]), 0, pmt.fisher_q_mean(e, alpha, sigma, n_aver[chunk])), (m, -1))
+            
+            g_shared += np.einsum('sip,ip->s', J_shared, de)
+            g_scans[chunk] = np.einsum('bip,ip->ib', J_scans, de)
+            A += np.einsum('sip,ip,tip->st', J_shared, w, J_shared, optimize=True)
+            B[chunk] = np.einsum('sip,ip,bip->isb', J_shared, w, J_scans, optimize=True)
+            D[chunk] = np.einsum('bip,ip,cip->ibc', J_scans, w, J_scans, optimize=True)
+    
+    return nll, g_shared, g_scans, A, B, D
+
+
+def _schur_solve(g_shared, g_scans, A, B, D, damping):
+    """ 
+    Solve the block-arrow system [[A, B], [B^T, D]] [d_shared, d_scans] = -[g_shared, g_scans] 
+    (D is block-diagonal, one block per line-scan) with the Schur complement of D,
+    after Levenberg-Marquardt damping of the diagonals.
+    """
+    A = A + damping*np.diag(np.diag(A))
+    D_diag = np.einsum('ibb->ib', D)
+    D = D + np.einsum('ib,bc->ibc', damping*D_diag + 1e-12*D_diag.max(), np.eye(D.shape[1]))
+    
+    D_inv = np.linalg.inv(D)
+    BD_inv = B @ D_inv
+    S = A - np.einsum('isb,itb->st', BD_inv, B)
+    
+    d_shared = np.linalg.solve(S, -g_shared + np.einsum('isb,ib->s', BD_inv, g_scans))
+    d_scans = -np.einsum('ibc,ic->ib', D_inv, g_scans + np.einsum('isb,s->ib', B, d_shared))
+    
+    return d_shared, d_scans, S, D_inv, BD_inv
+
+
+def _multi_cov(S, D_inv, BD_inv):
+    """ 
+    Sparse covariance matrix of the parameters of an ultimate-fit model (inverse of the Fisher information), 
+    with the parameters ordered as in the model's signature. Covariances between parameters of different line-scans are omitted.
+    """
+    from scipy.sparse import coo_matrix
+    
+    (n, n_shared, n_block) = BD_inv.shape
+    
+    S_inv = np.linalg.inv(S)
+    C_shared_scans = -S_inv @ BD_inv
+    C_scans = D_inv + np.einsum('isb,st,itc->ibc', BD_inv, S_inv, BD_inv)
+    
+    shared = np.arange(n_shared)
+    scans = n_shared + np.arange(n_block)*n + np.arange(n)[:, np.newaxis]
+    
+    blocks = [(shared[:, np.newaxis], shared, S_inv), 
+              (shared[:, np.newaxis], scans[:, np.newaxis, :], C_shared_scans), 
+              (scans[:, :, np.newaxis], shared, np.swapaxes(C_shared_scans, 1, 2)), 
+              (scans[:, :, np.newaxis], scans[:, np.newaxis, :], C_scans)]
+    rows, cols, data = [np.concatenate([np.broadcast_to(block[k], block[2].shape).ravel() for block in blocks]) for k in range(3)]
+    
+    n_par = n_shared + n*n_block
+    return coo_matrix((data, (rows, cols)), shape=(n_par, n_par)).tocsr()
+
+
+def mle_multi(x, y, func, p0, n_aver, alpha, sigma, chunk_size=256, minimize_options=None):
+    """ 
+    Joint MLE fit of many line-profiles (first axis of 'y') with an ultimate-fit model, L_multi, L_multi_wall, or L_multi_plasma.
+    Exploits the structure of the problem, a few parameters shared by all line-profiles plus independent parameters of each line-profile:
+    Levenberg-Marquardt iterations with the expected Fisher information are solved with the Schur complement of the 
+    block-diagonal part, so that time and memory grow linearly with the number of line-profiles. 
+    The line-profiles are evaluated together in chunks of 'chunk_size'.
+    'minimize_options' accepts 'gtol' (maximal gradient, default 1e-5), 'ftol' (relative change of the objective, default 1e-10), and 'maxiter' (default 200).
+    Returns an OptimizeResult like mle(...); its hess_inv is the sparse inverse Fisher information.
+    """
+    options = {'gtol': 1e-5, 'ftol': 1e-10, 'maxiter': 200, **(minimize_options or {})}
+    
+    y = np.asarray(y)
+    n = len(y)
+    n_aver = np.broadcast_to(n_aver, y.shape)
+    n_shared = len(model_params(func))
+    
+    shared, scans = np.asarray(p0[:n_shared], dtype=float), np.reshape(np.asarray(p0[n_shared:], dtype=float), (-1, n)).T
+    
+    terms = _multi_terms(x, y, func, shared, scans, n_aver, alpha, sigma, chunk_size)
+    damping, nfev, message = 1e-3, 1, 'Maximum number of iterations has been exceeded.'
+    
+    for nit in range(1, options['maxiter'] + 1):
+        nll, g_shared, g_scans = terms[:3]
+        if max(np.abs(g_shared).max(initial=0), np.abs(g_scans).max(initial=0)) < options['gtol']:
+            message = 'Optimization terminated successfully.'
+            break
+        
+        d_shared, d_scans = _schur_solve(*terms[1:], damping)[:2]
+        nll_new = _multi_terms(x, y, func, shared + d_shared, scans + d_scans, n_aver, alpha, sigma, chunk_size, derivatives=False)[0]
+        nfev += 1
+        
+        if nll_new < nll:
+            shared, scans, damping = shared + d_shared, scans + d_scans, max(damping/3, 1e-9)
+            terms = _multi_terms(x, y, func, shared, scans, n_aver, alpha, sigma, chunk_size)
+            nfev += 1
+            if nll - nll_new < options['ftol']*max(abs(nll), 1):
+                message = 'Optimization terminated successfully.'
+                break
+        else:
+            damping *= 4
+            if damping > 1e12:
+                message = 'Desired error not necessarily achieved due to precision loss.'
+                break
+    
+    nll, g_shared, g_scans = terms[:3]
+    S, D_inv, BD_inv = _schur_solve(*terms[1:], 0)[2:]
+    
+    return OptimizeResult(x=np.concatenate([shared, scans.T.ravel()]), 
+                          fun=nll, 
+                          jac=np.concatenate([g_shared, g_scans.T.ravel()]), 
+                          hess_inv=_multi_cov(S, D_inv, BD_inv), 
+                          nit=nit, 
+                          nfev=nfev, 
+                          success=message.startswith('Optimization terminated'), 
+                          message=message)
+
+
+###-------------------------------------###
+### Tracking vessels through a kymogram ###
+
+def model_name(func):
+    """ 
+    Name of a model of line-profiles, e.g. 'L_plasma_no_glx' for ReducedModel(L_plasma_no_glx, ...).
+    """
+    func = getattr(func, 'func', func)
+    
+    return getattr(func, '__name__', type(func).__name__)
+
+
+def model_params(func):
+    """ 
+    Names of the parameters of a model of line-profiles, func(x, *params).
+    """
+    return [name for name, par in list(inspect.signature(func).parameters.items())[1:] 
+            if par.kind == par.POSITIONAL_OR_KEYWORD and par.default is par.empty]
+
+
+class ReducedModel:
+    """ 
+    Model of line-profiles, func(x, *params), with some of its parameters fixed to the values in 'fixed_params' 
+    (e.g. the PSF parameters from the calibration). 
+    Unlike a lambda, it can be sent to worker processes and provides the derivatives with respect to the free parameters.
+    """
+    def __init__(self, func, fixed_params):
+        self.func, self.fixed_params = func, dict(fixed_params)
+        self.names = model_params(func)
+        self.free = [name for name in self.names if name not in self.fixed_params]
+        self._free_index = [self.names.index(name) for name in self.free]
+        self._func_jac = getattr(func, 'jac', jacobian(func))
+        if self._func_jac is None:
+            self.jac = None
+
+    def params(self, p):
+        """ 
+        All parameters of 'func' given the free parameters 'p'.
+        """
+        free = dict(zip(self.free, p))
+        return [free[name] if name in free else self.fixed_params[name] for name in self.names]
+
+    def __call__(self, x, *p):
+        return self.func(x, *self.params(p))
+
+    def jac(self, x, *p):
+        return self._func_jac(x, *self.params(p))[self._free_index]
+
+
+def _fit_rows(x, rows, model, p0, n_aver, alpha, sigma, minimize_options, dtype=None):
+    """ 
+    Fit consecutive line-profiles with MLE, starting each fit from the solution for the previous line-profile.
+    'n_aver' is the same for all line-profiles, or given for each one (an array with the shape of 'rows').
+    """
+    fits = np.zeros((len(rows), 2*len(p0) + 3))
+    p = p0
+    for i, y in enumerate(rows):
+        res = mle(x, y, model, p, n_aver[i] if np.ndim(n_aver) == np.ndim(rows) else n_aver, alpha, sigma, 
+                  minimize_options=minimize_options, dtype=dtype)
+        fits[i] = [*res.x, *np.sqrt(np.diag(res.hess_inv)), res.fun, res.success, res.nit]
+        p = res.x if res.success else p
+        
+    return fits
+
+
+def track_kymogram(kymogram, model, fixed_params, p0, n_aver, alpha, sigma, x=None, chunk_size=256, workers=None, minimize_options=None, cache=None, 
+                   dtype=None, threads=False):
+    """ 
+    Fit every line-profile (first axis) of a kymogram with MLE, e.g. to track a vessel's center and radius in time.
+    'model' is fitted with its parameters in 'fixed_params' (dict) fixed; 'p0' is the initial guess for the remaining free parameters.
+    'n_aver' is the number of PMT outputs averaged in each pixel: one number, or an array with the shape of the kymogram 
+    (e.g. the counts from preprocess.profiles(...)).
+    Rows are fitted in chunks of 'chunk_size' by a pool of 'workers' processes (all CPUs by default, no pool if workers=1),
+    or threads with 'threads' (with the compiled kernels, which release the GIL, see kernels.py);
+    within a chunk, each fit starts from the solution for the previous row.
+    With a 'cache' (cache.ResultCache), the results of chunks fitted before with the same rows, model, fixed parameters and options are reused.
+    The fits are computed in the precision 'dtype' (config.DTYPE by default, see mle(...)).
+    Within profiling.profile(), the worker processes are profiled too, with the fits indexed by row.
+    Returns a structured array with the fitted free parameters, their error bars ('<name>_err'), 
+    the negative log-likelihood ('nll'), convergence flags ('success'), and numbers of iterations ('nit') for each row.
+    """
+    model = ReducedModel(model, fixed_params)
+    x = np.arange(np.shape(kymogram)[-1]) if x is None else x
+    p0 = np.asarray([p0[name] for name in model.free] if isinstance(p0, dict) else p0, dtype=float)
+    
+    args = (alpha, sigma, minimize_options, config.get_dtype(dtype))
+    starts = range(0, len(kymogram), chunk_size)
+    per_row = np.ndim(n_aver) == np.ndim(kymogram)
+    
+    def chunk(i):
+        return (x, np.asarray(kymogram[i: i + chunk_size]), model, p0, np.asarray(n_aver[i: i + chunk_size]) if per_row else n_aver, *args)
+    
+    profile = profiling.enabled()
+    if workers == 1:
+        fits = [profiling.collect(profiling.run(profile, cached_call, cache, _fit_rows, *chunk(i)), start=i) for i in starts]
+    else:
+        with (ThreadPoolExecutor if threads else ProcessPoolExecutor)(max_workers=workers) as pool:
+            futures = [pool.submit(profiling.run, profile, cached_call, cache, _fit_rows, *chunk(i)) for i in starts]
+            fits = [profiling.collect(future.result(), start=i) for i, future in zip(starts, futures)]
+    fits = np.vstack(fits) if fits else np.zeros((0, 2*len(p0) + 3))
+    
+    result = np.zeros(len(fits), dtype=fit_dtype(model.free))
+    for field, column in zip(result.dtype.names, fits.T):
+        result[field] = column
+    
+    return result
+
+
+###---------------------------------------------###
+### Online tracking of streaming line-profiles  ###
+
+# OLS estimates of the vessel's center and radii, used when a fit exceeds its latency budget:
+# model: (OLS fit of a line-profile, {name of a parameter of the model: index of its estimate in the output of the OLS fit})
+OLS_FALLBACKS = {
+    L_plasma_no_glx: (ols_plasma, {'xc': 0, 'R_lum': 3}),
+    L_plasma: (ols_plasma, {'xc': 0, 'R_lum': 3}),
+    L_wall: (ols_wall, {'xc': 0, 'R_wall': 3}),
+    L_wall_plasma: (lambda y: ols_wall_plasma(*y), {'xc': 0, 'R_lum': 3, 'R_wall': 4}),
+}
+
+
+class _BudgetExceeded(Exception):
+    pass
+
+
+class StreamingTracker:
+    """ 
+    Online MLE tracking of a vessel in line-profiles arriving one at a time, e.g. from the acquisition (see track(...) and atrack(...)).
+    'model', 'fixed_params', 'p0', 'n_aver', 'alpha', 'sigma' and 'x' are as in track_kymogram(...).
+    Each fit starts from the state estimate of a Kalman filter of the free parameters, modelled as random walks with the STDs 
+    of their steps per line-profile in 'process_noise' (dict; for the parameters not in it, the error bars of the last fit).
+    A fit is stopped once it takes longer than 'budget' seconds (no limit if None): then, the vessel's center and radii are estimated 
+    by the OLS fit in OLS_FALLBACKS for 'model' (or 'fallback'(x, y), a dict of parameters, if given), and the other parameters by the state estimate.
+    """
+    def __init__(self, model, fixed_params, p0, n_aver, alpha, sigma, x=None, budget=None, process_noise=None, fallback=None, minimize_options=None):
+        self.model = ReducedModel(model, fixed_params)
+        self.n_aver, self.alpha, self.sigma, self.x = n_aver, alpha, sigma, x
+        self.budget, self.minimize_options = budget, minimize_options
+        self.process_noise = dict(process_noise or {})
+        self.fallback = fallback if fallback is not None else self._ols_fallback(model)
+        
+        self.state = np.asarray([p0[name] for name in self.model.free] if isinstance(p0, dict) else p0, dtype=float)
+        self.state_var = np.full(len(self.state), np.inf)
+        self._step_var = np.full(len(self.state), np.inf)
+        
+        self.dtype = np.dtype(fit_dtype(self.model.free).descr + [(name + '_filtered', float) for name in self.model.free] + 
+                              [('latency', float), ('fallback', bool)])
+
+    @staticmethod
+    def _ols_fallback(model):
+        if model not in OLS_FALLBACKS:
+            return None
+        ols, index = OLS_FALLBACKS[model]
+        
+        def fallback(x, y):
+            # OLS fits are in pixels
+            p = ols(y)
+            params = {name: p[i] for name, i in index.items()}
+            params['xc'] = np.interp(params['xc'], np.arange(len(x)), x)
+            return {name: val*(x[-1] - x[0])/(len(x) - 1) if name.startswith('R_') else val for name, val in params.items()}
+        
+        return fallback
+    
+    def _fit(self, x, y, n_aver, start):
+        """ 
+        MLE fit from the state estimate, stopped when over the budget. Returns the parameters, their error bars, nll, success, nit, and whether it was stopped.
+        """
+        iterates = [self.state]
+        
+        def callback(p):
+            iterates.append(np.copy(p))
+            if self.budget is not None and time.perf_counter() - start > self.budget:
+                raise _BudgetExceeded
+        
+        try:
+            res = mle(x, y, self.model, self.state, n_aver, self.alpha, self.sigma, minimize_options=self.minimize_options, callback=callback)
+        except _BudgetExceeded:
+            return iterates[-1], np.full(len(self.state), np.nan), np.nan, False, len(iterates) - 1, True
+        
+        return res.x, np.sqrt(np.diag(res.hess_inv)), res.fun, res.success, res.nit, False
+    
+    def update(self, y, n_aver=None):
+        """ 
+        Fit the line-profile 'y', averaged over 'n_aver' PMT outputs (self.n_aver by default; or per pixel), and update the state estimate. Returns the result as a record of self.dtype, with the fitted parameters 
+        and their error bars (NaN for fallback estimates), the state estimates ('<name>_filtered'), and the time spent ('latency', s).
+        """
+        start = time.perf_counter()
+        y = np.asarray(y, dtype=float)
+        x = np.arange(np.shape(y)[-1]) if self.x is None else np.asarray(self.x)
+        
+        n_aver = self.n_aver if n_aver is None else n_aver
+        p, err, nll, success, nit, stopped = self._fit(x, y, n_aver, start)
+        
+        # Kalman filter: prediction, then update with the fit unless it was stopped
+        step_var = np.array([self.process_noise[name]**2 if name in self.process_noise else var for name, var in zip(self.model.free, self._step_var)])
+        var = self.state_var + step_var
+        if not stopped:
+            self._step_var = err**2
+            gain = 1/(1 + err**2/var)
+            self.state = self.state + gain*(p - self.state)
+            self.state_var = gain*err**2
+        else:
+            self.state_var = var
+            if self.fallback is not None:
+                try:
+                    estimates = self.fallback(x, y)
+                    p = np.array([estimates.get(name, val) for name, val in zip(self.model.free, self.state)])
+                except (RuntimeError, ValueError):
+                    # the OLS fit failed too
+                    p = self.state
+            nll = pmt.nll_q_mean(y, self.model(x, *p), self.alpha, self.sigma, n_aver)
+        
+        record = np.zeros((), dtype=self.dtype)
+        for field, val in zip(self.dtype.names, [*p, *err, nll, success, nit, *self.state]):
+            record[field] = val
+        record['fallback'] = stopped
+        record['latency'] = time.perf_counter() - start
+        
+        return record
 
-        return pmt.nll_q_mean(y, func(x, *p), alpha, sigma, n_aver) 
+    def track(self, profiles):
+        """ 
+        Fit the line-profiles of an iterable (e.g. a generator reading them from the acquisition) as they arrive; yields records of self.dtype.
+        """
+        for y in profiles:
+            yield self.update(y)
 
-    return minimize(neg_loglike, 
-                    p0,
-                    method='bfgs', 
-                    options=minimize_options)
+    async def atrack(self, profiles):
+        """ 
+        Like track(...), for an async iterable of line-profiles; fits run in a worker thread so that the event loop 
+        (e.g. the acquisition) is not blocked.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        async for y in profiles:
+            yield await loop.run_in_executor(None, self.update, y)
@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+from sl2pm import bistable_bias
+
+
+P = dict(t0=0.00072, w=0.00052, tau1=1.1e-4, tau2=2.6e-5, dI1=4.6, dI2=14.6, I0=176.6)
+DT = 0.00331
+
+
+class TestBistableBias(unittest.TestCase):
+    def test_step_diff_periodic(self):
+        t = np.linspace(0, 5*DT, 5000)
+        starts = np.arange(P['t0'] - 10*DT, t[-1] + DT, DT)
+        args = [P[name] for name in ['w', 'tau1', 'tau2', 'dI1', 'dI2']]
+        expected = sum(bistable_bias.step_diff(t - start, *args) for start in starts)
+        np.testing.assert_allclose(bistable_bias.step_diff_periodic(t, P['t0'], *args, DT), expected, atol=1e-10)
+
+    def test_fit_batch(self):
+        rng = np.random.default_rng(0)
+        t = np.linspace(0, DT, 1000, endpoint=False)
+        traces = bistable_bias.bb_single(t, *P.values(), dt=DT) + rng.normal(0, 0.3, (4, len(t)))
+        p0 = dict(P, t0=0.0007, tau1=5e-5, tau2=2e-5, dI1=5.8, dI2=13.5)
+        
+        fits = bistable_bias.fit_batch(t, traces, p0, DT)
+        self.assertTrue(fits['success'].all())
+        for name in ['t0', 'w', 'I0']:
+            np.testing.assert_allclose(fits[name], P[name], atol=5*fits[name + '_err'].max())
+        
+        corrected = np.concatenate(list(bistable_bias.correct(np.array_split(traces[0], 3), fits[0], DT, t[1] - t[0])))
+        np.testing.assert_allclose(corrected.mean(), P['I0'], atol=0.05)
+        self.assertLess(corrected.std(), 0.35)
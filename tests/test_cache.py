@@ -0,0 +1,74 @@
+import functools
+import os
+import tempfile
+import time
+import unittest
+import numpy as np
+from sl2pm import cache, config, kernels, simulate, track_vessel
+from sl2pm.models import L_plasma_no_glx, L_wall
+
+
+class TestCache(unittest.TestCase):
+    def test_result_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            results = cache.ResultCache(directory, max_bytes=3*(128 + 8*8))
+            keys = [cache.key(np.arange(8) + i, L_plasma_no_glx, dict(s_xy=1.5), (0.45, 6.0, 0)) for i in range(4)]
+            self.assertEqual(len(set(keys)), 4)
+            self.assertEqual(keys[0], cache.key(np.arange(8), L_plasma_no_glx, dict(s_xy=1.5), (0.45, 6.0, 0)))
+            self.assertNotEqual(keys[0], cache.key(np.arange(8.0), L_plasma_no_glx, dict(s_xy=1.5), (0.45, 6.0, 0)))
+
+            for i, k in enumerate(keys[:3]):
+                results.put(k, np.full(8, i, dtype=float))
+                os.utime(os.path.join(directory, k + '.npy'), (i, i))
+            self.assertIsNotNone(results.get(keys[0]))
+            results.put(keys[3], np.full(8, 3, dtype=float))
+            self.assertNotIn(keys[1], results)
+            self.assertEqual(len(results), 3)
+            np.testing.assert_array_equal(results.get(keys[0]), 0)
+            self.assertEqual(os.listdir(directory).count(keys[3] + '.npy'), 1)
+
+    def test_track_kymogram(self):
+        x = np.arange(48.0)
+        kymogram = simulate.vessel_kymogram(x, L_plasma_no_glx, dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=np.full(8, 10.0), I=10.0, b=1.0), 10, (0.45, 6.0, 0), rng=0)
+        args = (L_plasma_no_glx, dict(s_xy=1.5, l=4.0), dict(xc=23.0, R_lum=9.0, I=9.0, b=1.2), 10, 0.45, 6.0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            results = cache.ResultCache(directory)
+            fits = track_vessel.track_kymogram(kymogram, *args, chunk_size=4, workers=1, cache=results)
+            self.assertEqual(len(results), 2)
+            np.testing.assert_array_equal(track_vessel.track_kymogram(kymogram, *args, chunk_size=4, workers=1, cache=results), fits)
+
+            kymogram[5] += 1
+            refits = track_vessel.track_kymogram(kymogram, *args, chunk_size=4, workers=1, cache=results)
+            self.assertEqual(len(results), 3)
+            np.testing.assert_array_equal(refits[:4], fits[:4])
+
+    def test_environment(self):
+        # results cached with another version of the package, backend or precision are not reused
+        parts = (np.arange(8), L_plasma_no_glx, dict(s_xy=1.5))
+        k = cache.key(*parts)
+        version, backend = cache.VERSION, kernels.BACKEND
+        try:
+            cache.VERSION = version + '.post1'
+            self.assertNotEqual(cache.key(*parts), k)
+            cache.VERSION, kernels.BACKEND = version, 'numba' if backend == 'numpy' else 'numpy'
+            self.assertNotEqual(cache.key(*parts), k)
+        finally:
+            cache.VERSION, kernels.BACKEND = version, backend
+        with config.precision(np.float32):
+            self.assertNotEqual(cache.key(*parts), k)
+        self.assertEqual(cache.key(*parts), k)
+
+    def test_callables(self):
+        # partial models and closures are told apart by what they wrap and capture
+        partials = [functools.partial(L_wall, n_phi=64), functools.partial(L_plasma_no_glx, n_r=16), functools.partial(L_plasma_no_glx, n_r=32)]
+        self.assertEqual(len({cache.key(model) for model in partials}), 3)
+        self.assertEqual(cache.key(functools.partial(L_wall, n_phi=64)), cache.key(partials[0]))
+
+        def scaled(scale):
+            return lambda x: scale*x
+
+        self.assertNotEqual(cache.key(scaled(1.0)), cache.key(scaled(2.0)))
+        self.assertEqual(cache.key(scaled(1.0)), cache.key(scaled(1.0)))
+        with self.assertRaises(TypeError):
+            cache.key(object())
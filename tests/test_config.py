@@ -0,0 +1,37 @@
+import unittest
+import warnings
+import numpy as np
+from sl2pm import config, pmt, simulate, track_vessel
+from sl2pm.models import L_plasma_no_glx
+
+
+class TestConfig(unittest.TestCase):
+    def test_dtype(self):
+        self.assertEqual(config.get_dtype(), np.float64)
+        with config.precision(np.float32):
+            self.assertEqual(config.get_dtype(), np.float32)
+            self.assertEqual(config.get_dtype('float64'), np.float64)
+        self.assertEqual(config.get_dtype(), np.float64)
+        with self.assertRaises(ValueError):
+            config.set_dtype(np.float16)
+
+    def test_q(self):
+        s, e = np.linspace(-20, 400, 64), np.array([0.5, 5.0, 40.0])
+        q64 = pmt.q(s[:, np.newaxis], e, 0.452, 0, 6.0)
+        q32 = pmt.q(s[:, np.newaxis], e, 0.452, 0, 6.0, dtype=np.float32)
+        self.assertEqual(q32.dtype, np.float64)
+        np.testing.assert_allclose(q32, q64, rtol=1e-4, atol=1e-6*q64.max())
+
+    def test_mle(self):
+        x = np.arange(48.0)
+        y = simulate.vessel_kymogram(x, L_plasma_no_glx, dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=np.full(1, 10.0), I=10.0, b=1.0),
+                                     10, (0.452, 6.0, 0), rng=np.random.default_rng(0))[0]
+        model = track_vessel.ReducedModel(L_plasma_no_glx, dict(s_xy=1.5, l=4.0))
+        p0 = [25.0, 10.5, 10.5, 1.05]
+        # the variance of the PMT output is clamped in line searches through negative expected photon counts, without warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            fit64 = track_vessel.mle(x, y, model, p0, 10, 0.452, 6.0)
+            fit32 = track_vessel.mle(x, y, model, p0, 10, 0.452, 6.0, dtype=np.float32)
+        self.assertTrue(fit32.success)
+        np.testing.assert_allclose(fit32.x, fit64.x, atol=1e-2*np.sqrt(np.diag(fit64.hess_inv)).max())
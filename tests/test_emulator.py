@@ -0,0 +1,33 @@
+import pickle
+import unittest
+from functools import partial
+import numpy as np
+from sl2pm import emulator, track_vessel
+from sl2pm.models import L_plasma_no_glx
+
+
+class TestProfileEmulator(unittest.TestCase):
+    emu = emulator.ProfileEmulator(2.4, 3.0, (8, 16), s_gcx=0.8)
+    x = np.arange(-25.0, 25.0)
+
+    def test_max_error(self):
+        for name, error in self.emu.max_error(n_samples=16).items():
+            self.assertLess(error, 1e-4, name)
+
+    def test_jacobians(self):
+        for name, p in [('L_plasma_no_glx', [0.3, 12.0, 10.0, 1.0]), 
+                        ('L_wall', [0.3, 12.0, 0.7, 10.0, 3.0, 1.0]), 
+                        ('L_plasma', [0.3, 11.0, 12.5, 10.0, 1.0])]:
+            model, p, h = self.emu.model(name), np.array(p), 1e-6
+            J_num = np.array([(model(self.x, *(p + h*dp)) - model(self.x, *(p - h*dp)))/(2*h) for dp in np.eye(len(p))])
+            np.testing.assert_allclose(model.jac(self.x, *p), J_num, atol=1e-6*np.abs(J_num).max())
+
+    def test_mle(self):
+        x, n_aver = np.arange(50.0), 10
+        e = L_plasma_no_glx(x, 25.3, 2.4, 3.0, 12.0, 30.0, 1.0)
+        y = 3/0.452*e + np.random.default_rng(0).normal(size=e.shape)*np.sqrt((4*e/0.452 + 36)/n_aver)
+        model = pickle.loads(pickle.dumps(self.emu.model('L_plasma_no_glx')))
+        res = track_vessel.mle(x - 25, y, model, [0.0, 11.0, 25.0, 2.0], n_aver, 0.452, 6.0)
+        res_exact = track_vessel.mle(x, y, track_vessel.ReducedModel(partial(L_plasma_no_glx, n_r=128, rule='tanh-sinh'), {'s_xy': 2.4, 'l': 3.0}), [25.0, 11.0, 25.0, 2.0], n_aver, 0.452, 6.0)
+
+        np.testing.assert_allclose(res.x + [25, 0, 0, 0], res_exact.x, atol=1e-3)
@@ -0,0 +1,25 @@
+import unittest
+import numpy as np
+from sl2pm import fisher, models, simulate, track_qd
+from sl2pm.pmt import Calibration
+
+
+class TestFisher(unittest.TestCase):
+    def test_photon_information(self):
+        e = np.geomspace(0.01, 300, 20)
+        info = fisher.photon_information(e, 0.45, 6.0)
+        self.assertTrue(np.all(info < 1/e))
+        np.testing.assert_allclose(info[-1]*e[-1], 0.75, rtol=0.01)
+
+    def test_crb(self):
+        X, Y = track_qd.xy_grid((14, 14))
+        calibration = Calibration(0.45, 6.0, 0)
+        p = np.array([[0.5, A, 7.2, 6.8, 1.5, 1.2, 0.3] for A in [100, 150, 200]])
+        bounds = fisher.precision(models.qd_blurred, (X, Y), p, calibration)
+        np.testing.assert_allclose(bounds[1], fisher.precision(models.qd_blurred, (X, Y), p[1], calibration)[0])
+        self.assertTrue(np.all(np.diff(bounds[:, 2]) < 0))
+
+        image = simulate.pmt_sample(models.qd_blurred(X, Y, *p[1]), *calibration, rng=0)
+        fit = track_qd.mle_fit(image, *calibration, p0=p[1], minimize_options=dict(gtol=1e-5))
+        observed = fisher.observed_errors(track_qd.neg_loglike_grad, [fit.x], [(image, *calibration, 5, 800)])
+        np.testing.assert_allclose(observed[0, 2:4], bounds[1, 2:4], rtol=0.25)
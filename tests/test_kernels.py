@@ -0,0 +1,95 @@
+import unittest
+import warnings
+import numpy as np
+from scipy.special import erfcx
+from sl2pm import kernels, models, pmt, profiling, simulate, track_vessel
+from sl2pm.models import L_plasma_no_glx
+from sl2pm.quadrature import quadrature
+
+
+class TestKernels(unittest.TestCase):
+    def setUp(self):
+        self.backend = kernels.BACKEND
+        kernels.set_backend('numpy')
+
+    def tearDown(self):
+        kernels.BACKEND = self.backend
+
+    def test_models(self):
+        # the kernels as plain Python, on few nodes
+        x, rule = np.linspace(-20, 20, 9), quadrature(16, 'gauss-legendre')
+        np.testing.assert_allclose(kernels._f_lumen(x, 1.5, 4.0, 10.0, rule.nodes, rule.weights),
+                                   models.F_lumen(x, 1.5, 4.0, 10.0, n_r=16, rule='gauss-legendre'), rtol=1e-12)
+        np.testing.assert_allclose(kernels._f_wall(x, 1.5, 4.0, 12.0, 0.5, np.i0(0.5), rule.nodes, rule.weights),
+                                   models.f_wall(x, 1.5, 4.0, 12.0, 0.5, n_phi=16, rule='gauss-legendre'), rtol=1e-12)
+        np.testing.assert_allclose(kernels._f_gcx(x, 1.5, 4.0, 10.0, 12.0, 0.7, rule.nodes, rule.weights),
+                                   models.F_gcx(x, 1.5, 4.0, 10.0, 12.0, 0.7, n_phi=16, rule='gauss-legendre'), rtol=1e-10)
+
+        y, x = [c.ravel().astype(float) for c in np.mgrid[:5, :5]]
+        p = (1.0, 50.0, 2.2, 1.8, 1.2, 0.9, 0.3)
+        np.testing.assert_allclose(kernels._qd_blurred(x, y, *p), models.qd_blurred(x, y, *p), rtol=1e-12)
+
+        z = np.r_[-3:30:0.7]
+        np.testing.assert_allclose([kernels._erfcx(v) for v in z], erfcx(z), rtol=1e-13)
+
+    def test_pmt(self):
+        s, e = np.array([-5.0, 3.0, 40.0, 120.0]), np.array([0.0, 0.5, 5.0, 20.0])
+        table = pmt.f_table(0.452, 5, 400)
+        n_max = table.n_max(e)
+        table._extend(n_max + 1)
+        q0, q1 = kernels._q(s, e, 6.0, table.s.astype(float), table.weights, table.g, n_max, True)
+        q, dq_de = pmt.q_grad(s, e, 0.452, 0, 6.0, delta_s=5, s_max=400)
+        np.testing.assert_allclose(q0, q, rtol=1e-10)
+        np.testing.assert_allclose(np.sign(e)*(q1 - q0), dq_de, rtol=1e-8, atol=1e-14)
+
+        s[1], n_aver = np.nan, np.array([10.0, 10.0, 9.0, 4.0])
+        self.assertAlmostEqual(kernels._nll_q_mean(s, e + 1, 0.452, 6.0, n_aver), pmt.nll_q_mean(s, e + 1, 0.452, 6.0, n_aver), places=10)
+        np.testing.assert_allclose(kernels._nll_q_mean_de(s, e + 1, 0.452, 6.0, np.array([10.0])), pmt.nll_q_mean_de(s, e + 1, 0.452, 6.0, 10),
+                                   rtol=1e-12)
+
+    def test_masked(self):
+        # masked pixels (no PMT outputs averaged, as from preprocess.profiles(...), or NaN outputs) do not contribute,
+        # without warnings from NumPy; without Numba, the 'numba' backend runs the kernels as plain Python,
+        # which raises ZeroDivisionError as njit does
+        s, e, n_aver = np.array([10.0, np.nan, 12.0, 11.0]), np.array([1.5, 1.5, 2.0, 1.8]), np.array([4.0, 0.0, 0.0, 3.0])
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            nll, nll_de = pmt.nll_q_mean(s, e, 0.452, 6.0, n_aver), pmt.nll_q_mean_de(s, e, 0.452, 6.0, n_aver)
+        
+        kernels.BACKEND = 'numba'
+        self.assertTrue(kernels.applies(s, 0.452, 6.0))
+        self.assertAlmostEqual(pmt.nll_q_mean(s, e, 0.452, 6.0, n_aver), nll, places=10)
+        np.testing.assert_allclose(pmt.nll_q_mean_de(s, e, 0.452, 6.0, n_aver), nll_de, rtol=1e-12)
+        
+        self.assertAlmostEqual(nll, kernels._nll_q_mean(s[[0, 3]], e[[0, 3]], 0.452, 6.0, n_aver[[0, 3]]), places=12)
+        np.testing.assert_array_equal(nll_de[1:3], 0)
+        np.testing.assert_allclose(nll_de[[0, 3]], kernels._nll_q_mean_de(s[[0, 3]], e[[0, 3]], 0.452, 6.0, n_aver[[0, 3]]), rtol=1e-12)
+
+    @unittest.skipUnless(kernels.numba, "Numba is not installed")
+    def test_backends(self):
+        x, s, e = np.linspace(-20, 20, 61), np.linspace(-20, 400, 64)[:, np.newaxis], np.array([0.5, 5.0, 40.0])
+        y, xx = np.mgrid[:9, :9]
+        evaluate = [lambda: models.L_plasma_no_glx(x, 0.5, 1.5, 4.0, 10.0, 10.0, 1.0),
+                    lambda: models.L_plasma(x, 0.5, 1.5, 4.0, 10.0, 12.0, 0.7, 10.0, 1.0),
+                    lambda: models.L_wall(x, 0.5, 1.5, 4.0, 12.0, 0.5, 10.0, 1.0, 0.5),
+                    lambda: models.qd_blurred(xx, y, 1.0, 50.0, 4.2, 3.8, 1.2, 0.9, 0.3),
+                    lambda: pmt.q_grad(s, e, 0.452, 0, 6.0),
+                    lambda: pmt.nll_q_mean(s, e, 0.452, 6.0, 10),
+                    lambda: pmt.nll_q_mean_de(s, np.broadcast_to(e, s.shape), 0.452, 6.0, 10)]
+
+        expected = [func() for func in evaluate]
+        kernels.set_backend('numba')
+        for func, value in zip(evaluate, expected):
+            np.testing.assert_allclose(func(), value, rtol=1e-9, atol=1e-300)
+
+    def test_threads(self):
+        x = np.arange(48.0)
+        params = dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=np.full(6, 10.0), I=10.0, b=1.0)
+        kymogram = simulate.vessel_kymogram(x, L_plasma_no_glx, params, 10, (0.452, 6.0, 0), rng=np.random.default_rng(0))
+        args = (L_plasma_no_glx, dict(s_xy=1.5, l=4.0), dict(xc=25.0, R_lum=10.5, I=10.5, b=1.05), 10, 0.452, 6.0)
+
+        fits = track_vessel.track_kymogram(kymogram, *args, chunk_size=2, workers=1)
+        with profiling.profile() as profile:
+            threaded = track_vessel.track_kymogram(kymogram, *args, chunk_size=2, workers=3, threads=True)
+        np.testing.assert_array_equal(threaded, fits)
+        self.assertEqual([fit['index'] for fit in profile.fits], list(range(6)))
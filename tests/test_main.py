@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+from sl2pm import __main__ as cli
+from sl2pm import simulate
+from sl2pm.models import L_plasma_no_glx, qd_blurred, rbc
+from sl2pm.pmt import Calibration
+from sl2pm.store import ResultStore
+
+
+def pmt_images(e, alpha, sigma, mu, shape, rng):
+    n = rng.poisson(e, shape)
+    return rng.gamma(np.maximum(3*n, 1e-12), 1/alpha)*(n > 0) + rng.normal(mu, sigma, shape)
+
+
+class TestCLI(unittest.TestCase):
+    def test_track_rbc(self):
+        rng = np.random.default_rng(1)
+        x = np.arange(60)
+        linescans = np.array([pmt_images(rbc(x, 0.5, 20.0, 3.0, xo), 0.45, 6.0, 0, len(x), rng) for xo in [20.0, 30.0, 40.0]])
+        with tempfile.TemporaryDirectory() as path:
+            np.save(os.path.join(path, 'linescans.npy'), linescans)
+            Calibration(0.45, 6.0, 0).save(os.path.join(path, 'calib.json'))
+            cli.main(['track-rbc', os.path.join(path, 'linescans.npy'), '-c', os.path.join(path, 'calib.json'), 
+                      '-o', os.path.join(path, 'rbc.npy'), '--workers', '1', '--profile', os.path.join(path, 'profile.json')])
+            fits = np.load(os.path.join(path, 'rbc.npy'))
+            with open(os.path.join(path, 'profile.json')) as file:
+                profile = json.load(file)
+
+            # resuming an interrupted run fits only the remaining line-scans
+            store = ResultStore(os.path.join(path, 'rbc.npy'))
+            store.truncate(0)
+            store.append(fits[:1])
+            cli.main(['track-rbc', os.path.join(path, 'linescans.npy'), '-c', os.path.join(path, 'calib.json'), 
+                      '-o', os.path.join(path, 'rbc.npy'), '--workers', '1', '--resume'])
+            np.testing.assert_array_equal(np.load(os.path.join(path, 'rbc.npy')), fits)
+
+        self.assertEqual([fit['index'] for fit in profile['fits']], [0, 1, 2])
+        self.assertEqual(fits.dtype.names[:4], ('b', 'A', 's', 'xo'))
+        np.testing.assert_allclose(fits['xo'], [20, 30, 40], atol=5*fits['xo_err'].max())
+
+    def test_calibrate(self):
+        rng = np.random.default_rng(2)
+        with tempfile.TemporaryDirectory() as path:
+            stacks = [os.path.join(path, f'stack_{e}.npy') for e in [0, 1, 2, 4, 8]]
+            for e, stack in zip([0, 1, 2, 4, 8], stacks):
+                np.save(stack, np.rint(pmt_images(e, 0.45, 6.0, 2.0, (16, 32, 32), rng)))
+            calib = os.path.join(path, 'calib.json')
+            cli.main(['calibrate-pmt', *stacks, '-c', calib])
+            np.testing.assert_allclose(Calibration.load(calib), [0.45, 6.0, 2.0], rtol=0.05, atol=0.2)
+
+            # the PSF from a kymogram streamed in blocks, and the wall and plasma kymograms stacked lazily
+            x = np.arange(48.0)
+            params = dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=np.full(400, 10.0), I=10.0, b=1.0)
+            np.save(os.path.join(path, 'plasma.npy'), simulate.vessel_kymogram(x, L_plasma_no_glx, params, 1, (0.45, 6.0, 0), rng=rng))
+            Calibration(0.45, 6.0, 0).save(calib)
+            cli.main(['calibrate-psf', os.path.join(path, 'plasma.npy'), '-c', calib, '--block-size', '64'])
+            with open(calib) as file:
+                psf = json.load(file)['psf']
+            self.assertEqual(psf['n_aver'], 400)
+            self.assertLess(abs(psf['params']['R_lum'] - 10.0), 5*psf['errors']['R_lum'])
+
+            kymograms = cli.load_kymogram([os.path.join(path, 'plasma.npy')]*2)
+            self.assertEqual((len(kymograms), kymograms[5:8].shape, kymograms[5].shape), (400, (3, 2, 48), (2, 48)))
+
+    def test_track_vessel(self):
+        x = np.arange(48.0)
+        params = dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=np.full(12, 10.0), I=10.0, b=1.0)
+        kymogram = simulate.vessel_kymogram(x, L_plasma_no_glx, params, 1, (0.45, 6.0, 0), rng=np.random.default_rng(3))
+        psf = dict(model='plasma', n_aver=1, params=dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=10.0, I=10.0, b=1.0))
+        with tempfile.TemporaryDirectory() as path:
+            np.save(os.path.join(path, 'plasma.npy'), kymogram)
+            Calibration(0.45, 6.0, 0).save(os.path.join(path, 'calib.json'))
+            cli.save_calibration(os.path.join(path, 'calib.json'), dict(psf=psf))
+            command = ['track-vessel', os.path.join(path, 'plasma.npy'), '-c', os.path.join(path, 'calib.json'), '-o', os.path.join(path, 'vessel.npy'), 
+                       '--workers', '1', '--n-aver', '3', '--block-size', '2', '--cache', os.path.join(path, 'cache')]
+            cli.main(command)
+            fits = np.load(os.path.join(path, 'vessel.npy'))
+            self.assertEqual(len(fits), 4)
+            self.assertEqual(len(os.listdir(os.path.join(path, 'cache'))), 2)
+
+            store = ResultStore(os.path.join(path, 'vessel.npy'))
+            store.truncate(0)
+            store.append(fits[:2])
+            cli.main(command + ['--resume'])
+            np.testing.assert_array_equal(np.load(os.path.join(path, 'vessel.npy')), fits)
+            # the resumed block starts from the last stored fit, as in the first run, and is read from the cache
+            self.assertEqual(len(os.listdir(os.path.join(path, 'cache'))), 2)
+        
+        self.assertEqual(fits.dtype.names[:2], ('xc', 'R_lum'))
+        self.assertTrue(fits['success'].all())
+
+    def test_track_qd(self):
+        rng = np.random.default_rng(4)
+        X, Y = np.meshgrid(range(14), range(12))
+        images = pmt_images(np.array([qd_blurred(X, Y, 0.5, 150, 6 + 0.1*k, 5, 1.5, 1.2, 0.3) for k in range(4)]), 0.45, 6.0, 0, (4, 12, 14), rng)
+        with tempfile.TemporaryDirectory() as path:
+            np.save(os.path.join(path, 'images.npy'), images)
+            Calibration(0.45, 6.0, 0).save(os.path.join(path, 'calib.json'))
+            command = ['track-qd', os.path.join(path, 'images.npy'), '-c', os.path.join(path, 'calib.json'), '-o', os.path.join(path, 'qd.npy'), 
+                       '--workers', '1', '--block-size', '2', '--cache', os.path.join(path, 'cache')]
+            cli.main(command)
+            fits = np.load(os.path.join(path, 'qd.npy'))
+
+            store = ResultStore(os.path.join(path, 'qd.npy'))
+            store.truncate(0)
+            store.append(fits[:2])
+            cli.main(command + ['--resume'])
+            np.testing.assert_array_equal(np.load(os.path.join(path, 'qd.npy')), fits)
+            # the resumed block was fitted before, and is read from the cache
+            self.assertEqual(len(os.listdir(os.path.join(path, 'cache'))), 2)
+
+        self.assertTrue(fits['success'].all())
+        np.testing.assert_allclose(fits['xo'], 6 + 0.1*np.arange(4), atol=5*fits['xo_err'].max())
@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+from functools import partial
+from sl2pm import models
+
+
+def central_diff(func, p, h=1e-6):
+    p = np.asarray(p, dtype=float)
+    return np.array([(func(*(p + h*dp)) - func(*(p - h*dp)))/(2*h) for dp in np.eye(len(p))])
+
+
+def f_wall_baseline(x_psf, s_xy, l, R_wall, a1, n_phi=256):
+    # f_wall(...) of release 1.0.1: the trapezoidal rule over [-pi, pi]
+    phi = np.linspace(-np.pi, np.pi, n_phi)[:, np.newaxis]
+    integrand = R_wall*np.exp(a1*np.cos(phi))/np.i0(a1)*models.gaussian(R_wall*np.cos(phi) - x_psf, s_xy)*models.laplace(R_wall*np.sin(phi), l)
+    return np.trapz(integrand, x=phi[:, 0], axis=0)
+
+
+class TestJacobians(unittest.TestCase):
+    x = np.linspace(-8, 8, 41)
+
+    def assert_jac(self, func, jac, p, *args, rtol=1e-6):
+        J = jac(*args, *p)
+        J_num = central_diff(lambda *p: func(*args, *p), p)
+        self.assertEqual(J.shape, J_num.shape)
+        np.testing.assert_allclose(J, J_num, atol=rtol*np.abs(J_num).max())
+
+    def test_qd_blurred(self):
+        X, Y = np.meshgrid(range(12), range(8))
+        self.assert_jac(models.qd_blurred, models.qd_blurred_jac, [1.0, 40.0, 5.3, 3.4, 1.2, 0.9, 0.3], X, Y)
+
+    def test_rbc(self):
+        x = np.arange(60.0)
+        self.assert_jac(models.rbc, models.rbc_jac, [2.0, 15.0, 7.0, 27.0], x)
+        self.assert_jac(models.rbc_inv, models.rbc_inv_jac, [2.0, 15.0, 7.0, 27.0], x)
+
+    def test_integrals(self):
+        for func, jac, p in [(models.F_lumen, models.F_lumen_jac, [1.2, 2.0, 4.0]), 
+                             (models.f_wall, models.f_wall_jac, [1.2, 2.0, 4.0, 0.7]), 
+                             (models.F_gcx, models.F_gcx_jac, [1.2, 2.0, 4.0, 4.6, 0.8])]:
+            self.assert_jac(lambda dx, *p: func(self.x + dx, *p), lambda dx, *p: jac(self.x + dx, *p), [0.3, *p])
+
+    def test_vessel_models(self):
+        self.assert_jac(models.L_plasma, models.L_plasma_jac, [0.3, 1.2, 2.0, 4.0, 4.6, 0.8, 10.0, 1.0], self.x)
+        self.assert_jac(models.L_plasma_no_glx, models.L_plasma_no_glx_jac, [0.3, 1.2, 2.0, 4.0, 10.0, 1.0], self.x)
+        self.assert_jac(models.L_wall, models.L_wall_jac, [0.3, 1.2, 2.0, 4.0, 0.7, 10.0, 3.0, 1.0], self.x)
+        self.assert_jac(models.L_wall_plasma, models.L_wall_plasma_jac, [0.3, 1.2, 2.0, 4.0, 4.6, 0.8, 0.7, 10.0, 12.0, 3.0, 1.0, 1.5], self.x)
+
+    def test_ultimate_fit_models(self):
+        self.assert_jac(models.L_multi, models.L_multi_jac, 
+                        [1.2, 2.0, 0.6, 0.8, 3.0, 1.0, 1.5, 10.0, 11.0, 12.0, 13.0, 4.6, 4.8, 0.3, -0.2, 0.7, 0.5], self.x)
+        self.assert_jac(models.L_multi_wall, models.L_multi_wall_jac, [1.2, 2.0, 3.0, 1.0, 10.0, 11.0, 4.6, 4.8, 0.3, -0.2, 0.7, 0.5], self.x)
+        self.assert_jac(models.L_multi_plasma, models.L_multi_plasma_jac, [1.2, 2.0, 1.0, 10.0, 11.0, 4.6, 4.8, 0.3, -0.2], self.x)
+
+    def test_quadrature_rules(self):
+        for rule in ['gauss-legendre', 'tanh-sinh']:
+            model = partial(models.L_wall_plasma, n_r=64, n_phi=64, rule=rule)
+            p = [0.3, 1.2, 2.0, 4.0, 4.6, 0.8, 0.7, 10.0, 12.0, 3.0, 1.0, 1.5]
+            np.testing.assert_allclose(model(self.x, *p), models.L_wall_plasma(self.x, *p, n_r=2048, n_phi=2048, rule='tanh-sinh'), rtol=1e-4)
+            self.assert_jac(model, models.jacobian(model), p, self.x)
+
+
+class TestQuadrature(unittest.TestCase):
+    def test_defaults(self):
+        # the default Gauss-Legendre rules against the trapezoidal rules with 256 nodes of release 1.0.1 (the same nodes
+        # for F_lumen and F_gcx) and against the converged integrals
+        x = np.linspace(-30, 30, 121)
+        for func, baseline, p, n_key in [(models.F_lumen, partial(models.F_lumen, n_r=256, rule='trapz'), [1.5, 4.0, 10.0], 'n_r'), 
+                                         (models.f_wall, f_wall_baseline, [1.5, 4.0, 10.0, 0.7], 'n_phi'), 
+                                         (models.F_gcx, partial(models.F_gcx, n_phi=256, rule='trapz'), [1.5, 4.0, 10.0, 11.0, 0.8], 'n_phi')]:
+            value, exact = func(x, *p), func(x, *p, **{n_key: 2048, 'rule': 'tanh-sinh'})
+            np.testing.assert_allclose(value, baseline(x, *p), atol=2e-3*np.max(exact))
+            np.testing.assert_allclose(value, exact, atol=1e-5*np.max(exact))
+            self.assertLess(np.max(np.abs(value - exact)), np.max(np.abs(baseline(x, *p) - exact)))
@@ -0,0 +1,15 @@
+import subprocess
+import sys
+import unittest
+
+
+class TestPackage(unittest.TestCase):
+    def test_lazy_imports(self):
+        probe = "import sys, sl2pm.models; print(int('mpmath' in sys.modules), int('scipy.optimize' in sys.modules), int('sl2pm.track_qd' in sys.modules))"
+        self.assertEqual(subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True).stdout.split(), ['0', '0', '0'])
+
+        import sl2pm
+        self.assertIs(sl2pm.track_qd, sys.modules['sl2pm.track_qd'])
+        self.assertTrue(set(sl2pm.__all__) <= set(dir(sl2pm)))
+        with self.assertRaises(AttributeError):
+            sl2pm.not_a_module
@@ -1,5 +1,8 @@
+import os
+import tempfile
 import unittest
-from sl2pm.pmt import gain, pmt_output
+import numpy as np
+from sl2pm.pmt import gain, pmt_output, f, f_table, q, q_grad, NLLTable, nll_q_mean, nll_q_mean_de, Calibration, calibrate
 
 
 class TestPMT(unittest.TestCase):
@@ -14,3 +17,71 @@ class TestPMT(unittest.TestCase):
         self.assertEqual(pmt_output(4, 3), 4.0)
         with self.assertRaises(ZeroDivisionError):
             pmt_output(4, 0)
+
+    def test_f_table(self):
+        table = f_table(0.452, 5, 800)
+        s = table.s[1:, np.newaxis]
+        for e in [0.01, 1.0, 20.0]:
+            np.testing.assert_allclose(table(np.array([e]))[1:], f(s, np.array([e]), 0.452), rtol=1e-9)
+        self.assertIs(table, f_table(0.452, 5, 800))
+
+    def test_q_normalized(self):
+        s = np.arange(-50, 1500, 0.5)
+        for e in [0.1, 2.0, 10.0]:
+            self.assertAlmostEqual(np.trapz(q(s, np.full(s.shape, e), 0.452, 0, 6, delta_s=1, s_max=1400), x=s), 1, places=3)
+
+    def test_q_chunked(self):
+        rng = np.random.default_rng(0)
+        s, e = rng.normal(100, 50, (20, 30)), rng.uniform(0, 20, (20, 30))
+        q0, dq_de = q_grad(s, e, 0.45, 1, 6, s_max=500)
+        q0_chunked, dq_de_chunked = q_grad(s, e, 0.45, 1, 6, s_max=500, max_bytes=2*8*500*7)
+        np.testing.assert_allclose(q0_chunked, q0, rtol=1e-12)
+        np.testing.assert_allclose(dq_de_chunked, dq_de, rtol=1e-12, atol=1e-20)
+        np.testing.assert_allclose(q(s, e, 0.45, 1, 6, s_max=500, max_bytes=1), q0, rtol=1e-12)
+        self.assertEqual(q0.shape, s.shape)
+
+    def test_nll_table(self):
+        table = NLLTable(0.452, 0, 6, (-50, 600), delta_s=5, s_max=800)
+        rng = np.random.default_rng(0)
+        s, e = np.rint(rng.normal(100, 30, 200)), rng.uniform(0.01, 30, 200)
+        np.testing.assert_allclose(table(s, e), -np.log(q(s, e, 0.452, 0, 6, delta_s=5, s_max=800)), atol=1e-3)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            table.save(os.path.join(tmp, 'table.npz'))
+            loaded = NLLTable.load(os.path.join(tmp, 'table.npz'))
+        self.assertEqual(loaded.nll(s, e), table.nll(s, e))
+
+        # the edges of the table are interpolated, PMT outputs and expected photon counts beyond them are evaluated exactly
+        s, e = np.array([-50, 600, -51, 601, 100, 100, 100, 100]), np.array([1e-3, 1e2, 1e-3, 1e2, 1e-3, 1e2, 1e-4, 2e2])
+        q0, dq_de = q_grad(s, e, 0.452, 0, 6, delta_s=5, s_max=800)
+        np.testing.assert_allclose(table(s, e), -np.log(q0), atol=1e-9)
+        np.testing.assert_array_equal(table.nll_grad(s, e)[1][[2, 3, 6, 7]], (-dq_de/q0)[[2, 3, 6, 7]])
+        self.assertTrue(np.isnan(table(np.array([np.nan]), np.array([5.0]))))
+
+    def test_gradients(self):
+        rng = np.random.default_rng(1)
+        s, e, h = np.rint(rng.normal(100, 30, 50)), rng.uniform(0.05, 30, 50), 1e-6
+        
+        dq_de = (q(s, e + h, 0.452, 0, 6, 5, 800) - q(s, e - h, 0.452, 0, 6, 5, 800))/(2*h)
+        np.testing.assert_allclose(q_grad(s, e, 0.452, 0, 6, 5, 800)[1], dq_de, atol=1e-8*np.abs(dq_de).max())
+        
+        s[3] = np.nan
+        dnll_de = [(nll_q_mean(s, e + h*de, 0.452, 6, 10) - nll_q_mean(s, e - h*de, 0.452, 6, 10))/(2*h) for de in np.eye(len(e))]
+        np.testing.assert_allclose(nll_q_mean_de(s, e, 0.452, 6, 10), dnll_de, atol=1e-5)
+
+    def test_calibrate(self):
+        rng = np.random.default_rng(0)
+        n = rng.poisson([0, 1, 2, 4, 8], (16, 32, 32, 5)).T
+        stacks = np.rint(rng.gamma(np.maximum(3*n, 1e-12), 1/0.45)*(n > 0) + rng.normal(2.0, 6.0, n.shape))
+        for calibration in [calibrate(stacks), calibrate(stacks, per_pixel=True), calibrate(stacks[:, :2], refine=True)]:
+            np.testing.assert_allclose(calibration, [0.45, 6.0, 2.0], rtol=0.05, atol=0.2)
+        
+        # line-scan stacks, [frame, x], with the dark one last, and no dark stack (mu fitted)
+        lines = stacks[::-1, :, 0]
+        np.testing.assert_allclose(calibrate(lines, dark=4, per_pixel=True), calibrate(lines[..., np.newaxis], dark=4, per_pixel=True))
+        np.testing.assert_allclose(calibrate(lines, dark=4, per_pixel=True), [0.45, 6.0, 2.0], rtol=0.1, atol=0.3)
+        np.testing.assert_allclose(calibrate(stacks[1:, :4], dark=None), [0.45, 6.0, 2.0], rtol=0.05, atol=0.5)
+        
+        with tempfile.TemporaryDirectory() as path:
+            calibration.save(os.path.join(path, 'calibration.json'))
+            self.assertEqual(Calibration.load(os.path.join(path, 'calibration.json')), calibration)
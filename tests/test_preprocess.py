@@ -0,0 +1,32 @@
+import unittest
+import numpy as np
+from sl2pm import preprocess, simulate, track_vessel
+from sl2pm.models import L_plasma_no_glx
+
+
+class TestPreprocess(unittest.TestCase):
+    def test_bin_rows(self):
+        block = np.arange(14.0).reshape(7, 2)
+        block[1, 0] = np.nan
+        y, counts = preprocess.bin_rows(block, 3, mask=np.arange(7) == 4)
+        np.testing.assert_array_equal(counts, [[2, 3], [2, 2], [1, 1]])
+        np.testing.assert_allclose(y, [[2, 3], [8, 9], [12, 13]])
+
+    def test_profiles(self):
+        x, n_rows, n_aver = np.arange(48.0), 400, 10
+        intensity = np.full(n_rows, 10.0)
+        intensity[[*range(95, 130), *range(261, 268)]] = 1.0  # RBCs crossing
+        params = dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=10.0, I=intensity, b=1.0)
+        kymogram = simulate.vessel_kymogram(x, L_plasma_no_glx, params, 1, (0.452, 6.0, 0), rng=np.random.default_rng(0))
+
+        blocks = list(preprocess.profiles(kymogram, n_aver, block_size=128))
+        bins, y, counts = [np.concatenate(parts) for parts in zip(*blocks)]
+        np.testing.assert_array_equal(bins, np.r_[:10, 13:26, 27:40])
+        self.assertTrue(np.all(counts[bins == 9] < n_aver) and np.all(counts[bins == 5] == n_aver))
+        self.assertLessEqual(counts[:, 0].sum(), np.sum(intensity > 1))
+
+        fits = track_vessel.track_kymogram(y, L_plasma_no_glx, dict(s_xy=1.5, l=4.0), dict(xc=25.0, R_lum=10.5, I=10.5, b=1.05),
+                                           counts, 0.452, 6.0, workers=1, minimize_options=dict(gtol=1e-3))
+        self.assertTrue(np.all(fits['success']))
+        # unbiased within the scatter of the fits (wider than their error bars, as the masked bins vary in their counts)
+        self.assertLess(np.abs(np.mean(fits['R_lum']) - 10.0), 3*np.std(fits['R_lum'])/np.sqrt(len(fits)))
@@ -0,0 +1,42 @@
+import json
+import os
+import tempfile
+import unittest
+import numpy as np
+from sl2pm import profiling, simulate, track_vessel
+from sl2pm.models import L_plasma_no_glx
+
+
+class TestProfiling(unittest.TestCase):
+    def test_track_kymogram(self):
+        x = np.arange(48.0)
+        params = dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=np.full(8, 10.0), I=10.0, b=1.0)
+        kymogram = simulate.vessel_kymogram(x, L_plasma_no_glx, params, 10, (0.452, 6.0, 0), rng=np.random.default_rng(0))
+        args = (L_plasma_no_glx, dict(s_xy=1.5, l=4.0), dict(xc=25.0, R_lum=10.5, I=10.5, b=1.05), 10, 0.452, 6.0)
+
+        with profiling.profile() as profile:
+            fits = track_vessel.track_kymogram(kymogram, *args, chunk_size=3, workers=1, minimize_options=dict(gtol=1e-3))
+        self.assertFalse(profiling.enabled())
+
+        self.assertEqual([fit['index'] for fit in profile.fits], list(range(8)))
+        self.assertEqual([fit['nit'] for fit in profile.fits], list(fits['nit']))
+        self.assertEqual(profile.counts['misc.minimize_bfgs'], 8)
+        self.assertEqual(profile.counts['models.L_plasma_no_glx'], profile.counts['track_vessel.neg_loglike_grad'])
+        self.assertGreaterEqual(profile.counts['pmt.nll_q_mean'], sum(fit['nfev'] for fit in profile.fits))
+
+        summary, = profile.models()
+        self.assertEqual((summary['function'], summary['model'], summary['fits']), ('track_vessel', 'L_plasma_no_glx', 8))
+        self.assertIn('pmt.nll_q_mean_de', profile.table())
+
+        with tempfile.TemporaryDirectory() as directory:
+            profile.save(os.path.join(directory, 'profile.json'))
+            with open(os.path.join(directory, 'profile.json')) as file:
+                self.assertEqual(len(json.load(file)['fits']), 8)
+
+        # off by default, and worker outputs are merged only into a Profile being recorded
+        self.assertIsNone(profiling.run(False, track_vessel.track_kymogram, kymogram[:2], *args, workers=1)[1])
+        output = profiling.run(True, track_vessel.track_kymogram, kymogram[:2], *args, workers=1)
+        self.assertEqual(len(output[1].fits), 2)
+        with profiling.profile() as profile:
+            np.testing.assert_array_equal(profiling.collect(output, start=6), output[0])
+        self.assertEqual([fit['index'] for fit in profile.fits], [6, 7])
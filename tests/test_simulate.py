@@ -0,0 +1,23 @@
+import unittest
+import numpy as np
+from sl2pm import pmt, simulate
+from sl2pm.pmt import Calibration
+
+
+class TestSimulate(unittest.TestCase):
+    def test_pmt_sample(self):
+        e = np.full(200000, 3.0)
+        s = simulate.pmt_sample(e, 0.45, 6.0, mu=2.0, rng=0)
+        np.testing.assert_array_equal(s, simulate.pmt_sample(e, 0.45, 6.0, mu=2.0, rng=0))
+        self.assertAlmostEqual(s.mean(), pmt.pmt_output(3.0, 0.45) + 2.0, delta=0.2)
+        self.assertAlmostEqual(s.var()/pmt.pmt_output_var(pmt.pmt_output(3.0, 0.45), 0.45, 6.0), 1, delta=0.02)
+
+        s = simulate.pmt_sample(e, 0.45, 6.0, n_aver=10, rng=1)
+        self.assertAlmostEqual(s.var()/pmt.pmt_output_var(pmt.pmt_output(3.0, 0.45), 0.45, 6.0)*10, 1, delta=0.02)
+
+    def test_rbc_kymogram(self):
+        kymogram, truth = simulate.rbc_kymogram(20, 100, Calibration(0.45, 6.0, 0), speed=2.5, rng=0)
+        self.assertEqual(kymogram.shape, (20, 100))
+        for _, cell in zip(range(3), np.unique(truth['cell'])):
+            front = truth[(truth['cell'] == cell) & truth['plasma_before_rbc']]
+            np.testing.assert_allclose(np.diff(front['xo'])/np.diff(front['t']), 2.5)
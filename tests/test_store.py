@@ -0,0 +1,41 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from sl2pm import store, track_rbc
+from sl2pm.misc import fit_dtype
+
+
+class TestStore(unittest.TestCase):
+    def test_result_store(self):
+        records = np.zeros(10, dtype=fit_dtype(['b', 'A', 's', 'xo']))
+        records['xo'], records['xo_err'], records['success'] = 2.0*np.arange(10) + 1, 0.1, True
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rbc.npy')
+            results = store.ResultStore(path, records.dtype)
+            self.assertEqual(len(results.read()), 0)
+            self.assertEqual(results.extend(iter(records[:7]), chunk_size=3), 7)
+            self.assertEqual(results.chunks, [(0, 3), (3, 6), (6, 7)])
+
+            # a crash while appending a chunk: records written but not committed in the index
+            with open(path, 'ab') as file:
+                file.write(records[7:9].tobytes())
+            resumed = store.ResultStore(path)
+            self.assertEqual(len(resumed), 7)
+            with self.assertRaises(ValueError):
+                store.ResultStore(path, fit_dtype(['xo']))
+
+            resumed.append(records[len(resumed):])
+            mapped = resumed.read()
+            self.assertIsInstance(mapped, np.memmap)
+            np.testing.assert_array_equal(mapped, records)
+            np.testing.assert_array_equal(np.load(path), records)
+            np.testing.assert_array_equal(resumed.chunk(1)['xo'], records['xo'][3:6])
+
+            speed = track_rbc.rbc_speed(np.arange(10), mapped['xo'], mapped['xo_err'])
+            self.assertAlmostEqual(speed['speed'], 2.0)
+
+            resumed.truncate(5)
+            self.assertEqual(len(store.ResultStore(path)), 3)
+            del mapped
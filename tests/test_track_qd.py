@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+from sl2pm import track_qd
+from sl2pm.models import qd_blurred
+from sl2pm.pmt import Calibration
+
+
+class TestTrackQD(unittest.TestCase):
+    def test_track_stack(self):
+        rng = np.random.default_rng(0)
+        X, Y = track_qd.xy_grid((12, 14))
+        xo, yo = 6 + 0.1*np.arange(6), 5 - 0.05*np.arange(6)
+        e = np.array([qd_blurred(X, Y, 0.5, 150, x, y, 1.5, 1.2, 0.3) for x, y in zip(xo, yo)])
+        n = rng.poisson(e)
+        images = rng.gamma(np.maximum(3*n, 1e-12), 1/0.45)*(n > 0) + rng.normal(0, 6, n.shape)
+
+        seeds = track_qd.p0_moments(images, 0.45)
+        np.testing.assert_allclose(seeds[:, 2:4], np.transpose([xo, yo]), atol=1)
+        
+        fits = track_qd.track_stack(images, Calibration(0.45, 6.0, 0), workers=1, minimize_options=dict(gtol=1e-3))
+        self.assertTrue(fits['success'].all())
+        np.testing.assert_allclose(fits['xo'], xo, atol=4*fits['xo_err'].max())
+        np.testing.assert_allclose(fits['yo'], yo, atol=4*fits['yo_err'].max())
+        
+        ols = track_qd.track_stack(images[:2], Calibration(0.45, 6.0, 0), p0='ols', workers=1, minimize_options=dict(gtol=1e-3))
+        np.testing.assert_allclose(ols['xo'], fits['xo'][:2], atol=1e-2)
+        with self.assertRaises(ValueError):
+            track_qd.track_stack(images, Calibration(0.45, 6.0, 0), p0='max', workers=1)
+
+    def test_track_frames(self):
+        rng = np.random.default_rng(1)
+        X, Y = track_qd.xy_grid((48, 64))
+        xo, yo = np.array([10.3, 30.6, 52.1, 20.8]), np.array([12.2, 35.7, 9.4, 40.1])
+        e = 0.5 + sum(qd_blurred(X, Y, 0, 150, x, y, 1.5, 1.5, 0) for x, y in zip(xo, yo))
+        n = rng.poisson(e)
+        frame = rng.gamma(np.maximum(3*n, 1e-12), 1/0.45)*(n > 0) + rng.normal(0, 6, n.shape)
+
+        # a chain of candidates: the second is suppressed by the first, and so does not suppress the third
+        np.testing.assert_array_equal(track_qd._suppress(np.zeros(3), np.array([0.0, 3.0, 6.0]), np.array([3.0, 2.0, 1.0]), 4), [0, 2])
+        t, y, x, _ = track_qd.detect_spots(np.stack([frame, frame[::-1]]))
+        np.testing.assert_array_equal(np.bincount(t), [len(xo), len(xo)])
+        
+        rois, y0, x0 = track_qd.extract_rois(frame, [2, 20], [30, 62], 6)
+        self.assertTrue(all(np.shares_memory(roi, frame) for roi in rois))
+        np.testing.assert_array_equal(x0, [24, 51])
+        
+        fits = track_qd.track_frames(frame, Calibration(0.45, 6.0, 0), workers=1, minimize_options=dict(gtol=1e-3))
+        self.assertEqual(len(fits), len(xo))
+        order = np.argsort(yo)
+        np.testing.assert_allclose(fits['xo'], xo[order], atol=0.5)
+        np.testing.assert_allclose(fits['yo'], yo[order], atol=0.5)
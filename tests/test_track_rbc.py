@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+from sl2pm import simulate, track_rbc
+from sl2pm.models import rbc
+from sl2pm.pmt import Calibration
+
+
+class TestTrackRBC(unittest.TestCase):
+    def test_link_edges(self):
+        t = np.array([0, 0, 1, 1, 1, 2, 3])
+        x = np.array([10., 40., 12., 14., 43., 16., 18.])
+        polarity = np.array([True, False, True, True, False, True, True])
+        np.testing.assert_array_equal(track_rbc.link_edges(t, x, polarity, max_shift=5), [0, 1, 0, 2, 1, 2, 2])
+        
+        # missed detections: a gap of one line-scan is bridged with max_gap=1 (within max_shift per line-scan), not with max_gap=0
+        t, x = np.array([0, 2, 3, 5, 6, 9]), np.array([10., 14., 16., 22., 24., 30.])
+        np.testing.assert_array_equal(track_rbc.link_edges(t, x, np.ones(6, dtype=bool), max_shift=3, max_gap=0), [0, 1, 1, 2, 2, 3])
+        np.testing.assert_array_equal(track_rbc.link_edges(t, x, np.ones(6, dtype=bool), max_shift=3, max_gap=1), [0, 0, 0, 0, 0, 1])
+        # interfaces before 'start' are only continued
+        np.testing.assert_array_equal(track_rbc.link_edges([0, 1, 2, 3], [10., 12., 14., 16.], np.ones(4, dtype=bool), start=2), [0, 1, 1, 1])
+
+    def test_track_kymogram(self):
+        rng = np.random.default_rng(0)
+        speed, x = 2.5, np.arange(100)
+        fronts = 60 + speed*np.arange(40)
+        e = 2 + 14*(1 - rbc(x, 0, 1, 1.5, fronts[:, np.newaxis] - 30) + rbc(x, 0, 1, 1.5, fronts[:, np.newaxis]))
+        n = rng.poisson(e)
+        kymogram = rng.gamma(np.maximum(3*n, 1e-12), 1/0.45)*(n > 0) + rng.normal(0, 6, n.shape)
+
+        tracks = np.concatenate(list(track_rbc.track_kymogram(kymogram, Calibration(0.45, 6.0, 0), block_size=16, workers=1, 
+                                                              minimize_options=dict(gtol=1e-3))))
+        # the front and the rear of the RBC are one cell (the other tracks are spurious detections in single line-scans)
+        labels, counts = np.unique(tracks['interface'], return_counts=True)
+        front, rear = labels[np.argsort(counts)[-2:]]
+        cells = track_rbc.pair_cells(tracks)
+        self.assertEqual(cells[tracks['interface'] == front][0], cells[tracks['interface'] == rear][0])
+        speeds = track_rbc.cell_speeds(tracks, min_scans=10)
+        self.assertEqual(len(speeds), 1)
+        self.assertEqual(speeds['n_edges'][0], 2)
+        np.testing.assert_allclose(speeds['speed'], speed, atol=4*speeds['speed_err'].max())
+
+    def test_cells(self):
+        calibration = Calibration(0.45, 6.0, 0)
+        kymogram, truth = simulate.rbc_kymogram(48, 120, calibration, speed=2.5, rng=0)
+        # a line-scan without interfaces at the start of a block
+        kymogram[16] = kymogram.mean()
+        tracks = np.concatenate(list(track_rbc.track_kymogram(kymogram, calibration, block_size=16, workers=1, 
+                                                              minimize_options=dict(gtol=1e-3))))
+        
+        # the interfaces on both sides of the gap stay on their tracks
+        crossing = [k for k in np.unique(tracks['interface']) if tracks['t'][tracks['interface'] == k].min() < 16 < tracks['t'][tracks['interface'] == k].max()]
+        edges = {(cell, polarity) for cell, _, polarity, _ in truth[truth['t'] == 15]} & {(cell, polarity) for cell, _, polarity, _ in truth[truth['t'] == 17]}
+        self.assertEqual(len(crossing), len(edges))
+        
+        speeds = track_rbc.cell_speeds(tracks, min_scans=10)
+        self.assertEqual(speeds['n_edges'].max(), 2)
+        np.testing.assert_allclose(speeds['speed'], 2.5, atol=4*speeds['speed_err'].max())
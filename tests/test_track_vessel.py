@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+import numpy as np
+from sl2pm import simulate, track_vessel
+from sl2pm.models import L_multi_plasma, L_plasma_no_glx
+
+
+class TestTrackVessel(unittest.TestCase):
+    def test_mle_multi(self):
+        rng = np.random.default_rng(0)
+        x, n_aver = np.arange(60), 10
+        p_true = [2.5, 20.0, 0.2, 45.0, 44.0, 46.0, 15.0, 16.0, 17.0, 30.0, 30.5, 29.5]
+        e = L_multi_plasma(x, *p_true)
+        y = 3/0.452*e + rng.normal(size=e.shape)*np.sqrt((4*e/0.452 + 36)/n_aver)
+        p0 = [2.3, 18.0, 0.3, 40.0, 40.0, 40.0, 15.0, 15.0, 15.0, 30.0, 30.0, 30.0]
+
+        res_bfgs = track_vessel.mle(x, y, L_multi_plasma, p0, n_aver, 0.452, 6.0)
+        res = track_vessel.mle_multi(x, y, L_multi_plasma, p0, n_aver, 0.452, 6.0, chunk_size=2)
+        
+        self.assertTrue(res.success)
+        self.assertAlmostEqual(res.fun, res_bfgs.fun, places=5)
+        np.testing.assert_allclose(res.x, res_bfgs.x, atol=1e-3)
+        self.assertEqual(res.hess_inv.shape, (len(p0), len(p0)))
+
+    def test_track_kymogram(self):
+        x, R = np.arange(48.0), 10 + 0.5*np.sin(np.arange(7)/3)
+        kymogram = simulate.vessel_kymogram(x, L_plasma_no_glx, dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=R, I=10.0, b=1.0), 10, (0.45, 6.0, 0), rng=1)
+        args = (L_plasma_no_glx, dict(s_xy=1.5, l=4.0), dict(xc=23.0, R_lum=9.0, I=9.0, b=1.2), 10, 0.45, 6.0)
+
+        fits = track_vessel.track_kymogram(kymogram, *args, chunk_size=3, workers=1)
+        np.testing.assert_array_equal(track_vessel.track_kymogram(kymogram, *args, chunk_size=3, workers=2), fits)
+        # the warm start does not cross chunks: each chunk is fitted as if it were a kymogram of its own
+        for i in range(0, len(kymogram), 3):
+            np.testing.assert_array_equal(track_vessel.track_kymogram(kymogram[i: i + 3], *args, workers=1), fits[i: i + 3])
+        self.assertNotEqual(track_vessel.track_kymogram(kymogram, *args, chunk_size=7, workers=1)['nit'][3], fits['nit'][3])
+
+    def test_streaming_tracker(self):
+        x, R = np.arange(48.0), 10 + 0.5*np.sin(np.arange(20)/3)
+        kymogram = simulate.vessel_kymogram(x, L_plasma_no_glx, dict(xc=24.0, s_xy=1.5, l=4.0, R_lum=R, I=10.0, b=1.0), 10, (0.45, 6.0, 0), rng=0)
+        args = (L_plasma_no_glx, dict(s_xy=1.5, l=4.0), dict(xc=23.0, R_lum=9.0, I=9.0, b=1.2), 10, 0.45, 6.0)
+
+        fits = np.array(list(track_vessel.StreamingTracker(*args, minimize_options=dict(gtol=1e-3)).track(kymogram)))
+        self.assertFalse(fits['fallback'].any())
+        self.assertTrue(np.all(fits['latency'] > 0))
+        np.testing.assert_allclose(fits['R_lum'], R, atol=5*fits['R_lum_err'].max())
+        np.testing.assert_allclose(fits['R_lum_filtered'], R, atol=5*fits['R_lum_err'].max())
+
+        fits = np.array(list(track_vessel.StreamingTracker(*args, budget=0).track(kymogram[:3])))
+        self.assertTrue(fits['fallback'].all())
+        self.assertTrue(np.isnan(fits['R_lum_err']).all())
+        np.testing.assert_allclose(fits['R_lum'], R[:3], atol=2)
+
+        async def profiles():
+            for y in kymogram[:3]:
+                yield y
+
+        async def track():
+            return [fit async for fit in track_vessel.StreamingTracker(*args, minimize_options=dict(gtol=1e-3)).atrack(profiles())]
+
+        synchronous = list(track_vessel.StreamingTracker(*args, minimize_options=dict(gtol=1e-3)).track(kymogram[:3]))
+        np.testing.assert_allclose(np.array(asyncio.run(track()))['R_lum'], np.array(synchronous)['R_lum'])